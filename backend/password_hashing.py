@@ -0,0 +1,22 @@
+"""bcrypt hashing for passwords and PINs.
+
+Kept apart from server.py so the hashing process pool only imports passlib
+instead of the whole app (Mongo client, settings, routes) in every worker.
+"""
+from passlib.context import CryptContext
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+def hash_password(password: str) -> str:
+    return pwd_context.hash(password)
+
+def verify_password(plain_password: str, hashed_password: str) -> bool:
+    return pwd_context.verify(plain_password, hashed_password)
+
+def hash_pin(pin: str) -> str:
+    """Hash PIN for secure storage"""
+    return pwd_context.hash(pin)
+
+def verify_pin(plain_pin: str, hashed_pin: str) -> bool:
+    """Verify PIN against hash"""
+    return pwd_context.verify(plain_pin, hashed_pin)
@@ -1,19 +1,42 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, File, Request, Response, UploadFile, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING, IndexModel, ReturnDocument, UpdateOne
+from bson import Binary
+from pymongo.errors import BulkWriteError, DuplicateKeyError, ExecutionTimeout, OperationFailure
 import os
 import logging
 from pathlib import Path
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, TypeAdapter
 from typing import List, Optional
 import uuid
 from datetime import datetime, timezone, timedelta
 import jwt
-from passlib.context import CryptContext
+from password_hashing import hash_password, verify_password, hash_pin, verify_pin
 import json
+import re
 import base64
+import gzip
+import hashlib
+import random
+import math
+import unicodedata
+import time
+import asyncio
+import multiprocessing
+import tempfile
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+
+# orjson renders responses several times faster than the stdlib encoder
+try:
+    from fastapi.responses import ORJSONResponse as DefaultJSONResponse
+    import orjson  # noqa: F401 - ORJSONResponse only fails when rendering without it
+except ImportError:
+    from fastapi.responses import JSONResponse as DefaultJSONResponse
 
 # WebAuthn imports (will be imported dynamically in functions to avoid dependency issues)
 try:
@@ -30,17 +53,147 @@ mongo_url = os.environ['MONGO_URL']
 client = AsyncIOMotorClient(mongo_url)
 db = client[os.environ['DB_NAME']]
 
+# Indexes
+# Every query shape in this module should be served by one of these. Indexes keep
+# the default generated names so ones created by hand before are recognised.
+INDEXES = {
+    "users": [
+        IndexModel([("username", ASCENDING)], unique=True),
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("company_id", ASCENDING), ("role", ASCENDING), ("created_at", ASCENDING), ("id", ASCENDING)]),
+        IndexModel([("role", ASCENDING)])
+    ],
+    "companies": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("name", ASCENDING)])
+    ],
+    "orders": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("company_id", ASCENDING), ("created_at", ASCENDING), ("id", ASCENDING)]),
+        IndexModel([("courier_id", ASCENDING), ("status", ASCENDING), ("created_at", ASCENDING), ("id", ASCENDING)]),
+        IndexModel([("customer_id", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)]),
+        IndexModel([("company_id", ASCENDING), ("search_grams", ASCENDING)])
+    ],
+    "customers": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("company_id", ASCENDING), ("phone_number", ASCENDING)], unique=True),
+        IndexModel([("company_id", ASCENDING), ("name", ASCENDING), ("id", ASCENDING)]),
+        IndexModel([("company_id", ASCENDING), ("search_grams", ASCENDING)])
+    ],
+    "user_security": [
+        IndexModel([("user_id", ASCENDING)], unique=True)
+    ],
+    "sms_logs": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("company_id", ASCENDING), ("sent_at", DESCENDING)]),
+        IndexModel([("sent_at", DESCENDING)])
+    ],
+    "sms_logs_archive": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("company_id", ASCENDING), ("date", DESCENDING), ("last_sent_at", DESCENDING)])
+    ],
+    "sms_monthly_stats": [
+        IndexModel([("year", ASCENDING), ("month", ASCENDING)], unique=True)
+    ],
+    "sms_daily_stats": [
+        IndexModel([("date", ASCENDING), ("company_id", ASCENDING)], unique=True),
+        IndexModel([("year", ASCENDING), ("month", ASCENDING), ("day", ASCENDING)])
+    ],
+    "sms_outbox": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("status", ASCENDING), ("priority", ASCENDING), ("next_attempt_at", ASCENDING)]),
+        IndexModel([("status", ASCENDING), ("lease_expires_at", ASCENDING)]),
+        IndexModel([("coalesce_key", ASCENDING), ("status", ASCENDING), ("coalesce_until", ASCENDING)], sparse=True),
+        IndexModel([("sms_log.sent_at", ASCENDING)], sparse=True),
+        IndexModel([("purge_at", ASCENDING)], expireAfterSeconds=0)
+    ],
+    "token_revocations": [
+        IndexModel([("kind", ASCENDING), ("subject_id", ASCENDING)], unique=True),
+        IndexModel([("updated_at", ASCENDING)]),
+        IndexModel([("expire_at", ASCENDING)], expireAfterSeconds=0)
+    ],
+    "export_jobs": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("status", ASCENDING), ("created_at", ASCENDING)]),
+        IndexModel([("company_id", ASCENDING), ("created_at", DESCENDING)]),
+        IndexModel([("purge_at", ASCENDING)], expireAfterSeconds=0)
+    ],
+    "change_versions": [
+        IndexModel([("scope", ASCENDING)], unique=True)
+    ],
+    "job_locks": [
+        IndexModel([("name", ASCENDING)], unique=True)
+    ],
+    "ephemeral_store": [
+        IndexModel([("key", ASCENDING)], unique=True),
+        IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0)
+    ]
+}
+
+# collection -> {index name: error} of the last attempt to create each declared index
+index_failures = {}
+
+async def ensure_collection_indexes(collection_name: str) -> bool:
+    """Create the declared indexes of one collection, a no-op when they already exist.
+
+    Each index is created on its own so one that cannot be built does not hold
+    back the others. Returns True when every declared index exists.
+    """
+    failures = {}
+    for model in INDEXES[collection_name]:
+        name = model.document["name"]
+        try:
+            await db[collection_name].create_indexes([model])
+        except OperationFailure as e:
+            # Typically duplicates blocking a unique index or an index with the same keys under another name
+            print(f"⚠️ Could not create index {name} on {collection_name}: {e}")
+            failures[name] = str(e)
+    index_failures[collection_name] = failures
+    return not failures
+
+async def ensure_indexes():
+    """Apply the index registry, runs in the background so startup is not blocked by index builds"""
+    failed = [name for name in INDEXES if not await ensure_collection_indexes(name)]
+    if failed:
+        print(f"⚠️ Index bootstrap incomplete for: "
+              f"{', '.join(f'{name} ({len(index_failures[name])} failed)' for name in failed)}")
+    else:
+        print(f"✅ Indexes ensured on {len(INDEXES)} collections")
+
+async def build_index_report() -> dict:
+    """Declared indexes missing from the database and existing ones that are undeclared or unused"""
+    report = {}
+    for collection_name, models in INDEXES.items():
+        collection = db[collection_name]
+        existing = await collection.index_information()
+        usage = {
+            row["name"]: {"ops": row["accesses"]["ops"], "since": row["accesses"]["since"]}
+            for row in await collection.aggregate([{"$indexStats": {}}]).to_list(None)
+        }
+        declared = {model.document["name"] for model in models}
+        report[collection_name] = {
+            "missing": sorted(declared - set(existing)),
+            "undeclared": sorted(set(existing) - declared - {"_id_"}),
+            # Access counters reset on mongod restart, check "since" before dropping anything
+            "unused": sorted(name for name, stats in usage.items() if name != "_id_" and stats["ops"] == 0),
+            "failed": index_failures.get(collection_name, {}),
+            "usage": usage
+        }
+    return report
+
 # Create the main app without a prefix
-app = FastAPI()
+app = FastAPI(default_response_class=DefaultJSONResponse)
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
 
 # Security
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 security = HTTPBearer()
 JWT_SECRET = "your-secret-key-change-in-production"
 JWT_ALGORITHM = "HS256"
+ACCESS_TOKEN_TTL_MINUTES = int(os.environ.get('ACCESS_TOKEN_TTL_MINUTES', '15'))
+REFRESH_TOKEN_TTL_DAYS = int(os.environ.get('REFRESH_TOKEN_TTL_DAYS', '7'))
+TOKEN_REVOCATION_SYNC_SECONDS = float(os.environ.get('TOKEN_REVOCATION_SYNC_SECONDS', '5'))
 
 # User roles
 class UserRole:
@@ -56,6 +209,8 @@ class Company(BaseModel):
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     total_deliveries: int = 0
     active_couriers: int = 0
+    sms_coalesce_window_seconds: Optional[int] = None  # None uses the server default
+    sms_encoding_policy: Optional[str] = None  # "unicode" or "gsm7", None uses the server default
 
 class User(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -66,6 +221,16 @@ class User(BaseModel):
     is_active: bool = True
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
+class TokenUser(User):
+    """User authorized from access token claims alone.
+
+    The token only carries id, username, role and company, the other profile
+    fields are None rather than defaults; load the user when they are needed.
+    """
+    full_name: Optional[str] = None
+    is_active: Optional[bool] = None
+    created_at: Optional[datetime] = None
+
 class Order(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     customer_name: str
@@ -103,6 +268,17 @@ class LoginResponse(BaseModel):
     token_type: str
     user: User
     company: Optional[Company] = None
+    refresh_token: Optional[str] = None
+    expires_in: Optional[int] = None
+
+class RefreshTokenRequest(BaseModel):
+    refresh_token: str
+
+class TokenResponse(BaseModel):
+    access_token: str
+    refresh_token: str
+    token_type: str
+    expires_in: int
 
 class CreateCompanyRequest(BaseModel):
     name: str
@@ -112,6 +288,10 @@ class CreateCompanyRequest(BaseModel):
 class UpdateCompanyRequest(BaseModel):
     name: str
 
+class UpdateCompanySMSSettingsRequest(BaseModel):
+    sms_coalesce_window_seconds: Optional[int] = None
+    sms_encoding_policy: Optional[str] = None
+
 class DeleteCompanyRequest(BaseModel):
     password: str
 
@@ -150,6 +330,14 @@ class AssignOrderRequest(BaseModel):
 class MarkDeliveredRequest(BaseModel):
     order_id: str
 
+class BulkAssignOrdersRequest(BaseModel):
+    order_ids: List[str]
+    courier_id: Optional[str] = Field(default=None, min_length=1)  # None unassigns the orders
+
+class BulkOrderStatusRequest(BaseModel):
+    order_ids: List[str]
+    status: str
+
 class CreateCustomerRequest(BaseModel):
     name: str
     phone_number: str
@@ -164,6 +352,15 @@ class UpdateCustomerRequest(BaseModel):
     email: Optional[str] = None
     notes: Optional[str] = None
 
+class CreateExportJobRequest(BaseModel):
+    format: str = "csv"  # "csv" or "excel"
+    customer_name: Optional[str] = None
+    courier_id: Optional[str] = None
+    date_from: Optional[str] = None
+    date_to: Optional[str] = None
+    status: Optional[str] = None
+    q: Optional[str] = None
+
 # Security Models
 class UserSecurity(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -223,33 +420,285 @@ class UpdateSMSCostRequest(BaseModel):
     currency: str = "EUR"
 
 # Helper functions
-def hash_password(password: str) -> str:
-    return pwd_context.hash(password)
-
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
-
-def create_access_token(data: dict):
+def create_access_token(data: dict, expires_delta: timedelta = timedelta(days=7)):
     to_encode = data.copy()
-    expire = datetime.now(timezone.utc) + timedelta(days=7)
-    to_encode.update({"exp": expire})
+    now = datetime.now(timezone.utc)
+    to_encode.update({"iat": now, "exp": now + expires_delta})
     encoded_jwt = jwt.encode(to_encode, JWT_SECRET, algorithm=JWT_ALGORITHM)
     return encoded_jwt
 
+def create_user_tokens(user_data: dict, company_data: Optional[dict] = None):
+    """Issue a short-lived access token carrying the user's claims plus a refresh token.
+
+    Access tokens embed role, company and token versions so protected routes can
+    authorize without a database lookup; revocation is handled by token_revocations.
+    """
+    access_token = create_access_token({
+        "type": "access",
+        "sub": user_data["username"],
+        "uid": user_data["id"],
+        "role": user_data["role"],
+        "cid": user_data.get("company_id"),
+        "ver": user_data.get("token_version", 0),
+        "cver": company_data.get("token_version", 0) if company_data else 0
+    }, timedelta(minutes=ACCESS_TOKEN_TTL_MINUTES))
+    refresh_token = create_access_token({
+        "type": "refresh",
+        "sub": user_data["username"],
+        "uid": user_data["id"],
+        "ver": user_data.get("token_version", 0)
+    }, timedelta(days=REFRESH_TOKEN_TTL_DAYS))
+    return access_token, refresh_token
+
+class TokenRevocationList:
+    """Compact in-memory set of revoked token versions.
+
+    Maps user ids and company ids to the minimum token version still accepted.
+    Entries are persisted in db.token_revocations and pulled by every worker each
+    TOKEN_REVOCATION_SYNC_SECONDS; they are dropped once every access token they
+    could reject has expired.
+    """
+
+    def __init__(self, sync_seconds: float, retention: timedelta):
+        self.sync_seconds = sync_seconds
+        self.retention = retention
+        self._users = {}  # user_id -> (min_version, updated_at)
+        self._companies = {}  # company_id -> (min_version, updated_at)
+        self._last_sync = None
+        self._task = None
+        self.rejected = 0
+
+    def _apply(self, kind: str, subject_id: str, min_version: int, updated_at: datetime):
+        entries = self._users if kind == "user" else self._companies
+        current = entries.get(subject_id)
+        if current is None or current[0] < min_version:
+            entries[subject_id] = (min_version, updated_at)
+
+    def is_revoked(self, payload: dict) -> bool:
+        user_entry = self._users.get(payload.get("uid"))
+        if user_entry and payload.get("ver", 0) < user_entry[0]:
+            self.rejected += 1
+            return True
+        company_entry = self._companies.get(payload.get("cid"))
+        if company_entry and payload.get("cver", 0) < company_entry[0]:
+            self.rejected += 1
+            return True
+        return False
+
+    async def revoke(self, kind: str, subject_id: str, min_version: int):
+        now = datetime.now(timezone.utc)
+        self._apply(kind, subject_id, min_version, now)
+        await db.token_revocations.update_one(
+            {"kind": kind, "subject_id": subject_id},
+            {"$max": {"min_version": min_version},
+             "$set": {"updated_at": now, "expire_at": now + self.retention}},
+            upsert=True
+        )
+
+    async def sync(self):
+        now = datetime.now(timezone.utc)
+        since = self._last_sync or now - self.retention
+        async for entry in db.token_revocations.find(
+            {"updated_at": {"$gt": since}},
+            {"_id": 0, "kind": 1, "subject_id": 1, "min_version": 1, "updated_at": 1}
+        ):
+            self._apply(entry["kind"], entry["subject_id"], entry["min_version"], entry["updated_at"])
+        self._last_sync = now
+        
+        # Tokens issued before the cutoff have expired, their entries are no longer needed
+        cutoff = (now - self.retention).replace(tzinfo=None)
+        for entries in (self._users, self._companies):
+            for subject_id in [k for k, v in entries.items() if v[1].replace(tzinfo=None) < cutoff]:
+                del entries[subject_id]
+
+    async def _run(self):
+        while True:
+            try:
+                await self.sync()
+            except Exception as e:
+                print(f"⚠️ Token revocation sync failed: {str(e)}")
+            await asyncio.sleep(self.sync_seconds)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self) -> dict:
+        return {
+            "revoked_users": len(self._users),
+            "revoked_companies": len(self._companies),
+            "rejected_tokens": self.rejected,
+            "last_sync": self._last_sync.isoformat() if self._last_sync else None
+        }
+
+token_revocations = TokenRevocationList(
+    TOKEN_REVOCATION_SYNC_SECONDS,
+    timedelta(minutes=ACCESS_TOKEN_TTL_MINUTES, seconds=TOKEN_REVOCATION_SYNC_SECONDS)
+)
+
+async def revoke_user_tokens(user_id: str):
+    """Bump a user's token version so every token issued before now is rejected"""
+    user = await db.users.find_one_and_update(
+        {"id": user_id},
+        {"$inc": {"token_version": 1}},
+        projection={"_id": 0, "token_version": 1},
+        return_document=ReturnDocument.AFTER
+    )
+    if user:
+        await token_revocations.revoke("user", user_id, user["token_version"])
+
+async def revoke_company_tokens(company_id: str, current_version: Optional[int] = None):
+    """Bump a company's token version so every token issued to its users is rejected"""
+    if current_version is None:
+        company = await db.companies.find_one_and_update(
+            {"id": company_id},
+            {"$inc": {"token_version": 1}},
+            projection={"_id": 0, "token_version": 1},
+            return_document=ReturnDocument.AFTER
+        )
+        if not company:
+            return
+        current_version = company["token_version"]
+    await token_revocations.revoke("company", company_id, current_version)
+
+# Authenticated principal cache
+PRINCIPAL_CACHE_TTL_SECONDS = float(os.environ.get('PRINCIPAL_CACHE_TTL_SECONDS', '30'))
+PRINCIPAL_CACHE_MAX_ENTRIES = int(os.environ.get('PRINCIPAL_CACHE_MAX_ENTRIES', '10000'))
+
+class PrincipalCache:
+    """In-process TTL/LRU cache of authenticated users keyed by token subject.
+
+    Each entry holds the User together with the is_active flag of its company,
+    so disabled companies can be rejected without an extra query. Entries are
+    dropped explicitly by the write endpoints that touch users or companies;
+    the TTL bounds staleness for writes made by other workers.
+    """
+
+    def __init__(self, ttl_seconds: float, max_entries: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # username -> (expires_at, user, company_active)
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    def get(self, username: str):
+        entry = self._entries.get(username)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[username]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(username)
+        self.hits += 1
+        return entry[1], entry[2]
+
+    def set(self, username: str, user: "User", company_active: bool, generation: int):
+        # Skip entries loaded before an invalidation ran, they may be stale
+        if generation != self._generation or self.max_entries <= 0:
+            return
+        self._entries[username] = (time.monotonic() + self.ttl_seconds, user, company_active)
+        self._entries.move_to_end(username)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate_user(self, *usernames: str):
+        self._generation += 1
+        for username in usernames:
+            if self._entries.pop(username, None) is not None:
+                self.invalidations += 1
+
+    def invalidate_company(self, company_id: str):
+        self._generation += 1
+        stale = [username for username, entry in self._entries.items() if entry[1].company_id == company_id]
+        for username in stale:
+            del self._entries[username]
+        self.invalidations += len(stale)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups * 100, 1) if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations
+        }
+
+principal_cache = PrincipalCache(PRINCIPAL_CACHE_TTL_SECONDS, PRINCIPAL_CACHE_MAX_ENTRIES)
+
+async def load_principal(username: str):
+    """Load a user and its company's is_active flag in a single round trip"""
+    results = await db.users.aggregate([
+        {"$match": {"username": username}},
+        {"$limit": 1},
+        {"$lookup": {
+            "from": "companies",
+            "localField": "company_id",
+            "foreignField": "id",
+            "as": "company"
+        }},
+        {"$addFields": {
+            "company_is_active": {"$ifNull": [{"$arrayElemAt": ["$company.is_active", 0]}, True]}
+        }},
+        {"$project": {"_id": 0, "password": 0, "company": 0}}
+    ]).to_list(1)
+    if not results:
+        return None
+    user_data = results[0]
+    return User(**user_data), user_data["company_is_active"]
+
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
     try:
         payload = jwt.decode(credentials.credentials, JWT_SECRET, algorithms=[JWT_ALGORITHM])
         username: str = payload.get("sub")
-        if username is None:
+        if username is None or payload.get("type") == "refresh":
             raise HTTPException(status_code=401, detail="Invalid token")
-        
-        user_data = await db.users.find_one({"username": username})
-        if user_data is None:
-            raise HTTPException(status_code=401, detail="User not found")
-        
-        return User(**user_data)
     except jwt.PyJWTError:
         raise HTTPException(status_code=401, detail="Invalid token")
+    
+    # Self-contained access tokens authorize without touching the database
+    if payload.get("uid") is not None:
+        if token_revocations.is_revoked(payload):
+            raise HTTPException(status_code=401, detail="Token revoked")
+        return TokenUser(
+            id=payload["uid"],
+            username=username,
+            role=payload["role"],
+            company_id=payload.get("cid")
+        )
+    
+    # Legacy tokens only carry the username
+    principal = principal_cache.get(username)
+    if principal is None:
+        generation = principal_cache.generation
+        principal = await load_principal(username)
+        if principal is None:
+            raise HTTPException(status_code=401, detail="User not found")
+        principal_cache.set(username, principal[0], principal[1], generation)
+    
+    user, company_active = principal
+    if not user.is_active:
+        raise HTTPException(status_code=401, detail="Account disabled")
+    if not company_active:
+        raise HTTPException(status_code=403, detail="Company disabled")
+    
+    return user
 
 def require_role(required_roles: List[str]):
     def role_checker(current_user: User = Depends(get_current_user)):
@@ -259,8 +708,10 @@ def require_role(required_roles: List[str]):
     return role_checker
 
 # SMS Cost Management Functions
-async def get_sms_cost_settings():
-    """Get current SMS cost settings"""
+SMS_COST_SETTINGS_CHECK_SECONDS = float(os.environ.get('SMS_COST_SETTINGS_CHECK_SECONDS', '10'))
+
+async def load_sms_cost_settings():
+    """Load SMS cost settings from the database, creating the defaults if missing"""
     settings = await db.sms_cost_settings.find_one({})
     if not settings:
         # Create default settings
@@ -269,89 +720,759 @@ async def get_sms_cost_settings():
             "cost_per_sms": 0.05,
             "currency": "EUR", 
             "updated_at": datetime.now(timezone.utc),
-            "updated_by": "system"
+            "updated_by": "system",
+            "version": 0
         }
-        await db.sms_cost_settings.insert_one(default_settings)
-        return default_settings
+        await db.sms_cost_settings.update_one({}, {"$setOnInsert": default_settings}, upsert=True)
+        settings = await db.sms_cost_settings.find_one({})
     
     # Convert ObjectId to string for JSON serialization
     if '_id' in settings:
         settings['_id'] = str(settings['_id'])
     return settings
 
-async def update_monthly_sms_stats(success: bool = True, company_id: str = None):
+class SMSCostSettingsCache:
+    """Process-local copy of the SMS cost settings.
+
+    update_sms_cost_settings bumps a version on the settings document and
+    refreshes the local copy. Other workers pick the change up with a projected
+    version read at most once every check_seconds, reloading only on mismatch.
+    """
+
+    def __init__(self, check_seconds: float):
+        self.check_seconds = check_seconds
+        self._settings = None
+        self._checked_at = 0.0
+        self._lock = asyncio.Lock()
+        self.hits = 0
+        self.version_checks = 0
+        self.reloads = 0
+
+    def _fresh(self) -> bool:
+        return self._settings is not None and time.monotonic() - self._checked_at < self.check_seconds
+
+    async def get(self) -> dict:
+        if not self._fresh():
+            async with self._lock:
+                if not self._fresh():
+                    await self._revalidate()
+        else:
+            self.hits += 1
+        return dict(self._settings)
+
+    async def _revalidate(self):
+        if self._settings is not None:
+            current = await db.sms_cost_settings.find_one({}, {"_id": 0, "version": 1})
+            self.version_checks += 1
+            if current is not None and current.get("version", 0) == self._settings.get("version", 0):
+                self._checked_at = time.monotonic()
+                return
+        self.set(await load_sms_cost_settings())
+        self.reloads += 1
+
+    def set(self, settings: dict):
+        settings = dict(settings)
+        if '_id' in settings:
+            settings['_id'] = str(settings['_id'])
+        self._settings = settings
+        self._checked_at = time.monotonic()
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "version_checks": self.version_checks,
+            "reloads": self.reloads,
+            "version": self._settings.get("version", 0) if self._settings else None
+        }
+
+sms_cost_settings_cache = SMSCostSettingsCache(SMS_COST_SETTINGS_CHECK_SECONDS)
+
+async def get_sms_cost_settings():
+    """Get current SMS cost settings"""
+    return await sms_cost_settings_cache.get()
+
+SMS_STATS_BATCH_ENABLED = os.environ.get('SMS_STATS_BATCH_ENABLED', 'false').lower() == 'true'
+SMS_STATS_FLUSH_SECONDS = float(os.environ.get('SMS_STATS_FLUSH_SECONDS', '5'))
+
+SMS_STATS_TOTAL_FIELDS = (
+    "total_sms_sent", "successful_sms", "failed_sms", "total_cost", "billed_segments", "coalesced_sms", "saved_cost"
+)
+
+def new_sms_stats_delta() -> dict:
+    # "daily" mirrors the counters per company for the sms_daily_stats rollup
+    delta = {field: 0 for field in SMS_STATS_TOTAL_FIELDS}
+    delta.update({"companies": {}, "daily": {}})
+    return delta
+
+def add_to_sms_stats_delta(delta: dict, success: bool, company_id: Optional[str], cost_per_sms: float,
+                           coalesced: int = 0, segments: int = 1):
+    # The provider bills every segment of a multi-part message at cost_per_sms
+    delta["total_sms_sent"] += 1
+    if success:
+        delta["successful_sms"] += 1
+        delta["billed_segments"] += segments
+        delta["total_cost"] += segments * cost_per_sms
+        # Notifications merged into this message that would otherwise have been billed separately
+        delta["coalesced_sms"] += coalesced
+        delta["saved_cost"] += coalesced * cost_per_sms
+    else:
+        delta["failed_sms"] += 1
+    
+    if company_id:
+        company = delta["companies"].setdefault(
+            company_id, {"sent": 0, "success": 0, "failed": 0, "coalesced": 0, "segments": 0, "segmented": 0}
+        )
+        company["sent"] += 1
+        company["success" if success else "failed"] += 1
+        if success:
+            company["coalesced"] += coalesced
+            # segmented counts the successes behind segments, the rest of the month bills one each
+            company["segments"] += segments
+            company["segmented"] += 1
+    
+    daily = delta["daily"].setdefault(company_id, {"total": 0, "success": 0, "failed": 0, "segments": 0, "cost": 0.0})
+    daily["total"] += 1
+    if success:
+        daily["success"] += 1
+        daily["segments"] += segments
+        daily["cost"] += segments * cost_per_sms
+    else:
+        daily["failed"] += 1
+
+def sms_daily_stats_key(day, company_id: Optional[str]) -> dict:
+    return {"date": day.isoformat(), "company_id": company_id}
+
+async def apply_sms_daily_stats_delta(day, delta: dict):
+    """Increment the per-day, per-company sms_daily_stats rollup"""
+    now = datetime.now(timezone.utc)
+    operations = [
+        UpdateOne(
+            sms_daily_stats_key(day, company_id),
+            {"$inc": counters,
+             "$set": {"updated_at": now},
+             "$setOnInsert": {"year": day.year, "month": day.month, "day": day.day}},
+            upsert=True
+        )
+        for company_id, counters in delta["daily"].items()
+    ]
+    if not operations:
+        return
+    try:
+        await db.sms_daily_stats.bulk_write(operations, ordered=False)
+    except BulkWriteError as e:
+        # Upserts that lost a race against another writer's first insert of the same
+        # (date, company_id) hit the unique index; the rollup exists now, apply them again
+        errors = e.details.get("writeErrors", [])
+        if not errors or any(error.get("code") != 11000 for error in errors):
+            raise
+        await db.sms_daily_stats.bulk_write([operations[error["index"]] for error in errors], ordered=False)
+
+async def apply_sms_stats_delta(day, delta: dict, cost_per_sms: float, currency: str):
+    """Apply accumulated counters to the monthly record with a single upserted $inc.
+
+    Both stats collections rely on the unique indexes the registry creates at startup,
+    so a concurrent first write of a period fails with a duplicate key and is retried.
+    """
+    now = datetime.now(timezone.utc)
+    year, month = day.year, day.month
+    increments = {field: delta[field] for field in SMS_STATS_TOTAL_FIELDS}
+    for company_id, counters in delta["companies"].items():
+        # Zero increments still create the field, readers expect sent/success/failed
+        for field, value in counters.items():
+            increments[f"companies_breakdown.{company_id}.{field}"] = value
+    
+    update = {
+        "$inc": increments,
+        "$set": {"updated_at": now},
+        "$setOnInsert": {
+            "id": str(uuid.uuid4()),
+            "cost_per_sms": cost_per_sms,
+            "currency": currency,
+            "created_at": now
+        }
+    }
+    try:
+        await db.sms_monthly_stats.update_one({"year": year, "month": month}, update, upsert=True)
+    except DuplicateKeyError:
+        # Lost an upsert race against another writer, the record exists now
+        await db.sms_monthly_stats.update_one({"year": year, "month": month}, update)
+    
+    await apply_sms_daily_stats_delta(day, delta)
+
+class SMSStatsAggregator:
+    """Accumulates SMS counters in memory and flushes them every few seconds.
+
+    Under high volume this turns one write per SMS into one write per month
+    touched per flush interval. Pending counters are flushed on shutdown.
+    """
+
+    def __init__(self, flush_seconds: float):
+        self.flush_seconds = flush_seconds
+        self._pending = {}  # date -> (delta, cost_per_sms, currency)
+        self._task = None
+        self.flushes = 0
+
+    def add(self, day, success: bool, company_id: Optional[str], cost_per_sms: float, currency: str,
+            coalesced: int = 0, segments: int = 1):
+        if day not in self._pending:
+            self._pending[day] = (new_sms_stats_delta(), cost_per_sms, currency)
+        delta = self._pending[day][0]
+        add_to_sms_stats_delta(delta, success, company_id, cost_per_sms, coalesced, segments)
+
+    async def flush(self):
+        pending, self._pending = self._pending, {}
+        for day, (delta, cost_per_sms, currency) in pending.items():
+            try:
+                await apply_sms_stats_delta(day, delta, cost_per_sms, currency)
+            except Exception as e:
+                print(f"⚠️ SMS stats flush failed for {day.isoformat()}: {str(e)}")
+                self._merge_back(day, delta, cost_per_sms, currency)
+        self.flushes += 1
+
+    def _merge_back(self, day, delta: dict, cost_per_sms: float, currency: str):
+        if day not in self._pending:
+            self._pending[day] = (delta, cost_per_sms, currency)
+            return
+        current = self._pending[day][0]
+        for field in SMS_STATS_TOTAL_FIELDS:
+            current[field] += delta[field]
+        for breakdown in ("companies", "daily"):
+            for company_id, counters in delta[breakdown].items():
+                if company_id not in current[breakdown]:
+                    current[breakdown][company_id] = counters
+                    continue
+                for field, value in counters.items():
+                    current[breakdown][company_id][field] += value
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_seconds)
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+    def stats(self) -> dict:
+        return {
+            "enabled": SMS_STATS_BATCH_ENABLED,
+            "flush_seconds": self.flush_seconds,
+            "pending_sms": sum(delta["total_sms_sent"] for delta, _, _ in self._pending.values()),
+            "flushes": self.flushes
+        }
+
+sms_stats_aggregator = SMSStatsAggregator(SMS_STATS_FLUSH_SECONDS)
+
+async def update_monthly_sms_stats(success: bool = True, company_id: str = None, coalesced: int = 0,
+                                   segments: int = 1):
     """Update monthly SMS statistics"""
     now = datetime.now(timezone.utc)
-    year = now.year
-    month = now.month
     
     # Get current cost settings
     cost_settings = await get_sms_cost_settings()
     cost_per_sms = cost_settings["cost_per_sms"]
     
-    # Find or create monthly record
-    monthly_stats = await db.sms_monthly_stats.find_one({"year": year, "month": month})
-    
-    if not monthly_stats:
-        monthly_stats = {
-            "id": str(uuid.uuid4()),
-            "year": year,
-            "month": month,
-            "total_sms_sent": 0,
-            "successful_sms": 0,
-            "failed_sms": 0,
-            "total_cost": 0.0,
-            "cost_per_sms": cost_per_sms,
-            "currency": cost_settings["currency"],
-            "companies_breakdown": {},
-            "created_at": now,
-            "updated_at": now
-        }
+    if SMS_STATS_BATCH_ENABLED:
+        sms_stats_aggregator.add(
+            now.date(), success, company_id, cost_per_sms, cost_settings["currency"], coalesced, segments
+        )
+        return
     
-    # Update counters
-    monthly_stats["total_sms_sent"] += 1
-    if success:
-        monthly_stats["successful_sms"] += 1
-        monthly_stats["total_cost"] += cost_per_sms
-    else:
-        monthly_stats["failed_sms"] += 1
+    delta = new_sms_stats_delta()
+    add_to_sms_stats_delta(delta, success, company_id, cost_per_sms, coalesced, segments)
+    await apply_sms_stats_delta(now.date(), delta, cost_per_sms, cost_settings["currency"])
+
+async def backfill_sms_daily_stats(start_day, end_day, exclude_company_ids=()) -> int:
+    """Rebuild sms_daily_stats from sms_logs for the given inclusive day range.
+
+    Days are grouped server-side one month at a time and written with $set, so
+    running the backfill twice gives the same result. Rollups of companies in
+    exclude_company_ids are left alone. Returns the number of rollup documents
+    written.
+    """
+    from calendar import monthrange
     
-    # Update company breakdown
-    if company_id:
-        if company_id not in monthly_stats["companies_breakdown"]:
-            monthly_stats["companies_breakdown"][company_id] = {"sent": 0, "success": 0, "failed": 0}
+    written = 0
+    year, month = start_day.year, start_day.month
+    while (year, month) <= (end_day.year, end_day.month):
+        range_start = max(start_day, datetime(year, month, 1).date())
+        range_end = min(end_day, datetime(year, month, monthrange(year, month)[1]).date())
         
-        monthly_stats["companies_breakdown"][company_id]["sent"] += 1
-        if success:
-            monthly_stats["companies_breakdown"][company_id]["success"] += 1
-        else:
-            monthly_stats["companies_breakdown"][company_id]["failed"] += 1
+        # Bill each month with the price recorded for it, like the monthly stats do
+        monthly_stats = await db.sms_monthly_stats.find_one(
+            {"year": year, "month": month}, {"_id": 0, "cost_per_sms": 1}
+        )
+        cost_per_sms = monthly_stats["cost_per_sms"] if monthly_stats else (await get_sms_cost_settings())["cost_per_sms"]
+        
+        rows = await db.sms_logs.aggregate([
+            {"$match": {"sent_at": {
+                "$gte": datetime(range_start.year, range_start.month, range_start.day, tzinfo=timezone.utc),
+                "$lt": datetime(range_end.year, range_end.month, range_end.day, tzinfo=timezone.utc) + timedelta(days=1)
+            }}},
+            {"$group": {
+                "_id": {
+                    "date": {"$dateToString": {"format": "%Y-%m-%d", "date": "$sent_at"}},
+                    "company_id": "$company_id"
+                },
+                "total": {"$sum": 1},
+                "success": {"$sum": {"$cond": [{"$eq": ["$status", "sent"]}, 1, 0]}},
+                # Logs written before segment accounting count as one segment
+                "segments": {"$sum": {"$cond": [{"$eq": ["$status", "sent"]}, {"$ifNull": ["$segments", 1]}, 0]}}
+            }}
+        ]).to_list(None)
+        
+        now = datetime.now(timezone.utc)
+        operations = []
+        for row in rows:
+            if row["_id"].get("company_id") in exclude_company_ids:
+                continue
+            day = datetime.strptime(row["_id"]["date"], "%Y-%m-%d").date()
+            operations.append(UpdateOne(
+                sms_daily_stats_key(day, row["_id"].get("company_id")),
+                {"$set": {
+                    "year": day.year,
+                    "month": day.month,
+                    "day": day.day,
+                    "total": row["total"],
+                    "success": row["success"],
+                    "failed": row["total"] - row["success"],
+                    "segments": row["segments"],
+                    "cost": row["segments"] * cost_per_sms,
+                    "updated_at": now,
+                    "backfilled_at": now
+                }},
+                upsert=True
+            ))
+        if operations:
+            await db.sms_daily_stats.bulk_write(operations, ordered=False)
+            written += len(operations)
+        
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
     
-    monthly_stats["updated_at"] = now
+    return written
+
+# SMS log retention
+SMS_LOG_HOT_DAYS = int(os.environ.get('SMS_LOG_HOT_DAYS', '90'))
+SMS_ARCHIVE_CHUNK_SIZE = int(os.environ.get('SMS_ARCHIVE_CHUNK_SIZE', '1000'))
+SMS_ARCHIVE_INTERVAL_SECONDS = float(os.environ.get('SMS_ARCHIVE_INTERVAL_SECONDS', '21600'))
+
+def sms_hot_cutoff() -> datetime:
+    """Logs sent before this instant live in sms_logs_archive instead of sms_logs"""
+    today = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    return today - timedelta(days=SMS_LOG_HOT_DAYS)
+
+job_lock_index_ready = False
+
+async def acquire_job_lock(name: str, ttl_seconds: float) -> bool:
+    """Best-effort cross-worker lock so periodic jobs run on one worker at a time"""
+    global job_lock_index_ready
+    if not job_lock_index_ready:
+        # The unique name turns a concurrent upsert on a held lock into DuplicateKeyError,
+        # so don't rely on the background bootstrap having reached this collection yet
+        job_lock_index_ready = await ensure_collection_indexes("job_locks")
     
-    # Upsert the record
-    await db.sms_monthly_stats.replace_one(
-        {"year": year, "month": month},
-        monthly_stats,
-        upsert=True
-    )
+    now = datetime.now(timezone.utc)
+    try:
+        await db.job_locks.update_one(
+            {"name": name, "$or": [{"expires_at": {"$lte": now}}, {"expires_at": None}]},
+            {"$set": {"expires_at": now + timedelta(seconds=ttl_seconds), "acquired_at": now}},
+            upsert=True
+        )
+        return True
+    except DuplicateKeyError:
+        return False
+
+async def release_job_lock(name: str):
+    await db.job_locks.update_one({"name": name}, {"$set": {"expires_at": None}})
+
+def encode_sms_log_chunk(logs: list) -> bytes:
+    lines = (json.dumps(log, default=lambda value: value.isoformat(), ensure_ascii=False) for log in logs)
+    return gzip.compress("\n".join(lines).encode("utf-8"))
+
+def decode_sms_log_chunk(payload: bytes) -> list:
+    return [json.loads(line) for line in gzip.decompress(payload).decode("utf-8").splitlines() if line]
+
+async def archive_sms_logs_for_day(day, company_id: Optional[str]) -> int:
+    """Move one company's logs for one day into compressed archive chunks"""
+    day_start = datetime(day.year, day.month, day.day, tzinfo=timezone.utc)
+    query = {"company_id": company_id, "sent_at": {"$gte": day_start, "$lt": day_start + timedelta(days=1)}}
+    moved = 0
+    while True:
+        logs = await db.sms_logs.find(query, {"_id": 0}).sort([("sent_at", 1), ("id", 1)]).to_list(SMS_ARCHIVE_CHUNK_SIZE)
+        if not logs:
+            return moved
+        
+        log_ids = [log["id"] for log in logs]
+        # Deterministic chunk id: rerunning after a crash rewrites the same chunk instead of duplicating it
+        chunk_id = hashlib.sha1("".join(log_ids).encode("utf-8")).hexdigest()
+        await db.sms_logs_archive.replace_one(
+            {"id": chunk_id},
+            {
+                "id": chunk_id,
+                "company_id": company_id,
+                "date": day.isoformat(),
+                "first_sent_at": logs[0]["sent_at"],
+                "last_sent_at": logs[-1]["sent_at"],
+                "count": len(logs),
+                "format": "ndjson+gzip",
+                "payload": Binary(encode_sms_log_chunk(logs)),
+                "archived_at": datetime.now(timezone.utc)
+            },
+            upsert=True
+        )
+        await db.sms_logs.delete_many({"id": {"$in": log_ids}})
+        moved += len(logs)
 
-# Security helper functions
-def hash_pin(pin: str) -> str:
-    """Hash PIN for secure storage"""
-    return pwd_context.hash(pin)
+async def archive_sms_logs() -> dict:
+    """Archive every sms_logs day older than SMS_LOG_HOT_DAYS.
 
-def verify_pin(plain_pin: str, hashed_pin: str) -> bool:
-    """Verify PIN against hash"""
-    return pwd_context.verify(plain_pin, hashed_pin)
+    A day is only moved once the sms_daily_stats rollup of every company in it
+    is finalized, since they are the report source once the raw logs leave the
+    hot collection. Rollups are rebuilt from the logs before being finalized:
+    a day that predates the incremental rollup, or the deploy day that only
+    has it from the deploy on, would otherwise be frozen incomplete.
+    """
+    cutoff = sms_hot_cutoff()
+    groups = await db.sms_logs.aggregate([
+        {"$match": {"sent_at": {"$lt": cutoff}}},
+        {"$group": {"_id": {
+            "date": {"$dateToString": {"format": "%Y-%m-%d", "date": "$sent_at"}},
+            "company_id": "$company_id"
+        }}},
+        {"$sort": {"_id.date": 1}}
+    ]).to_list(None)
+    
+    companies_by_day = {}
+    for group in groups:
+        companies_by_day.setdefault(group["_id"]["date"], []).append(group["_id"].get("company_id"))
+    
+    moved = 0
+    for date, company_ids in companies_by_day.items():
+        day = datetime.strptime(date, "%Y-%m-%d").date()
+        finalized = {
+            rollup.get("company_id") async for rollup in db.sms_daily_stats.find(
+                {"date": date, "finalized": True}, {"_id": 0, "company_id": 1}
+            )
+        }
+        if any(company_id not in finalized for company_id in company_ids):
+            # Rebuild the whole day while its logs are still hot; rollups that were
+            # already finalized have lost logs to the archive and must not be rebuilt
+            await backfill_sms_daily_stats(day, day, exclude_company_ids=finalized)
+            await db.sms_daily_stats.update_many(
+                {"date": date, "company_id": {"$in": company_ids}}, {"$set": {"finalized": True}}
+            )
+        for company_id in company_ids:
+            moved += await archive_sms_logs_for_day(day, company_id)
+    
+    return {"days_archived": len(companies_by_day), "logs_archived": moved, "cutoff": cutoff.isoformat()}
+
+async def count_archived_sms_logs(company_id: str, start_date: datetime, end_date: datetime) -> int:
+    rows = await db.sms_logs_archive.aggregate([
+        {"$match": {
+            "company_id": company_id,
+            "date": {"$gte": start_date.date().isoformat(), "$lte": end_date.date().isoformat()}
+        }},
+        {"$group": {"_id": None, "count": {"$sum": "$count"}}}
+    ]).to_list(1)
+    return rows[0]["count"] if rows else 0
+
+async def load_archived_sms_logs(company_id: str, start_date: datetime, end_date: datetime, limit: int) -> list:
+    """Most recent archived logs in the range, newest first, with sent_at as ISO strings"""
+    logs = []
+    cursor = db.sms_logs_archive.find(
+        {"company_id": company_id, "date": {"$gte": start_date.date().isoformat(), "$lte": end_date.date().isoformat()}},
+        {"_id": 0, "payload": 1}
+    ).sort([("date", -1), ("last_sent_at", -1)])
+    async for chunk in cursor:
+        logs.extend(reversed(decode_sms_log_chunk(chunk["payload"])))
+        if len(logs) >= limit:
+            break
+    return logs[:limit]
+
+class SMSLogArchiver:
+    """Runs archive_sms_logs periodically on whichever worker holds the job lock"""
+
+    def __init__(self, interval_seconds: float):
+        self.interval_seconds = interval_seconds
+        self._task = None
+        self.last_run = None
+        self.last_result = None
+
+    async def run_once(self) -> Optional[dict]:
+        if not await acquire_job_lock("sms_log_archiver", self.interval_seconds):
+            return None
+        try:
+            self.last_result = await archive_sms_logs()
+            self.last_run = datetime.now(timezone.utc)
+            return self.last_result
+        finally:
+            await release_job_lock("sms_log_archiver")
+
+    async def _run(self):
+        while True:
+            try:
+                result = await self.run_once()
+                if result and result["logs_archived"]:
+                    print(f"📦 Archived {result['logs_archived']} SMS logs from {result['days_archived']} days")
+            except Exception as e:
+                print(f"⚠️ SMS log archiving failed: {str(e)}")
+            await asyncio.sleep(self.interval_seconds)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self) -> dict:
+        return {
+            "hot_days": SMS_LOG_HOT_DAYS,
+            "last_run": self.last_run.isoformat() if self.last_run else None,
+            "last_result": self.last_result
+        }
+
+sms_log_archiver = SMSLogArchiver(SMS_ARCHIVE_INTERVAL_SECONDS)
+
+# Password/PIN hashing executor
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', str(min(4, os.cpu_count() or 1))))
+PASSWORD_HASH_MAX_PENDING = int(os.environ.get('PASSWORD_HASH_MAX_PENDING', '64'))
+
+class PasswordHashExecutor:
+    """Bounded process pool for bcrypt work.
+
+    bcrypt costs 100-300 ms of CPU per call, so it runs in separate processes
+    instead of the event loop. Once more than max_pending calls are queued or
+    running, new ones are rejected with 503 so a login storm degrades into
+    retries instead of stalling every other endpoint.
+    """
+
+    def __init__(self, workers: int, max_pending: int):
+        self.workers = max(1, workers)
+        self.max_pending = max_pending
+        self._pool = None
+        self.pending = 0
+        self.peak_pending = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.total_seconds = 0.0
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            # spawn avoids forking a process that already runs Mongo monitor threads
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._pool
+
+    def start(self):
+        self._get_pool()
+
+    async def run(self, func, *args):
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=503,
+                detail="Server busy, please retry shortly",
+                headers={"Retry-After": "1"}
+            )
+        
+        self.pending += 1
+        self.peak_pending = max(self.peak_pending, self.pending)
+        started = time.monotonic()
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(self._get_pool(), func, *args)
+        except BaseException:
+            self.failed += 1
+            raise
+        else:
+            self.completed += 1
+            self.total_seconds += time.monotonic() - started
+            return result
+        finally:
+            self.pending -= 1
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "max_pending": self.max_pending,
+            "in_flight": min(self.pending, self.workers),
+            "queued": max(self.pending - self.workers, 0),
+            "peak_pending": self.peak_pending,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "avg_latency_ms": round(self.total_seconds / self.completed * 1000, 1) if self.completed else 0.0
+        }
+
+password_executor = PasswordHashExecutor(PASSWORD_HASH_WORKERS, PASSWORD_HASH_MAX_PENDING)
+
+async def hash_password_async(password: str) -> str:
+    return await password_executor.run(hash_password, password)
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+    return await password_executor.run(verify_password, plain_password, hashed_password)
+
+async def hash_pin_async(pin: str) -> str:
+    return await password_executor.run(hash_pin, pin)
+
+async def verify_pin_async(plain_pin: str, hashed_pin: str) -> bool:
+    return await password_executor.run(verify_pin, plain_pin, hashed_pin)
 
 def generate_sms_code() -> str:
     """Generate 6-digit SMS verification code"""
     import random
     return ''.join([str(random.randint(0, 9)) for _ in range(6)])
 
-# SMS codes storage (in production, use Redis or database with TTL)
-sms_codes = {}
+# Short-lived verification state (SMS codes, WebAuthn challenges)
+TTL_STORE_BACKEND = os.environ.get('TTL_STORE_BACKEND', 'memory')  # "memory" or "mongo"
+TTL_STORE_MAX_ENTRIES = int(os.environ.get('TTL_STORE_MAX_ENTRIES', '100000'))
+TTL_STORE_SWEEP_SECONDS = float(os.environ.get('TTL_STORE_SWEEP_SECONDS', '60'))
+SMS_CODE_TTL_SECONDS = 300
+CHALLENGE_TTL_SECONDS = 300
+
+class TTLStore(ABC):
+    """Key/value store whose entries disappear after a per-entry TTL"""
+
+    @abstractmethod
+    async def set(self, key: str, value: dict, ttl_seconds: float):
+        ...
+
+    @abstractmethod
+    async def get(self, key: str) -> Optional[dict]:
+        ...
+
+    @abstractmethod
+    async def delete(self, key: str):
+        ...
+
+    def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    def stats(self) -> dict:
+        return {}
+
+class InMemoryTTLStore(TTLStore):
+    """Process-local store with a background expiry sweeper and a size cap.
+
+    Only suitable for a single API worker: entries are invisible to other processes.
+    """
+
+    def __init__(self, max_entries: int, sweep_seconds: float):
+        self.max_entries = max_entries
+        self.sweep_seconds = sweep_seconds
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._task = None
+        self.expired = 0
+        self.evicted = 0
+
+    async def set(self, key: str, value: dict, ttl_seconds: float):
+        self._entries[key] = (time.monotonic() + ttl_seconds, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evicted += 1
+
+    async def get(self, key: str) -> Optional[dict]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            del self._entries[key]
+            self.expired += 1
+            return None
+        return entry[1]
+
+    async def delete(self, key: str):
+        self._entries.pop(key, None)
+
+    def sweep(self):
+        now = time.monotonic()
+        for key in [key for key, entry in self._entries.items() if entry[0] <= now]:
+            del self._entries[key]
+            self.expired += 1
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.sweep_seconds)
+            self.sweep()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self) -> dict:
+        return {
+            "backend": "memory",
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "expired": self.expired,
+            "evicted": self.evicted
+        }
+
+class MongoTTLStore(TTLStore):
+    """Store shared by every worker, expired documents are removed by a TTL index.
+
+    The TTL monitor only runs about once a minute, so reads also filter on expires_at.
+    """
+
+    def __init__(self, collection_name: str):
+        self.collection_name = collection_name
+        self._index_task = None
+
+    def start(self):
+        if self._index_task is None:
+            self._index_task = asyncio.create_task(ensure_collection_indexes(self.collection_name))
+
+    async def set(self, key: str, value: dict, ttl_seconds: float):
+        await db[self.collection_name].update_one(
+            {"key": key},
+            {"$set": {"value": value, "expires_at": datetime.now(timezone.utc) + timedelta(seconds=ttl_seconds)}},
+            upsert=True
+        )
+
+    async def get(self, key: str) -> Optional[dict]:
+        entry = await db[self.collection_name].find_one(
+            {"key": key, "expires_at": {"$gt": datetime.now(timezone.utc)}},
+            {"_id": 0, "value": 1}
+        )
+        return entry["value"] if entry else None
+
+    async def delete(self, key: str):
+        await db[self.collection_name].delete_one({"key": key})
+
+    def stats(self) -> dict:
+        return {"backend": "mongo", "collection": self.collection_name}
+
+def create_ttl_store() -> TTLStore:
+    if TTL_STORE_BACKEND == "mongo":
+        return MongoTTLStore("ephemeral_store")
+    return InMemoryTTLStore(TTL_STORE_MAX_ENTRIES, TTL_STORE_SWEEP_SECONDS)
+
+ttl_store = create_ttl_store()
 
 async def get_user_security(user_id: str):
     """Get or create user security settings"""
@@ -363,69 +1484,718 @@ async def get_user_security(user_id: str):
         return new_security
     return UserSecurity(**security)
 
-async def send_sms_notification(phone_number: str, message: str, company_id: str = None):
-    """Send SMS notification using Twilio and track costs"""
-    success = False
-    try:
-        # Initialize Twilio client
-        from twilio.rest import Client
-        
-        account_sid = os.environ.get('TWILIO_ACCOUNT_SID')
-        auth_token = os.environ.get('TWILIO_AUTH_TOKEN')
-        
-        if not account_sid or not auth_token:
-            print(f"⚠️ Twilio credentials not found, using mock SMS")
-            print(f"MOCK SMS to {phone_number}: {message}")
-            success = True  # Mock SMS considered successful
+# SMS encoding
+SMS_DEFAULT_ENCODING_POLICY = os.environ.get('SMS_DEFAULT_ENCODING_POLICY', 'unicode')  # "unicode" or "gsm7"
+
+GSM7_BASIC_CHARS = set(
+    "@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞÆæßÉ !\"#¤%&'()*+,-./0123456789:;<=>?"
+    "¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà"
+)
+GSM7_EXTENSION_CHARS = set("^{}\\[~]|€\f")  # sent as escape + char, two septets each
+GSM7_TRANSLITERATIONS = {
+    "‘": "'", "’": "'", "‚": "'", "“": '"', "”": '"', "„": '"', "«": '"', "»": '"',
+    "–": "-", "—": "-", "…": "...", "\u00a0": " ", "•": "-", "ç": "Ç"
+}
+
+class EncodedSMS:
+    def __init__(self, text: str, encoding: str, segments: int, transliterated: bool):
+        self.text = text
+        self.encoding = encoding
+        self.segments = segments
+        self.transliterated = transliterated
+
+def is_gsm7(text: str) -> bool:
+    return all(char in GSM7_BASIC_CHARS or char in GSM7_EXTENSION_CHARS for char in text)
+
+def count_sms_segments(text: str) -> tuple:
+    """Return (encoding, segments) the way carriers bill a message"""
+    if is_gsm7(text):
+        septets = sum(2 if char in GSM7_EXTENSION_CHARS else 1 for char in text)
+        return "gsm7", 1 if septets <= 160 else math.ceil(septets / 153)
+    # UCS-2 counts UTF-16 code units, so emoji take two
+    units = len(text.encode("utf-16-le")) // 2
+    return "ucs2", 1 if units <= 70 else math.ceil(units / 67)
+
+def transliterate_to_gsm7(text: str) -> str:
+    """Replace or drop every character outside the GSM-7 alphabet"""
+    result = []
+    for char in text:
+        if char in GSM7_BASIC_CHARS or char in GSM7_EXTENSION_CHARS:
+            result.append(char)
+        elif char in GSM7_TRANSLITERATIONS:
+            result.append(GSM7_TRANSLITERATIONS[char])
         else:
-            client = Client(account_sid, auth_token)
+            # Accented letters fall back to their base letter, emoji and symbols are dropped
+            base = "".join(c for c in unicodedata.normalize("NFKD", char) if not unicodedata.combining(c))
+            if base and is_gsm7(base):
+                result.append(base)
+    text = "".join(result)
+    while "  " in text:
+        text = text.replace("  ", " ")
+    return text.replace(" .", ".").replace(" ,", ",").strip()
+
+def encode_sms(text: str, policy: str) -> EncodedSMS:
+    """Apply the company encoding policy and compute the billed segments"""
+    transliterated = False
+    if policy == "gsm7" and not is_gsm7(text):
+        text = transliterate_to_gsm7(text)
+        transliterated = True
+    encoding, segments = count_sms_segments(text)
+    return EncodedSMS(text, encoding, segments, transliterated)
+
+# SMS outbox
+TWILIO_API_BASE = os.environ.get('TWILIO_API_BASE', 'https://api.twilio.com')
+TWILIO_FROM_NUMBER = os.environ.get('TWILIO_FROM_NUMBER', '+15005550006')  # Twilio test number
+SMS_OUTBOX_WORKERS = int(os.environ.get('SMS_OUTBOX_WORKERS', '4'))
+SMS_OUTBOX_MAX_ATTEMPTS = int(os.environ.get('SMS_OUTBOX_MAX_ATTEMPTS', '5'))
+SMS_OUTBOX_RETRY_BASE_SECONDS = float(os.environ.get('SMS_OUTBOX_RETRY_BASE_SECONDS', '2'))
+SMS_OUTBOX_RETRY_MAX_SECONDS = float(os.environ.get('SMS_OUTBOX_RETRY_MAX_SECONDS', '300'))
+SMS_OUTBOX_LEASE_SECONDS = float(os.environ.get('SMS_OUTBOX_LEASE_SECONDS', '60'))
+SMS_OUTBOX_POLL_SECONDS = float(os.environ.get('SMS_OUTBOX_POLL_SECONDS', '2'))
+SMS_OUTBOX_DRAIN_SECONDS = float(os.environ.get('SMS_OUTBOX_DRAIN_SECONDS', '10'))
+# Finished items are kept this long after their log is written, for troubleshooting
+SMS_OUTBOX_RETENTION_HOURS = float(os.environ.get('SMS_OUTBOX_RETENTION_HOURS', '72'))
+SMS_PROVIDER_TIMEOUT_SECONDS = float(os.environ.get('SMS_PROVIDER_TIMEOUT_SECONDS', '10'))
+# Token buckets are per API worker process, divide the provider limit by the worker count
+SMS_RATE_GLOBAL_PER_SECOND = float(os.environ.get('SMS_RATE_GLOBAL_PER_SECOND', '10'))
+SMS_RATE_GLOBAL_BURST = float(os.environ.get('SMS_RATE_GLOBAL_BURST', '20'))
+SMS_RATE_COMPANY_PER_SECOND = float(os.environ.get('SMS_RATE_COMPANY_PER_SECOND', '2'))
+SMS_RATE_COMPANY_BURST = float(os.environ.get('SMS_RATE_COMPANY_BURST', '5'))
+
+class SMSPriority:
+    OTP = 0
+    DELIVERY = 10
+
+class SMSProviderError(Exception):
+    def __init__(self, message: str, retryable: bool = True, retry_after: Optional[float] = None,
+                 throttled: bool = False):
+        super().__init__(message)
+        self.retryable = retryable
+        self.retry_after = retry_after
+        self.throttled = throttled
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0
+
+    def wait_time(self) -> float:
+        """Seconds until one token is available, 0 if one is available now"""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        wait = max(self.blocked_until - now, 0.0)
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate if self.rate > 0 else SMS_OUTBOX_RETRY_MAX_SECONDS)
+        return wait
+
+    def consume(self):
+        self.tokens -= 1
+
+class SMSRateLimiter:
+    """Global and per-company token buckets in front of the SMS provider.
+
+    Workers do not claim items while the global bucket is empty, nor items of
+    companies whose bucket is empty. An item claimed anyway (several workers
+    racing for the last token) is deferred to the next free slot after the
+    ones already handed out, instead of coming back as soon as one token has
+    refilled. A 429 from the provider also pauses the global bucket for its
+    Retry-After, so the other workers stop hammering the provider while it is
+    throttling us.
+    """
+
+    def __init__(self, global_rate: float, global_burst: float, company_rate: float, company_burst: float):
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.company_rate = company_rate
+        self.company_burst = company_burst
+        self._company_buckets = {}
+        self._deferred_until = {}  # company_id -> monotonic time of the last slot handed out
+        self.throttled = {}  # company_id -> deferred by the local buckets
+        self.provider_throttled = {}  # company_id -> 429 responses
+
+    def _company_bucket(self, company_id: Optional[str]) -> TokenBucket:
+        if company_id not in self._company_buckets:
+            self._company_buckets[company_id] = TokenBucket(self.company_rate, self.company_burst)
+        return self._company_buckets[company_id]
+
+    def global_wait(self) -> float:
+        return self.global_bucket.wait_time()
+
+    def saturated_companies(self) -> list:
+        """Companies without a token right now, their items are left unclaimed"""
+        return [company_id for company_id, bucket in self._company_buckets.items() if bucket.wait_time() > 0]
+
+    def acquire(self, company_id: Optional[str]) -> float:
+        """Take a token from both buckets, or return how long to defer the item without taking any"""
+        company_bucket = self._company_bucket(company_id)
+        wait = max(self.global_bucket.wait_time(), company_bucket.wait_time())
+        if wait > 0:
+            key = company_id or "_none"
+            self.throttled[key] = self.throttled.get(key, 0) + 1
+            # Queue behind the items deferred before, one refill interval apart
+            now = time.monotonic()
+            interval = 1 / company_bucket.rate if company_bucket.rate > 0 else SMS_OUTBOX_RETRY_MAX_SECONDS
+            slot = max(now + wait, self._deferred_until.get(company_id, 0.0) + interval)
+            self._deferred_until[company_id] = slot
+            return slot - now
+        self.global_bucket.consume()
+        company_bucket.consume()
+        return 0.0
+
+    def provider_backoff(self, company_id: Optional[str], retry_after: float):
+        key = company_id or "_none"
+        self.provider_throttled[key] = self.provider_throttled.get(key, 0) + 1
+        self.global_bucket.blocked_until = max(self.global_bucket.blocked_until, time.monotonic() + retry_after)
+
+    def stats(self) -> dict:
+        return {
+            "global_rate_per_second": self.global_bucket.rate,
+            "company_rate_per_second": self.company_rate,
+            "throttled": dict(self.throttled),
+            "provider_throttled": dict(self.provider_throttled)
+        }
+
+sms_rate_limiter = SMSRateLimiter(
+    SMS_RATE_GLOBAL_PER_SECOND, SMS_RATE_GLOBAL_BURST,
+    SMS_RATE_COMPANY_PER_SECOND, SMS_RATE_COMPANY_BURST
+)
+
+async def deliver_sms(session, phone_number: str, message: str) -> dict:
+    """Send one SMS through the Twilio REST API, or print it when no credentials are set"""
+    account_sid = os.environ.get('TWILIO_ACCOUNT_SID')
+    auth_token = os.environ.get('TWILIO_AUTH_TOKEN')
+    
+    if not account_sid or not auth_token:
+        print(f"MOCK SMS to {phone_number}: {message}")
+        return {"method": "mock", "sid": None}
+    
+    import aiohttp
+    
+    try:
+        async with session.post(
+            f"{TWILIO_API_BASE}/2010-04-01/Accounts/{account_sid}/Messages.json",
+            data={"To": phone_number, "From": TWILIO_FROM_NUMBER, "Body": message},
+            auth=aiohttp.BasicAuth(account_sid, auth_token)
+        ) as response:
+            try:
+                body = await response.json(content_type=None)
+            except ValueError:
+                body = {}
+            if response.status in (200, 201):
+                return {"method": "twilio", "sid": body.get("sid")}
             
-            # Send SMS via Twilio
-            message_obj = client.messages.create(
-                body=message,
-                from_='+15005550006',  # Twilio test number - you can replace with your Twilio number
-                to=phone_number
+            error = f"Twilio error {response.status}: {body.get('message', '') if isinstance(body, dict) else body}"
+            retry_after = response.headers.get("Retry-After")
+            raise SMSProviderError(
+                error,
+                retryable=response.status == 429 or response.status >= 500,
+                retry_after=float(retry_after) if retry_after and retry_after.isdigit() else None,
+                throttled=response.status == 429
             )
-            
-            print(f"✅ SMS sent via Twilio to {phone_number}, SID: {message_obj.sid}")
-            success = True
-        
-        # Store SMS log
-        sms_log = {
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        raise SMSProviderError(f"Twilio unreachable: {str(e) or type(e).__name__}")
+
+SMS_LOG_BATCH_SIZE = int(os.environ.get('SMS_LOG_BATCH_SIZE', '200'))
+SMS_LOG_FLUSH_SECONDS = float(os.environ.get('SMS_LOG_FLUSH_SECONDS', '2'))
+SMS_LOG_MAX_BUFFER = int(os.environ.get('SMS_LOG_MAX_BUFFER', '50000'))
+
+class BufferedBulkWriter:
+    """Batches inserts into one collection as unordered insert_many calls.
+
+    Documents are flushed when batch_size are buffered or every flush_seconds,
+    whichever comes first, and once more on shutdown. A failed flush puts the
+    batch back in front of the buffer so it is retried on the next flush.
+    on_written, if given, is awaited with every batch once it is stored.
+    """
+
+    def __init__(self, collection_name: str, batch_size: int, flush_seconds: float, max_buffer: int,
+                 on_written=None):
+        self.collection_name = collection_name
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.max_buffer = max_buffer
+        self.on_written = on_written
+        self._buffer = deque()
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+        self.written = 0
+        self.flushes = 0
+        self.failures = 0
+        self.dropped = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+
+    def add(self, document: dict):
+        self._buffer.append(document)
+        if len(self._buffer) > self.max_buffer:
+            # The database has been unreachable for a long time, shed the oldest records
+            self._buffer.popleft()
+            self.dropped += 1
+        if len(self._buffer) >= self.batch_size:
+            self._wakeup.set()
+
+    async def flush(self):
+        async with self._flush_lock:
+            while self._buffer:
+                batch = [self._buffer.popleft() for _ in range(min(self.batch_size, len(self._buffer)))]
+                started = time.monotonic()
+                try:
+                    await db[self.collection_name].insert_many(batch, ordered=False)
+                except BulkWriteError as e:
+                    # Only duplicates (batch partly written by an earlier attempt) are safe to skip
+                    if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+                        self._requeue(batch, e)
+                        return
+                except Exception as e:
+                    self._requeue(batch, e)
+                    return
+                self.last_flush_ms = round((time.monotonic() - started) * 1000, 1)
+                self.max_flush_ms = max(self.max_flush_ms, self.last_flush_ms)
+                self.written += len(batch)
+                self.flushes += 1
+                if self.on_written:
+                    try:
+                        await self.on_written(batch)
+                    except Exception as e:
+                        print(f"⚠️ Post-write hook for {self.collection_name} failed: {str(e)}")
+
+    def _requeue(self, batch: list, error: Exception):
+        self.failures += 1
+        self._buffer.extendleft(reversed(batch))
+        print(f"⚠️ Flush of {len(batch)} {self.collection_name} records failed, will retry: {str(error)}")
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+    def stats(self) -> dict:
+        return {
+            "buffer_depth": len(self._buffer),
+            "written": self.written,
+            "flushes": self.flushes,
+            "failures": self.failures,
+            "dropped": self.dropped,
+            "last_flush_ms": self.last_flush_ms,
+            "max_flush_ms": self.max_flush_ms
+        }
+
+async def mark_sms_logs_written(logs: list):
+    # The outbox copy is only needed until the log itself is stored, after that the
+    # finished item only serves troubleshooting and expires through the purge_at TTL
+    await db.sms_outbox.update_many(
+        {"id": {"$in": [log["outbox_id"] for log in logs]}},
+        {"$unset": {"sms_log": ""},
+         "$set": {"purge_at": datetime.now(timezone.utc) + timedelta(hours=SMS_OUTBOX_RETENTION_HOURS)}}
+    )
+
+sms_log_writer = BufferedBulkWriter("sms_logs", SMS_LOG_BATCH_SIZE, SMS_LOG_FLUSH_SECONDS, SMS_LOG_MAX_BUFFER,
+                                    on_written=mark_sms_logs_written)
+
+async def recover_pending_sms_logs() -> int:
+    """Re-buffer logs stored on finished outbox items but not yet in sms_logs.
+
+    They are left behind by a crash or a failed flush at shutdown; the log keeps
+    its id, so one already written by another worker is skipped as a duplicate.
+    """
+    recovered = 0
+    async for item in db.sms_outbox.find({"sms_log.sent_at": {"$exists": True}}, {"_id": 0, "sms_log": 1}):
+        sms_log_writer.add(item["sms_log"])
+        recovered += 1
+    if recovered:
+        print(f"♻️ Recovered {recovered} SMS logs that were not written before the last shutdown")
+    return recovered
+
+def build_sms_log(item: dict, success: bool, method: str, sid: Optional[str] = None, error: Optional[str] = None) -> dict:
+    sms_log = {
+        "id": str(uuid.uuid4()),
+        "phone_number": item["phone_number"],
+        "message": item["message"],
+        "sent_at": datetime.now(timezone.utc),
+        "status": "sent" if success else "failed",
+        "method": method,
+        "company_id": item.get("company_id"),
+        "kind": item.get("kind"),
+        "outbox_id": item["id"],
+        "attempts": item.get("attempts", 1),
+        "encoding": item.get("encoding"),
+        "segments": item.get("segments", 1)
+    }
+    if sid:
+        sms_log["sid"] = sid
+    if error:
+        sms_log["error"] = error
+    coalesced = max(len(item.get("deliveries") or []) - 1, 0)
+    if coalesced:
+        sms_log["coalesced_notifications"] = coalesced + 1
+    return sms_log
+
+async def record_sms_result(item: dict, sms_log: dict):
+    """Buffer the SMS log and update monthly statistics for a finished outbox item.
+
+    The caller stores sms_log on the outbox item in the same update that finishes
+    it, so the log survives until the buffered write has reached sms_logs.
+    """
+    sms_log_writer.add(sms_log)
+    coalesced = max(len(item.get("deliveries") or []) - 1, 0)
+    success = sms_log["status"] == "sent"
+    
+    await update_monthly_sms_stats(
+        success=success, company_id=item.get("company_id"), coalesced=coalesced, segments=item.get("segments", 1)
+    )
+
+class SMSOutbox:
+    """Durable SMS queue in db.sms_outbox drained by a pool of async workers.
+
+    Request handlers only insert into the outbox; workers claim due items with a
+    lease (lowest priority value first, so OTP codes overtake delivery notices),
+    call the provider and retry with exponential backoff. Items whose lease
+    expires, e.g. because a worker process died, are claimed again.
+    """
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self._tasks = []
+        self._wakeup = asyncio.Event()
+        self._session = None
+        self._draining = False
+        self._drain_deadline = None
+        self.in_flight = 0
+        self.enqueued = 0
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.throttled = 0
+        self.coalesced = 0
+
+    async def enqueue(self, phone_number: str, message: str, company_id: str = None,
+                      kind: str = "delivery", priority: int = SMSPriority.DELIVERY,
+                      extra: Optional[dict] = None, delay_seconds: float = 0) -> dict:
+        now = datetime.now(timezone.utc)
+        item = {
             "id": str(uuid.uuid4()),
             "phone_number": phone_number,
             "message": message,
-            "sent_at": datetime.now(timezone.utc),
-            "status": "sent",
-            "method": "twilio" if account_sid and auth_token else "mock",
-            "company_id": company_id
+            "company_id": company_id,
+            "kind": kind,
+            "priority": priority,
+            "status": "pending",
+            "attempts": 0,
+            "next_attempt_at": now + timedelta(seconds=delay_seconds),
+            "lease_expires_at": None,
+            "created_at": now,
+            "updated_at": now,
+            **(extra or {})
         }
-        await db.sms_logs.insert_one(sms_log)
+        await db.sms_outbox.insert_one(item)
+        self.enqueued += 1
+        if not delay_seconds:
+            self._wakeup.set()
+        return item
+
+    async def _claim(self):
+        now = datetime.now(timezone.utc)
+        query = {"$or": [
+            {"status": "pending", "next_attempt_at": {"$lte": now}},
+            {"status": "sending", "lease_expires_at": {"$lte": now}}
+        ]}
+        saturated = sms_rate_limiter.saturated_companies()
+        if saturated:
+            query["company_id"] = {"$nin": saturated}
+        return await db.sms_outbox.find_one_and_update(
+            query,
+            {"$set": {
+                "status": "sending",
+                "lease_expires_at": now + timedelta(seconds=SMS_OUTBOX_LEASE_SECONDS),
+                "updated_at": now
+            },
+             "$inc": {"attempts": 1}},
+            sort=[("priority", 1), ("next_attempt_at", 1)],
+            projection={"_id": 0},
+            return_document=ReturnDocument.AFTER
+        )
+
+    def _retry_delay(self, attempts: int, error: SMSProviderError) -> float:
+        # Exponential backoff with equal jitter so retries from a burst spread out
+        delay = min(SMS_OUTBOX_RETRY_BASE_SECONDS * (2 ** (attempts - 1)), SMS_OUTBOX_RETRY_MAX_SECONDS)
+        delay = delay / 2 + random.uniform(0, delay / 2)
+        if error.retry_after:
+            delay = max(delay, error.retry_after)
+        return delay
+
+    async def _reschedule(self, item: dict, delay: float, error: Optional[str] = None, refund_attempt: bool = False):
+        update = {"$set": {
+            "status": "pending",
+            "next_attempt_at": datetime.now(timezone.utc) + timedelta(seconds=delay),
+            "lease_expires_at": None,
+            "updated_at": datetime.now(timezone.utc)
+        }}
+        if error:
+            update["$set"]["last_error"] = error
+        if refund_attempt:
+            update["$inc"] = {"attempts": -1}
+        await db.sms_outbox.update_one({"id": item["id"]}, update)
+
+    async def _fail(self, item: dict, error: str):
+        sms_log = build_sms_log(item, False, "twilio", error=error)
+        now = datetime.now(timezone.utc)
+        await db.sms_outbox.update_one(
+            {"id": item["id"]},
+            {"$set": {"status": "failed", "last_error": error, "finished_at": now, "sms_log": sms_log, "updated_at": now}}
+        )
+        self.failed += 1
+        await record_sms_result(item, sms_log)
+
+    async def _process(self, item: dict):
+        if item["attempts"] > SMS_OUTBOX_MAX_ATTEMPTS:
+            # Only reachable through expired leases: the item keeps crashing or stalling its worker
+            print(f"❌ SMS outbox item {item['id']} abandoned after {item['attempts'] - 1} claims")
+            await self._fail(item, f"Gave up after {item['attempts'] - 1} claims without a result")
+            return
         
-        # Update monthly statistics
-        await update_monthly_sms_stats(success=True, company_id=company_id)
+        wait = sms_rate_limiter.acquire(item.get("company_id"))
+        if wait > 0:
+            # Not an attempt: put it back until the buckets have room
+            self.throttled += 1
+            await self._reschedule(item, wait, refund_attempt=True)
+            return
         
-        return True
+        if item.get("deliveries"):
+            # Coalesced notifications are rendered once the window has closed
+            item["message"] = build_delivery_message(item["deliveries"])
         
-    except Exception as e:
-        print(f"❌ SMS sending failed: {str(e)}")
-        # Store failed SMS log
-        sms_log = {
-            "id": str(uuid.uuid4()),
-            "phone_number": phone_number,
-            "message": message,
-            "sent_at": datetime.now(timezone.utc),
-            "status": "failed",
-            "error": str(e),
-            "method": "twilio",
-            "company_id": company_id
-        }
-        await db.sms_logs.insert_one(sms_log)
+        policy = (await get_company_sms_settings(item.get("company_id")))["encoding_policy"]
+        encoded = encode_sms(item["message"], policy)
+        item.update({"message": encoded.text, "encoding": encoded.encoding, "segments": encoded.segments})
         
-        # Update monthly statistics for failed SMS
-        await update_monthly_sms_stats(success=False, company_id=company_id)
+        try:
+            result = await deliver_sms(self._session, item["phone_number"], item["message"])
+        except SMSProviderError as e:
+            if e.throttled:
+                # Pause every worker, the item itself retries with the usual capped backoff
+                # and attempt count so a provider that keeps refusing cannot pin it forever
+                sms_rate_limiter.provider_backoff(item.get("company_id"), e.retry_after or self._retry_delay(1, e))
+                self.throttled += 1
+            
+            if e.retryable and item["attempts"] < SMS_OUTBOX_MAX_ATTEMPTS:
+                delay = self._retry_delay(item["attempts"], e)
+                await self._reschedule(item, delay, error=str(e))
+                self.retried += 1
+                print(f"⚠️ SMS to {item['phone_number']} failed (attempt {item['attempts']}), retrying in {delay:.0f}s: {str(e)}")
+                return
+            
+            print(f"❌ SMS sending failed: {str(e)}")
+            await self._fail(item, str(e))
+            return
         
-        return False
+        if result["sid"]:
+            print(f"✅ SMS sent via Twilio to {item['phone_number']}, SID: {result['sid']}")
+        sms_log = build_sms_log(item, True, result["method"], sid=result["sid"])
+        now = datetime.now(timezone.utc)
+        await db.sms_outbox.update_one(
+            {"id": item["id"]},
+            {"$set": {"status": "sent", "sent_at": now, "finished_at": now, "sms_log": sms_log, "updated_at": now}}
+        )
+        self.sent += 1
+        
+        # sms_sent means the provider accepted the notification, not that it was queued.
+        # Set it before the stats, a failed stats write must not leave the order unmarked
+        order_ids = [delivery["order_id"] for delivery in item.get("deliveries") or []]
+        if order_ids:
+            await db.orders.update_many({"id": {"$in": order_ids}}, {"$set": {"sms_sent": True}})
+            await bump_change_versions(item.get("company_id"))
+        
+        await record_sms_result(item, sms_log)
+
+    async def _worker(self):
+        while True:
+            if self._draining and time.monotonic() > self._drain_deadline:
+                return
+            wait = sms_rate_limiter.global_wait()
+            if wait > 0:
+                # Nothing could be sent anyway, leave the items to workers with tokens
+                await asyncio.sleep(min(wait, SMS_OUTBOX_POLL_SECONDS))
+                continue
+            try:
+                item = await self._claim()
+            except Exception as e:
+                print(f"⚠️ SMS outbox claim failed: {str(e)}")
+                item = None
+            
+            if item is None:
+                if self._draining:
+                    return
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), SMS_OUTBOX_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                continue
+            
+            self.in_flight += 1
+            try:
+                await self._process(item)
+            except Exception as e:
+                # Leave the lease in place, the item is claimed again once it expires
+                print(f"❌ SMS outbox item {item['id']} crashed: {str(e)}")
+            finally:
+                self.in_flight -= 1
+
+    def start(self):
+        if self._tasks:
+            return
+        import aiohttp
+        self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=SMS_PROVIDER_TIMEOUT_SECONDS))
+        self._draining = False
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def drain(self, timeout: float):
+        """Keep sending due items until the outbox is empty or the timeout expires, then stop"""
+        if not self._tasks:
+            return
+        self._draining = True
+        self._drain_deadline = time.monotonic() + timeout
+        self._wakeup.set()
+        done, pending = await asyncio.wait(self._tasks, timeout=timeout + SMS_PROVIDER_TIMEOUT_SECONDS)
+        for task in pending:
+            task.cancel()
+        self._tasks = []
+        await self._session.close()
+        self._session = None
+
+    async def stats(self) -> dict:
+        backlog = await db.sms_outbox.aggregate([
+            {"$match": {"status": {"$in": ["pending", "sending"]}}},
+            {"$group": {
+                "_id": {"kind": "$kind", "status": "$status", "company_id": "$company_id"},
+                "count": {"$sum": 1}
+            }}
+        ]).to_list(None)
+        by_lane = {}
+        queued_by_company = {}
+        for row in backlog:
+            lane = f"{row['_id']['kind']}:{row['_id']['status']}"
+            by_lane[lane] = by_lane.get(lane, 0) + row["count"]
+            company_key = row["_id"].get("company_id") or "_none"
+            queued_by_company[company_key] = queued_by_company.get(company_key, 0) + row["count"]
+        return {
+            "workers": len(self._tasks),
+            "in_flight": self.in_flight,
+            "enqueued": self.enqueued,
+            "sent": self.sent,
+            "failed": self.failed,
+            "retried": self.retried,
+            "throttled": self.throttled,
+            "coalesced": self.coalesced,
+            "backlog": by_lane,
+            "queued_by_company": queued_by_company,
+            "rate_limiter": sms_rate_limiter.stats()
+        }
+
+sms_outbox = SMSOutbox(SMS_OUTBOX_WORKERS)
+
+# 0 sends delivery SMS right away, companies opt in to coalescing with sms_coalesce_window_seconds
+SMS_COALESCE_WINDOW_SECONDS = int(os.environ.get('SMS_COALESCE_WINDOW_SECONDS', '0'))
+COMPANY_SMS_SETTINGS_TTL_SECONDS = float(os.environ.get('COMPANY_SMS_SETTINGS_TTL_SECONDS', '30'))
+
+company_sms_settings_cache = {}  # company_id -> (expires_at, settings)
+
+async def get_company_sms_settings(company_id: Optional[str]) -> dict:
+    """Per-company SMS policy with environment defaults, cached briefly per process"""
+    settings = {"coalesce_window_seconds": SMS_COALESCE_WINDOW_SECONDS, "encoding_policy": SMS_DEFAULT_ENCODING_POLICY}
+    if not company_id:
+        return settings
+    
+    cached = company_sms_settings_cache.get(company_id)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+    
+    company = await db.companies.find_one(
+        {"id": company_id}, {"_id": 0, "sms_coalesce_window_seconds": 1, "sms_encoding_policy": 1}
+    )
+    if company and company.get("sms_coalesce_window_seconds") is not None:
+        settings["coalesce_window_seconds"] = company["sms_coalesce_window_seconds"]
+    if company and company.get("sms_encoding_policy"):
+        settings["encoding_policy"] = company["sms_encoding_policy"]
+    company_sms_settings_cache[company_id] = (time.monotonic() + COMPANY_SMS_SETTINGS_TTL_SECONDS, settings)
+    return settings
+
+def build_delivery_message(deliveries: list) -> str:
+    """Customer notification for one or more completed deliveries"""
+    if len(deliveries) == 1:
+        delivery = deliveries[0]
+        return f"Ciao {delivery['customer_name']}! 📦 La tua consegna è stata completata con successo all'indirizzo: {delivery['delivery_address']}. Grazie per aver scelto FarmyGo! 🚚"
+    
+    addresses = []
+    for delivery in deliveries:
+        if delivery["delivery_address"] not in addresses:
+            addresses.append(delivery["delivery_address"])
+    return f"Ciao {deliveries[0]['customer_name']}! 📦 Le tue {len(deliveries)} consegne sono state completate con successo all'indirizzo: {'; '.join(addresses)}. Grazie per aver scelto FarmyGo! 🚚"
+
+async def queue_delivery_notification(order: dict):
+    """Queue the delivery SMS for an order, merging it into a pending one for the same phone.
+
+    With a coalescing window (off by default), notifications to the same (company, phone)
+    are held until it closes and sent as a single message.
+    """
+    company_id = order.get("company_id")
+    phone_number = order["phone_number"]
+    delivery = {
+        "order_id": order["id"],
+        "customer_name": order["customer_name"],
+        "delivery_address": order["delivery_address"]
+    }
+    window = (await get_company_sms_settings(company_id))["coalesce_window_seconds"]
+    coalesce_key = f"{company_id}:{phone_number}"
+    now = datetime.now(timezone.utc)
+    
+    if window > 0:
+        merged = await db.sms_outbox.find_one_and_update(
+            {"coalesce_key": coalesce_key, "status": "pending", "coalesce_until": {"$gt": now}},
+            {"$push": {"deliveries": delivery}, "$set": {"updated_at": now}},
+            projection={"_id": 0, "id": 1}
+        )
+        if merged:
+            sms_outbox.coalesced += 1
+            return
+    
+    await sms_outbox.enqueue(
+        phone_number, build_delivery_message([delivery]), company_id,
+        kind="delivery", priority=SMSPriority.DELIVERY,
+        extra={
+            "coalesce_key": coalesce_key,
+            "coalesce_until": now + timedelta(seconds=window),
+            "deliveries": [delivery]
+        },
+        delay_seconds=window
+    )
+
+async def send_sms_notification(phone_number: str, message: str, company_id: str = None,
+                                kind: str = "delivery", priority: int = SMSPriority.DELIVERY):
+    """Queue an SMS notification and return the outbox item.
+
+    Enqueueing is not delivery: the outbox workers send it, track its cost and
+    mark delivered orders as sms_sent once the provider accepted the message.
+    """
+    return await sms_outbox.enqueue(phone_number, message, company_id, kind=kind, priority=priority)
 
 # Initialize super admin
 async def init_super_admin():
@@ -434,7 +2204,7 @@ async def init_super_admin():
         admin_user = {
             "id": str(uuid.uuid4()),
             "username": "superadmin",
-            "password": hash_password("admin123"),
+            "password": await hash_password_async("admin123"),
             "role": UserRole.SUPER_ADMIN,
             "company_id": None,
             "is_active": True,
@@ -443,30 +2213,533 @@ async def init_super_admin():
         await db.users.insert_one(admin_user)
         print("Super admin created: username=superadmin, password=admin123")
 
+# Search
+# Searchable fields are normalized into search_text and indexed as grams in
+# search_grams: every trigram plus the one and two character prefix of each word,
+# tagged with the field ("n:", "p:", "r:") so a name search can't match a phone.
+SEARCH_INDEX_VERSION = 1
+SEARCH_MAX_TIME_MS = int(os.environ.get('SEARCH_MAX_TIME_MS', '2000'))
+SEARCH_MAX_TERM_LENGTH = int(os.environ.get('SEARCH_MAX_TERM_LENGTH', '64'))
+SEARCH_BACKFILL_BATCH_SIZE = int(os.environ.get('SEARCH_BACKFILL_BATCH_SIZE', '500'))
+# At startup the backfill only runs for collections not yet completed at SEARCH_INDEX_VERSION
+SEARCH_BACKFILL_ON_STARTUP = os.environ.get('SEARCH_BACKFILL_ON_STARTUP', 'true').lower() == 'true'
+SEARCH_FIELDS = {
+    "orders": {"n": "customer_name", "p": "phone_number", "r": "reference_number"},
+    "customers": {"n": "name", "p": "phone_number"}
+}
+
+def normalize_search_text(text: Optional[str], field: str = "n") -> str:
+    """Lowercase and strip accents and punctuation, phone fields keep only digits"""
+    if not text:
+        return ""
+    if field == "p":
+        return "".join(ch for ch in text if ch.isdigit())
+    folded = "".join(ch for ch in unicodedata.normalize("NFKD", text) if not unicodedata.combining(ch))
+    return " ".join(re.sub(r"[^\w]+", " ", folded.casefold().replace("_", " ")).split())
+
+def text_grams(normalized: str) -> set:
+    grams = set()
+    for word in normalized.split():
+        grams.update(word[:n] for n in (1, 2))
+        grams.update(word[i:i + 3] for i in range(len(word) - 2))
+    return grams
+
+def build_search_fields(collection_name: str, document: dict) -> dict:
+    """search_text/search_grams for a document, to be $set alongside the searchable fields"""
+    search_text = {}
+    grams = set()
+    for field, source in SEARCH_FIELDS[collection_name].items():
+        normalized = normalize_search_text(document.get(source), field)
+        search_text[field] = normalized
+        grams.update(f"{field}:{gram}" for gram in text_grams(normalized))
+    return {"search_text": search_text, "search_grams": sorted(grams), "search_version": SEARCH_INDEX_VERSION}
+
+def compile_field_search(field: str, term: str) -> Optional[dict]:
+    normalized = normalize_search_text(term, field)
+    if not normalized:
+        return None
+    words = normalized.split()
+    grams = set()
+    for word in words:
+        # Short words can only use the prefix grams, longer ones match anywhere through their trigrams
+        if len(word) > 2:
+            grams.update(word[i:i + 3] for i in range(len(word) - 2))
+        else:
+            grams.add(word)
+    clauses = [{"search_grams": {"$all": sorted(f"{field}:{gram}" for gram in grams)}}]
+    if len(words) > 1 or len(normalized) > 3:
+        # Grams can come from different places, confirm on the candidates the index found
+        clauses.append({f"search_text.{field}": {"$regex": re.escape(normalized)}})
+    return clauses[0] if len(clauses) == 1 else {"$and": clauses}
+
+def compile_search_query(company_id: str, term: str, fields: tuple) -> dict:
+    """Translate user input into an indexed query over the given search fields.
+
+    User input never reaches $regex unescaped and one and two letter words only match
+    at the start of a word, everything else is a substring match.
+    """
+    if len(term) > SEARCH_MAX_TERM_LENGTH:
+        raise HTTPException(status_code=400, detail=f"Search term is limited to {SEARCH_MAX_TERM_LENGTH} characters")
+    branches = [
+        {"company_id": company_id, **clause}
+        for clause in (compile_field_search(field, term) for field in fields)
+        if clause
+    ]
+    if not branches:
+        raise HTTPException(status_code=400, detail="Search term must contain letters or digits")
+    return branches[0] if len(branches) == 1 else {"$or": branches}
+
+async def backfill_search_fields(collection_name: str) -> int:
+    """Index documents written before search_grams existed or with an older version.
+
+    The collection is walked once in _id order, each batch resuming after the
+    last _id seen, so documents that are already current are passed over once
+    instead of being rescanned for every batch.
+    """
+    projection = {source: 1 for source in SEARCH_FIELDS[collection_name].values()}
+    updated = 0
+    last_id = None
+    while True:
+        query = {"search_version": {"$ne": SEARCH_INDEX_VERSION}}
+        if last_id is not None:
+            query["_id"] = {"$gt": last_id}
+        documents = await db[collection_name].find(query, projection).sort("_id", 1).limit(
+            SEARCH_BACKFILL_BATCH_SIZE
+        ).to_list(SEARCH_BACKFILL_BATCH_SIZE)
+        if not documents:
+            break
+        last_id = documents[-1]["_id"]
+        await db[collection_name].bulk_write([
+            UpdateOne({"_id": document["_id"]}, {"$set": build_search_fields(collection_name, document)})
+            for document in documents
+        ], ordered=False)
+        updated += len(documents)
+    
+    # New writes always carry the current search fields, the collection stays complete from here on
+    await db.search_backfills.update_one(
+        {"collection": collection_name},
+        {"$set": {"version": SEARCH_INDEX_VERSION, "updated": updated, "completed_at": datetime.now(timezone.utc)}},
+        upsert=True
+    )
+    return updated
+
+async def backfill_search_index(force: bool = False) -> dict:
+    """Backfill every searchable collection, or only those not completed at the current version"""
+    if not await acquire_job_lock("search_backfill", 3600):
+        return {"skipped": True}
+    try:
+        completed = set() if force else {
+            marker["collection"] async for marker in db.search_backfills.find(
+                {"version": SEARCH_INDEX_VERSION}, {"_id": 0, "collection": 1}
+            )
+        }
+        result = {name: await backfill_search_fields(name) for name in SEARCH_FIELDS if name not in completed}
+        if result:
+            print(f"✅ Search index backfill: {result}")
+        return result
+    finally:
+        await release_job_lock("search_backfill")
+
+def search_timeout() -> HTTPException:
+    return HTTPException(status_code=503, detail="Search took too long, please narrow the filters")
+
+def build_order_search_query(
+    company_id: str,
+    customer_name: Optional[str] = None,
+    courier_id: Optional[str] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    status: Optional[str] = None,
+    q: Optional[str] = None
+) -> dict:
+    """Filters shared by order search and export, customer_name matches names and q any search field"""
+    query = {"company_id": company_id}
+    
+    search = [
+        compile_search_query(company_id, term, fields)
+        for term, fields in ((customer_name, ("n",)), (q, ("n", "p", "r")))
+        if term
+    ]
+    if search:
+        query["$and"] = search
+    
+    if courier_id:
+        query["courier_id"] = courier_id
+    
+    if status:
+        query["status"] = status
+    
+    if date_from or date_to:
+        date_query = {}
+        if date_from:
+            date_query["$gte"] = datetime.fromisoformat(date_from.replace('Z', '+00:00'))
+        if date_to:
+            date_query["$lte"] = datetime.fromisoformat(date_to.replace('Z', '+00:00'))
+        query["created_at"] = date_query
+    
+    return query
+
+# Pagination
+DEFAULT_PAGE_SIZE = int(os.environ.get('DEFAULT_PAGE_SIZE', '1000'))
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', '1000'))
+# NDJSON streams hold one batch in memory whatever the page size, so they accept far larger pages
+NDJSON_MAX_PAGE_SIZE = int(os.environ.get('NDJSON_MAX_PAGE_SIZE', '100000'))
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+def wants_ndjson(request: Request) -> bool:
+    return NDJSON_MEDIA_TYPE in request.headers.get("accept", "")
+
+class PageParams:
+    """Query parameters shared by the keyset-paginated list endpoints.
+
+    The continuation token for the next page is returned in the X-Next-Cursor
+    header and X-Total-Count is only computed when include_total is set.
+    NDJSON streams return the same pages, one document per line, and accept a
+    limit up to NDJSON_MAX_PAGE_SIZE instead of MAX_PAGE_SIZE.
+    """
+
+    def __init__(self, limit: Optional[int] = None, cursor: Optional[str] = None, include_total: bool = False,
+                 request: Request = None):
+        max_limit = NDJSON_MAX_PAGE_SIZE if request is not None and wants_ndjson(request) else MAX_PAGE_SIZE
+        if limit is not None and not 1 <= limit <= max_limit:
+            raise HTTPException(status_code=400, detail=f"limit must be between 1 and {max_limit}")
+        self.explicit_limit = limit
+        self.limit = limit or DEFAULT_PAGE_SIZE
+        self.cursor = cursor
+        self.include_total = include_total
+
+def encode_cursor(sort_field: str, document: dict) -> str:
+    value = document.get(sort_field)
+    payload = {
+        "f": sort_field,
+        "v": value.isoformat() if isinstance(value, datetime) else value,
+        "d": isinstance(value, datetime),
+        "id": document["id"]
+    }
+    return base64.urlsafe_b64encode(json.dumps(payload, separators=(",", ":")).encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str, sort_field: str) -> tuple:
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        if payload["f"] != sort_field:
+            raise ValueError("cursor belongs to another listing")
+        value = datetime.fromisoformat(payload["v"]) if payload["d"] else payload["v"]
+        return value, payload["id"]
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def keyset_query(query: dict, page: PageParams, sort_field: str, direction: int) -> dict:
+    """Restrict query to the documents after the page cursor in (sort_field, id) order"""
+    if not page.cursor:
+        return query
+    value, last_id = decode_cursor(page.cursor, sort_field)
+    op = "$gt" if direction == 1 else "$lt"
+    return {"$and": [query, {"$or": [
+        {sort_field: {op: value}},
+        {sort_field: value, "id": {op: last_id}}
+    ]}]}
+
+async def fetch_page(collection, query: dict, page: PageParams, response: Response,
+                     sort_field: str, direction: int = -1, projection: Optional[dict] = None,
+                     max_time_ms: Optional[int] = None) -> list:
+    """Fetch one keyset page ordered by (sort_field, id) and set the pagination headers"""
+    cursor = collection.find(keyset_query(query, page, sort_field, direction), projection).sort(
+        [(sort_field, direction), ("id", direction)]
+    ).limit(page.limit + 1)
+    count_options = {}
+    if max_time_ms:
+        cursor = cursor.max_time_ms(max_time_ms)
+        count_options["maxTimeMS"] = max_time_ms
+    
+    if page.include_total:
+        documents, total = await asyncio.gather(
+            cursor.to_list(page.limit + 1), collection.count_documents(query, **count_options)
+        )
+        response.headers["X-Total-Count"] = str(total)
+    else:
+        documents = await cursor.to_list(page.limit + 1)
+    
+    if len(documents) > page.limit:
+        documents = documents[:page.limit]
+        response.headers["X-Next-Cursor"] = encode_cursor(sort_field, documents[-1])
+    return documents
+
+# Fast list responses
+# Documents read with model_projection() only hold model fields. A prebuilt TypeAdapter
+# validates the whole list in one call and serializes it to JSON bytes, skipping the
+# per-document Model(**doc) and the response_model re-validation of FastAPI. Validating
+# in pydantic-core is cheaper than model_construct(), which runs in Python per document.
+LIST_ADAPTERS = {model: TypeAdapter(List[model]) for model in (Order, Customer, User)}
+PASSTHROUGH_HEADERS = ("x-next-cursor", "x-total-count", "etag", "cache-control")
+
+def model_projection(model) -> dict:
+    return {"_id": 0, **{field: 1 for field in model.model_fields}}
+
+ORDER_PROJECTION = model_projection(Order)
+CUSTOMER_PROJECTION = model_projection(Customer)
+USER_PROJECTION = model_projection(User)
+
+def passthrough_headers(response: Optional[Response]) -> dict:
+    # Headers set on the injected response are dropped when a Response is returned
+    if response is None:
+        return {}
+    return {name: value for name, value in response.headers.items() if name in PASSTHROUGH_HEADERS}
+
+def model_list_response(model, documents: list, response: Optional[Response] = None) -> Response:
+    adapter = LIST_ADAPTERS[model]
+    body = adapter.dump_json(adapter.validate_python(documents))
+    return Response(content=body, media_type="application/json", headers=passthrough_headers(response))
+
+# NDJSON streaming
+NDJSON_BATCH_SIZE = int(os.environ.get('NDJSON_BATCH_SIZE', '500'))
+ITEM_ADAPTERS = {model: TypeAdapter(model) for model in LIST_ADAPTERS}
+
+async def ndjson_response(model, collection, query: dict, page: PageParams, sort_field: str, direction: int,
+                          projection: dict, prepare=None, response: Optional[Response] = None,
+                          max_time_ms: Optional[int] = None) -> Response:
+    """Stream one page as one JSON document per line.
+
+    The page has the same size and pagination headers as the JSON listing, the
+    continuation cursor comes from an index-only lookup of the page boundary made
+    before streaming. The first batch is read before the response starts, so a
+    query over max_time_ms still fails with an error status; after that lines are
+    rendered and sent per cursor batch, so memory is bounded by the batch size.
+    prepare, if given, is awaited with each batch of documents before rendering.
+    """
+    from fastapi.responses import StreamingResponse
+    
+    keyset = keyset_query(query, page, sort_field, direction)
+    sort = [(sort_field, direction), ("id", direction)]
+    # The last document of this page and the first of the next one, if any
+    boundary = collection.find(keyset, {"_id": 0, sort_field: 1, "id": 1}).sort(sort).skip(page.limit - 1).limit(2)
+    cursor = collection.find(keyset, projection).sort(sort).limit(page.limit).batch_size(NDJSON_BATCH_SIZE)
+    count_options = {}
+    if max_time_ms:
+        boundary = boundary.max_time_ms(max_time_ms)
+        cursor = cursor.max_time_ms(max_time_ms)
+        count_options["maxTimeMS"] = max_time_ms
+    
+    headers = passthrough_headers(response)
+    edge, first = await asyncio.gather(boundary.to_list(2), cursor.to_list(NDJSON_BATCH_SIZE))
+    if len(edge) > 1:
+        headers["X-Next-Cursor"] = encode_cursor(sort_field, edge[0])
+    if page.include_total:
+        headers["X-Total-Count"] = str(await collection.count_documents(query, **count_options))
+    adapter = ITEM_ADAPTERS[model]
+    
+    async def render(batch: list) -> bytes:
+        if prepare:
+            await prepare(batch)
+        return b"".join(adapter.dump_json(item) + b"\n" for item in LIST_ADAPTERS[model].validate_python(batch))
+    
+    async def lines():
+        if first:
+            yield await render(first)
+        batch = []
+        async for document in cursor:
+            batch.append(document)
+            if len(batch) >= NDJSON_BATCH_SIZE:
+                yield await render(batch)
+                batch = []
+        if batch:
+            yield await render(batch)
+    
+    return StreamingResponse(lines(), media_type=NDJSON_MEDIA_TYPE, headers=headers)
+
+# Change versions
+# Every write bumps the version of the company it touches (and of the couriers whose
+# deliveries it changes) after it completes. List endpoints derive their ETag from that
+# version, so a client holding a current ETag gets 304 without any query on the data.
+RESPONSE_CACHE_ENABLED = os.environ.get('RESPONSE_CACHE_ENABLED', 'false').lower() == 'true'
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get('RESPONSE_CACHE_MAX_ENTRIES', '512'))
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get('RESPONSE_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+CONDITIONAL_CACHE_CONTROL = "private, no-cache"
+
+def company_scope(company_id: str) -> str:
+    return f"company:{company_id}"
+
+def courier_scope(courier_id: str) -> str:
+    return f"courier:{courier_id}"
+
+async def bump_change_versions(company_id: Optional[str], courier_ids=()):
+    """Invalidate the ETags of a company's lists and of the given couriers' deliveries.
+
+    Must run after the write: bumping first would let a concurrent read tag the old
+    data with the new version.
+    """
+    scopes = [company_scope(company_id)] if company_id else []
+    scopes.extend(courier_scope(courier_id) for courier_id in set(courier_ids) if courier_id)
+    if not scopes:
+        return
+    operations = [
+        UpdateOne({"scope": scope}, {"$inc": {"version": 1}, "$setOnInsert": {"epoch": uuid.uuid4().hex[:8]}}, upsert=True)
+        for scope in scopes
+    ]
+    try:
+        await db.change_versions.bulk_write(operations, ordered=False)
+    except BulkWriteError:
+        # Two first writes raced on the upsert, the retry updates the winner's document
+        await db.change_versions.bulk_write(operations, ordered=False)
+
+async def get_change_version(scope: str) -> str:
+    entry = await db.change_versions.find_one({"scope": scope}, {"_id": 0, "epoch": 1, "version": 1})
+    if entry is None:
+        # The epoch keeps ETags from repeating if the collection is ever reset
+        try:
+            await db.change_versions.update_one(
+                {"scope": scope},
+                {"$setOnInsert": {"epoch": uuid.uuid4().hex[:8], "version": 0}},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            pass
+        entry = await db.change_versions.find_one({"scope": scope}, {"_id": 0, "epoch": 1, "version": 1})
+    return f"{entry['epoch']}.{entry['version']}"
+
+def etag_matches(header: Optional[str], etag: str) -> bool:
+    if not header:
+        return False
+    candidates = [candidate.strip() for candidate in header.split(",")]
+    # Weak comparison, as If-None-Match requires
+    return "*" in candidates or etag.removeprefix("W/") in (candidate.removeprefix("W/") for candidate in candidates)
+
+class ResponseCache:
+    """Rendered list responses keyed by ETag, bounded by entry count and total bytes.
+
+    The ETag carries the change version, so entries are never invalidated explicitly:
+    after a write they are no longer looked up and age out of the LRU.
+    """
+
+    def __init__(self, enabled: bool, max_entries: int, max_bytes: int):
+        self.enabled = enabled
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, etag: str) -> Optional[Response]:
+        if not self.enabled:
+            return None
+        entry = self._entries.get(etag)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(etag)
+        self.hits += 1
+        body, media_type, headers = entry
+        return Response(content=body, media_type=media_type, headers=headers)
+
+    def put(self, etag: str, response: Response) -> Response:
+        if not self.enabled or len(response.body) > self.max_bytes // 4:
+            return response
+        if etag in self._entries:
+            self._bytes -= len(self._entries.pop(etag)[0])
+        headers = {name: value for name, value in response.headers.items() if name in PASSTHROUGH_HEADERS}
+        self._entries[etag] = (response.body, response.media_type, headers)
+        self._bytes += len(response.body)
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            _, (body, _, _) = self._entries.popitem(last=False)
+            self._bytes -= len(body)
+            self.evictions += 1
+        return response
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
+
+response_cache = ResponseCache(RESPONSE_CACHE_ENABLED, RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_MAX_BYTES)
+
+async def conditional_get(request: Request, response: Response, scope: str) -> tuple:
+    """ETag for this request and, when it can be answered without a query, the response.
+
+    The ETag covers the scope's version, the URL (page, cursor, filters) and the
+    Accept header, so each representation is validated separately.
+    """
+    variant = hashlib.sha1(
+        f"{scope}|{request.url.path}?{request.url.query}|{request.headers.get('accept', '')}".encode()
+    ).hexdigest()[:16]
+    etag = f'W/"{await get_change_version(scope)}-{variant}"'
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = CONDITIONAL_CACHE_CONTROL
+    
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return etag, Response(status_code=304, headers={"ETag": etag, "Cache-Control": CONDITIONAL_CACHE_CONTROL})
+    if wants_ndjson(request):
+        return etag, None
+    return etag, response_cache.get(etag)
+
 # Routes
 @api_router.post("/auth/login", response_model=LoginResponse)
 async def login(request: LoginRequest):
     user_data = await db.users.find_one({"username": request.username})
-    if not user_data or not verify_password(request.password, user_data["password"]):
+    if not user_data or not await verify_password_async(request.password, user_data["password"]):
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
     if not user_data["is_active"]:
         raise HTTPException(status_code=401, detail="Account disabled")
     
-    access_token = create_access_token({"sub": user_data["username"]})
     user = User(**user_data)
     
     company = None
+    company_data = None
     if user.company_id:
         company_data = await db.companies.find_one({"id": user.company_id})
         if company_data:
+            if not company_data.get("is_active", True):
+                raise HTTPException(status_code=401, detail="Company disabled")
             company = Company(**company_data)
     
+    access_token, refresh_token = create_user_tokens(user_data, company_data)
+    
     return LoginResponse(
         access_token=access_token,
         token_type="bearer",
         user=user,
-        company=company
+        company=company,
+        refresh_token=refresh_token,
+        expires_in=ACCESS_TOKEN_TTL_MINUTES * 60
+    )
+
+@api_router.post("/auth/refresh", response_model=TokenResponse)
+async def refresh_access_token(request: RefreshTokenRequest):
+    """Exchange a refresh token for a new access/refresh token pair"""
+    try:
+        payload = jwt.decode(request.refresh_token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+    except jwt.PyJWTError:
+        raise HTTPException(status_code=401, detail="Invalid refresh token")
+    
+    if payload.get("type") != "refresh" or payload.get("uid") is None:
+        raise HTTPException(status_code=401, detail="Invalid refresh token")
+    
+    user_data = await db.users.find_one({"id": payload["uid"]})
+    if not user_data or user_data.get("token_version", 0) != payload.get("ver", 0):
+        raise HTTPException(status_code=401, detail="Refresh token revoked")
+    
+    if not user_data["is_active"]:
+        raise HTTPException(status_code=401, detail="Account disabled")
+    
+    company_data = None
+    if user_data.get("company_id"):
+        company_data = await db.companies.find_one({"id": user_data["company_id"]})
+        if company_data and not company_data.get("is_active", True):
+            raise HTTPException(status_code=401, detail="Company disabled")
+    
+    access_token, refresh_token = create_user_tokens(user_data, company_data)
+    
+    return TokenResponse(
+        access_token=access_token,
+        refresh_token=refresh_token,
+        token_type="bearer",
+        expires_in=ACCESS_TOKEN_TTL_MINUTES * 60
     )
 
 # Super Admin Routes
@@ -493,7 +2766,7 @@ async def create_company(
     admin_user = {
         "id": str(uuid.uuid4()),
         "username": request.admin_username,
-        "password": hash_password(request.admin_password),
+        "password": await hash_password_async(request.admin_password),
         "role": UserRole.COMPANY_ADMIN,
         "company_id": company.id,
         "is_active": True,
@@ -565,6 +2838,33 @@ async def update_company(
     
     return {"message": "Company updated successfully"}
 
+@api_router.patch("/companies/{company_id}/sms-settings")
+async def update_company_sms_settings(
+    company_id: str,
+    request: UpdateCompanySMSSettingsRequest,
+    current_user: User = Depends(require_role([UserRole.SUPER_ADMIN]))
+):
+    """Update a company's SMS policy (only fields sent are changed, null restores the server default)"""
+    if request.sms_coalesce_window_seconds is not None and not 0 <= request.sms_coalesce_window_seconds <= 3600:
+        raise HTTPException(status_code=400, detail="Coalescing window must be between 0 and 3600 seconds")
+    
+    if request.sms_encoding_policy not in (None, "unicode", "gsm7"):
+        raise HTTPException(status_code=400, detail="Encoding policy must be 'unicode' or 'gsm7'")
+    
+    update_data = request.dict(exclude_unset=True)
+    if not update_data:
+        raise HTTPException(status_code=400, detail="No settings provided")
+    
+    result = await db.companies.update_one(
+        {"id": company_id},
+        {"$set": update_data}
+    )
+    if result.matched_count == 0:
+        raise HTTPException(status_code=404, detail="Company not found")
+    company_sms_settings_cache.pop(company_id, None)
+    
+    return {"message": "Company SMS settings updated successfully"}
+
 @api_router.patch("/companies/{company_id}/reset-password")
 async def reset_company_admin_password(
     company_id: str,
@@ -573,7 +2873,7 @@ async def reset_company_admin_password(
 ):
     # Verify super admin password
     admin_user = await db.users.find_one({"id": current_user.id})
-    if not admin_user or not verify_password(request.admin_password, admin_user["password"]):
+    if not admin_user or not await verify_password_async(request.admin_password, admin_user["password"]):
         raise HTTPException(status_code=401, detail="Incorrect admin password")
     
     # Find company
@@ -592,8 +2892,10 @@ async def reset_company_admin_password(
     # Update password
     await db.users.update_one(
         {"id": company_admin["id"]},
-        {"$set": {"password": hash_password(request.new_password)}}
+        {"$set": {"password": await hash_password_async(request.new_password)}}
     )
+    principal_cache.invalidate_user(company_admin["username"])
+    await revoke_user_tokens(company_admin["id"])
     
     return {"message": "Company admin password reset successfully"}
 
@@ -605,7 +2907,7 @@ async def delete_company(
 ):
     # Verify super admin password
     admin_user = await db.users.find_one({"id": current_user.id})
-    if not admin_user or not verify_password(request.password, admin_user["password"]):
+    if not admin_user or not await verify_password_async(request.password, admin_user["password"]):
         raise HTTPException(status_code=401, detail="Incorrect password")
     
     # Check if company exists
@@ -617,6 +2919,8 @@ async def delete_company(
     await db.orders.delete_many({"company_id": company_id})
     await db.users.delete_many({"company_id": company_id})
     await db.companies.delete_one({"id": company_id})
+    principal_cache.invalidate_company(company_id)
+    await revoke_company_tokens(company_id, company.get("token_version", 0) + 1)
     
     return {"message": "Company deleted successfully"}
 
@@ -634,6 +2938,9 @@ async def toggle_company_status(
         {"id": company_id},
         {"$set": {"is_active": new_status}}
     )
+    principal_cache.invalidate_company(company_id)
+    if not new_status:
+        await revoke_company_tokens(company_id)
     
     return {"message": f"Company {'enabled' if new_status else 'disabled'}"}
 
@@ -651,7 +2958,7 @@ async def create_courier(
     courier = {
         "id": str(uuid.uuid4()),
         "username": request.username,
-        "password": hash_password(request.password),
+        "password": await hash_password_async(request.password),
         "full_name": request.full_name,
         "role": UserRole.COURIER,
         "company_id": current_user.company_id,
@@ -659,19 +2966,27 @@ async def create_courier(
         "created_at": datetime.now(timezone.utc)
     }
     await db.users.insert_one(courier)
+    await bump_change_versions(current_user.company_id)
     
     return {"message": "Courier created successfully"}
 
 @api_router.get("/couriers", response_model=List[User])
 async def get_couriers(
+    request: Request,
+    response: Response,
+    page: PageParams = Depends(),
     current_user: User = Depends(require_role([UserRole.COMPANY_ADMIN]))
 ):
-    couriers = await db.users.find({
+    etag, cached = await conditional_get(request, response, company_scope(current_user.company_id))
+    if cached:
+        return cached
+    
+    couriers = await fetch_page(db.users, {
         "company_id": current_user.company_id,
         "role": UserRole.COURIER
-    }).to_list(1000)
+    }, page, response, "created_at", 1, USER_PROJECTION)
     
-    return [User(**courier) for courier in couriers]
+    return response_cache.put(etag, model_list_response(User, couriers, response))
 
 @api_router.patch("/couriers/{courier_id}")
 async def update_courier(
@@ -700,7 +3015,7 @@ async def update_courier(
     # Prepare update data
     update_data = {"username": request.username}
     if request.password:
-        update_data["password"] = hash_password(request.password)
+        update_data["password"] = await hash_password_async(request.password)
     if request.full_name is not None:
         update_data["full_name"] = request.full_name
     
@@ -709,6 +3024,10 @@ async def update_courier(
         {"id": courier_id},
         {"$set": update_data}
     )
+    principal_cache.invalidate_user(courier["username"], request.username)
+    if "password" in update_data or request.username != courier["username"]:
+        await revoke_user_tokens(courier_id)
+    await bump_change_versions(current_user.company_id)
     
     return {"message": "Courier updated successfully"}
 
@@ -736,6 +3055,9 @@ async def delete_courier(
     
     # Delete courier
     await db.users.delete_one({"id": courier_id})
+    principal_cache.invalidate_user(courier["username"])
+    await token_revocations.revoke("user", courier_id, courier.get("token_version", 0) + 1)
+    await bump_change_versions(current_user.company_id)
     
     return {"message": "Courier deleted successfully"}
 
@@ -757,6 +3079,10 @@ async def toggle_courier_status(
         {"id": courier_id},
         {"$set": {"is_active": new_status}}
     )
+    principal_cache.invalidate_user(courier["username"])
+    if not new_status:
+        await revoke_user_tokens(courier_id)
+    await bump_change_versions(current_user.company_id)
     
     return {"message": f"Courier {'activated' if new_status else 'blocked'}"}
 
@@ -795,8 +3121,18 @@ async def create_order(
                     address=request.delivery_address,
                     company_id=current_user.company_id
                 )
-                await db.customers.insert_one(new_customer.dict())
-                customer_id = new_customer.id
+                try:
+                    await db.customers.insert_one({**new_customer.dict(), **build_search_fields("customers", new_customer.dict())})
+                    customer_id = new_customer.id
+                except DuplicateKeyError:
+                    # Another request created this phone in the meantime, use that customer
+                    existing_customer = await db.customers.find_one(
+                        {"phone_number": request.phone_number, "company_id": current_user.company_id},
+                        {"_id": 0, "id": 1}
+                    )
+                    if not existing_customer:
+                        raise
+                    customer_id = existing_customer["id"]
     
     order = Order(
         customer_name=request.customer_name,
@@ -806,41 +3142,352 @@ async def create_order(
         company_id=current_user.company_id,
         customer_id=customer_id
     )
-    await db.orders.insert_one(order.dict())
+    await db.orders.insert_one({**order.dict(), **build_search_fields("orders", order.dict())})
+    await bump_change_versions(current_user.company_id)
     
     return {"message": "Order created successfully", "order": order}
 
+# Order import
+ORDER_IMPORT_MAX_ROWS = int(os.environ.get('ORDER_IMPORT_MAX_ROWS', '20000'))
+ORDER_IMPORT_MAX_ERRORS = int(os.environ.get('ORDER_IMPORT_MAX_ERRORS', '500'))
+ORDER_IMPORT_BATCH_SIZE = int(os.environ.get('ORDER_IMPORT_BATCH_SIZE', '1000'))
+# Accepted column headers, including the ones /orders/export writes
+ORDER_IMPORT_COLUMNS = {
+    "customer_name": {"customer_name", "cliente", "nome", "customer"},
+    "delivery_address": {"delivery_address", "indirizzo", "address"},
+    "phone_number": {"phone_number", "telefono", "phone"},
+    "reference_number": {"reference_number", "numero riferimento", "riferimento", "reference"}
+}
+
+def import_cell(value) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        # Phone numbers typed into Excel come back as floats
+        value = int(value)
+    return str(value).strip()
+
+def map_import_header(header: list) -> dict:
+    """Column index for every known field, unknown columns are ignored"""
+    columns = {}
+    for index, name in enumerate(header):
+        name = import_cell(name).lower()
+        for field, aliases in ORDER_IMPORT_COLUMNS.items():
+            if name in aliases and field not in columns:
+                columns[field] = index
+    missing = [field for field in ("customer_name", "delivery_address") if field not in columns]
+    if missing:
+        raise HTTPException(status_code=400, detail=f"Missing required columns: {', '.join(missing)}")
+    return columns
+
+def read_import_rows(source, file_format: str) -> list:
+    """Runs in a worker thread, returns (row number, raw values by field) for every non-empty row"""
+    if file_format == "xlsx":
+        from openpyxl import load_workbook
+        workbook = load_workbook(source, read_only=True, data_only=True)
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+    else:
+        import csv
+        import io
+        text = io.TextIOWrapper(source, encoding="utf-8-sig", newline="")
+        sample = text.read(4096)
+        text.seek(0)
+        try:
+            dialect = csv.Sniffer().sniff(sample, delimiters=",;\t")
+        except csv.Error:
+            dialect = csv.excel
+        rows = csv.reader(text, dialect)
+    
+    try:
+        columns = map_import_header(list(next(rows, [])))
+        parsed = []
+        for row_number, row in enumerate(rows, start=2):
+            values = {field: "" for field in ORDER_IMPORT_COLUMNS}
+            values.update({field: import_cell(row[index]) for field, index in columns.items() if index < len(row)})
+            if not any(values.values()):
+                continue
+            if len(parsed) >= ORDER_IMPORT_MAX_ROWS:
+                raise HTTPException(status_code=413, detail=f"Imports are limited to {ORDER_IMPORT_MAX_ROWS} rows")
+            parsed.append((row_number, values))
+        return parsed
+    finally:
+        if file_format == "xlsx":
+            workbook.close()
+
+async def resolve_import_customers(company_id: str, rows: list) -> tuple:
+    """Phone number to customer id for the whole file: one $in lookup, one insert_many for new phones"""
+    phones = {values["phone_number"] for _, values in rows if values["phone_number"]}
+    if not phones:
+        return {}, 0
+    
+    customer_ids = {}
+    async for customer in db.customers.find(
+        {"company_id": company_id, "phone_number": {"$in": list(phones)}}, {"_id": 0, "id": 1, "phone_number": 1}
+    ):
+        customer_ids[customer["phone_number"]] = customer["id"]
+    
+    new_customers = {}
+    for _, values in rows:
+        phone = values["phone_number"]
+        if phone and phone not in customer_ids and phone not in new_customers:
+            # The first row with a new phone names the customer, like create_order does
+            customer = Customer(
+                name=values["customer_name"],
+                phone_number=phone,
+                address=values["delivery_address"],
+                company_id=company_id
+            ).dict()
+            new_customers[phone] = {**customer, **build_search_fields("customers", customer)}
+    if not new_customers:
+        return customer_ids, 0
+    
+    created = len(new_customers)
+    try:
+        await db.customers.insert_many(list(new_customers.values()), ordered=False)
+    except BulkWriteError as e:
+        # Phones created concurrently by another request lose against the unique index, use theirs
+        duplicates = [error["op"]["phone_number"] for error in e.details.get("writeErrors", []) if error.get("code") == 11000]
+        if len(duplicates) != len(e.details.get("writeErrors", [])):
+            raise
+        created -= len(duplicates)
+        async for customer in db.customers.find(
+            {"company_id": company_id, "phone_number": {"$in": duplicates}}, {"_id": 0, "id": 1, "phone_number": 1}
+        ):
+            customer_ids[customer["phone_number"]] = customer["id"]
+            new_customers.pop(customer["phone_number"], None)
+    customer_ids.update({phone: customer["id"] for phone, customer in new_customers.items()})
+    return customer_ids, created
+
+@api_router.post("/orders/import")
+async def import_orders(
+    file: UploadFile = File(...),
+    current_user: User = Depends(require_role([UserRole.COMPANY_ADMIN]))
+):
+    """Create orders from a CSV or XLSX file, rows that fail validation are reported and skipped"""
+    filename = (file.filename or "").lower()
+    if filename.endswith(".xlsx"):
+        file_format = "xlsx"
+    elif filename.endswith(".csv"):
+        file_format = "csv"
+    else:
+        raise HTTPException(status_code=400, detail="Upload a .csv or .xlsx file")
+    
+    try:
+        rows = await asyncio.to_thread(read_import_rows, file.file, file_format)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Could not read the file: {str(e)}")
+    
+    errors = []
+    valid = []
+    for row_number, values in rows:
+        missing = [field for field in ("customer_name", "delivery_address") if not values[field]]
+        if missing:
+            errors.append({"row": row_number, "error": f"Missing {', '.join(missing)}"})
+        else:
+            valid.append((row_number, values))
+    
+    customer_ids, customers_created = await resolve_import_customers(current_user.company_id, valid)
+    
+    created = 0
+    for start in range(0, len(valid), ORDER_IMPORT_BATCH_SIZE):
+        batch = valid[start:start + ORDER_IMPORT_BATCH_SIZE]
+        documents = []
+        for _, values in batch:
+            order = Order(
+                customer_name=values["customer_name"],
+                delivery_address=values["delivery_address"],
+                phone_number=values["phone_number"],
+                reference_number=values["reference_number"] or None,
+                company_id=current_user.company_id,
+                customer_id=customer_ids.get(values["phone_number"])
+            ).dict()
+            documents.append({**order, **build_search_fields("orders", order)})
+        try:
+            result = await db.orders.insert_many(documents, ordered=False)
+            created += len(result.inserted_ids)
+        except BulkWriteError as e:
+            write_errors = e.details.get("writeErrors", [])
+            created += len(batch) - len(write_errors)
+            errors.extend({"row": batch[error["index"]][0], "error": error.get("errmsg", "Insert failed")} for error in write_errors)
+    
+    if created or customers_created:
+        await bump_change_versions(current_user.company_id)
+    
+    errors.sort(key=lambda error: error["row"])
+    return {
+        "total_rows": len(rows),
+        "created": created,
+        "customers_created": customers_created,
+        "failed": len(errors),
+        "errors": errors[:ORDER_IMPORT_MAX_ERRORS]
+    }
+
 @api_router.get("/orders/search")
 async def search_orders(
+    request: Request,
+    response: Response,
+    page: PageParams = Depends(),
     current_user: User = Depends(require_role([UserRole.COMPANY_ADMIN])),
     customer_name: Optional[str] = None,
     courier_id: Optional[str] = None,
     date_from: Optional[str] = None,
     date_to: Optional[str] = None,
-    status: Optional[str] = None
+    status: Optional[str] = None,
+    q: Optional[str] = None
 ):
     """Search orders with filters"""
-    query = {"company_id": current_user.company_id}
-    
-    if customer_name:
-        query["customer_name"] = {"$regex": customer_name, "$options": "i"}
-    
-    if courier_id:
-        query["courier_id"] = courier_id
-    
-    if status:
-        query["status"] = status
+    query = build_order_search_query(
+        current_user.company_id, customer_name, courier_id, date_from, date_to, status, q
+    )
+    try:
+        if wants_ndjson(request):
+            return await ndjson_response(Order, db.orders, query, page, "created_at", -1, ORDER_PROJECTION,
+                                         max_time_ms=SEARCH_MAX_TIME_MS)
+        orders = await fetch_page(db.orders, query, page, response, "created_at", -1, ORDER_PROJECTION,
+                                  max_time_ms=SEARCH_MAX_TIME_MS)
+    except ExecutionTimeout:
+        raise search_timeout()
+    return model_list_response(Order, orders, response)
+
+# Order export
+ORDER_EXPORT_BATCH_SIZE = int(os.environ.get('ORDER_EXPORT_BATCH_SIZE', '500'))
+ORDER_EXPORT_XLSX_QUEUE_BATCHES = int(os.environ.get('ORDER_EXPORT_XLSX_QUEUE_BATCHES', '4'))
+ORDER_EXPORT_COLUMNS = [
+    "Cliente", "Indirizzo", "Telefono", "Numero Riferimento",
+    "Corriere", "Stato", "Data Creazione", "Data Consegna"
+]
+ORDER_EXPORT_PROJECTION = {
+    "_id": 0, "customer_name": 1, "delivery_address": 1, "phone_number": 1, "reference_number": 1,
+    "courier_id": 1, "status": 1, "created_at": 1, "delivered_at": 1
+}
+
+class CourierNameLookup:
+    """Courier id to username for one export, only ids not seen yet hit the database"""
+
+    def __init__(self):
+        self.names = {}
+
+    async def resolve(self, orders: list):
+        missing = {order["courier_id"] for order in orders if order.get("courier_id")} - self.names.keys()
+        if not missing:
+            return
+        async for courier in db.users.find({"id": {"$in": list(missing)}}, {"_id": 0, "id": 1, "username": 1}):
+            self.names[courier["id"]] = courier["username"]
+        # Deleted couriers resolve to the unassigned label instead of being looked up again
+        self.names.update({courier_id: None for courier_id in missing - self.names.keys()})
+
+    def name(self, courier_id: Optional[str]) -> str:
+        return self.names.get(courier_id) or "Non assegnato"
+
+def format_order_export_row(order: dict, couriers: CourierNameLookup) -> list:
+    return [
+        order["customer_name"],
+        order["delivery_address"],
+        order["phone_number"],
+        order.get("reference_number") or "",
+        couriers.name(order.get("courier_id")),
+        order["status"].title(),
+        order["created_at"].strftime("%d/%m/%Y %H:%M"),
+        order["delivered_at"].strftime("%d/%m/%Y %H:%M") if order.get("delivered_at") else ""
+    ]
+
+async def iter_order_export_rows(query: dict):
+    """Yield export rows in batches straight from the cursor, newest order first"""
+    couriers = CourierNameLookup()
+    cursor = db.orders.find(query, ORDER_EXPORT_PROJECTION).sort([("created_at", -1), ("id", -1)]).batch_size(ORDER_EXPORT_BATCH_SIZE)
+    batch = []
+    async for order in cursor:
+        batch.append(order)
+        if len(batch) >= ORDER_EXPORT_BATCH_SIZE:
+            await couriers.resolve(batch)
+            yield [format_order_export_row(order, couriers) for order in batch]
+            batch = []
+    if batch:
+        await couriers.resolve(batch)
+        yield [format_order_export_row(order, couriers) for order in batch]
+
+async def stream_orders_csv(query: dict):
+    """CSV body as encoded chunks, one per cursor batch, memory stays at one batch"""
+    import csv
+    import io
+    
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(ORDER_EXPORT_COLUMNS)
+    yield buffer.getvalue().encode("utf-8")
+    
+    async for rows in iter_order_export_rows(query):
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(rows)
+        yield buffer.getvalue().encode("utf-8")
+
+def new_export_spool_path(suffix: str) -> str:
+    handle, path = tempfile.mkstemp(prefix="export-", suffix=suffix)
+    os.close(handle)
+    return path
+
+# Tells the xlsx writer thread to stop without saving the workbook
+XLSX_ABORT = object()
+
+def write_xlsx_rows(path: str, next_batch):
+    """Runs in a worker thread, appends row batches from next_batch() until None arrives.
+
+    openpyxl's write-only mode streams rows to disk, so memory stays at the queued batches.
+    """
+    from openpyxl import Workbook
+    
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet("Ordini")
+    sheet.append(ORDER_EXPORT_COLUMNS)
+    while (batch := next_batch()) is not None:
+        if batch is XLSX_ABORT:
+            return
+        for row in batch:
+            sheet.append(row)
+    workbook.save(path)
+
+async def put_for_thread(rows: asyncio.Queue, item, worker: asyncio.Future):
+    """Hand an item to a consumer thread, waiting for room in its queue or for the thread to fail"""
+    if not rows.full():
+        rows.put_nowait(item)
+        return
+    put = asyncio.ensure_future(rows.put(item))
+    await asyncio.wait([put, worker], return_when=asyncio.FIRST_COMPLETED)
+    if not put.done():
+        # The thread stopped early, surface its error
+        put.cancel()
+        await worker
+
+async def write_orders_xlsx(query: dict, path: str, progress=None) -> int:
+    """Write the order export as an xlsx file at path and return the number of rows"""
+    loop = asyncio.get_running_loop()
+    rows = asyncio.Queue(maxsize=ORDER_EXPORT_XLSX_QUEUE_BATCHES)
     
-    if date_from or date_to:
-        date_query = {}
-        if date_from:
-            date_query["$gte"] = datetime.fromisoformat(date_from.replace('Z', '+00:00'))
-        if date_to:
-            date_query["$lte"] = datetime.fromisoformat(date_to.replace('Z', '+00:00'))
-        query["created_at"] = date_query
+    def next_batch():
+        # Called from the writer thread, blocks it until the event loop hands over a batch
+        return asyncio.run_coroutine_threadsafe(rows.get(), loop).result()
     
-    orders = await db.orders.find(query).sort("created_at", -1).to_list(1000)
-    return [Order(**order) for order in orders]
+    writer = asyncio.ensure_future(asyncio.to_thread(write_xlsx_rows, path, next_batch))
+    written = 0
+    try:
+        async for batch in iter_order_export_rows(query):
+            await put_for_thread(rows, batch, writer)
+            written += len(batch)
+            if progress:
+                await progress(written)
+        await put_for_thread(rows, None, writer)
+        await writer
+    except BaseException:
+        # Drop what is queued and wait for the thread to stop, the caller removes the file next
+        while not rows.empty():
+            rows.get_nowait()
+        rows.put_nowait(XLSX_ABORT)
+        await asyncio.wait([writer])
+        raise
+    return written
 
 @api_router.get("/orders/export")
 async def export_orders(
@@ -850,93 +3497,448 @@ async def export_orders(
     date_from: Optional[str] = None,
     date_to: Optional[str] = None,
     status: Optional[str] = None,
-    format: str = "excel"
+    format: str = "excel",
+    q: Optional[str] = None
 ):
     """Export orders to Excel or CSV"""
     # Use same query logic as search
-    query = {"company_id": current_user.company_id}
-    
-    if customer_name:
-        query["customer_name"] = {"$regex": customer_name, "$options": "i"}
-    
-    if courier_id:
-        query["courier_id"] = courier_id
-    
-    if status:
-        query["status"] = status
-    
-    if date_from or date_to:
-        date_query = {}
-        if date_from:
-            date_query["$gte"] = datetime.fromisoformat(date_from.replace('Z', '+00:00'))
-        if date_to:
-            date_query["$lte"] = datetime.fromisoformat(date_to.replace('Z', '+00:00'))
-        query["created_at"] = date_query
-    
-    orders = await db.orders.find(query).sort("created_at", -1).to_list(1000)
-    
-    # Get courier names
-    courier_ids = [order.get("courier_id") for order in orders if order.get("courier_id")]
-    couriers = await db.users.find({"id": {"$in": courier_ids}}).to_list(1000)
-    courier_map = {c["id"]: c["username"] for c in couriers}
-    
-    # Prepare data for export
-    export_data = []
-    for order in orders:
-        export_data.append({
-            "Cliente": order["customer_name"],
-            "Indirizzo": order["delivery_address"],
-            "Telefono": order["phone_number"],
-            "Numero Riferimento": order.get("reference_number", ""),
-            "Corriere": courier_map.get(order.get("courier_id"), "Non assegnato"),
-            "Stato": order["status"].title(),
-            "Data Creazione": order["created_at"].strftime("%d/%m/%Y %H:%M"),
-            "Data Consegna": order.get("delivered_at").strftime("%d/%m/%Y %H:%M") if order.get("delivered_at") else ""
-        })
+    query = build_order_search_query(
+        current_user.company_id, customer_name, courier_id, date_from, date_to, status, q
+    )
     
     if format == "excel":
-        import pandas as pd
-        import io
-        from fastapi.responses import StreamingResponse
+        from fastapi.responses import FileResponse
+        from starlette.background import BackgroundTask
         
-        df = pd.DataFrame(export_data)
-        output = io.BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            df.to_excel(writer, sheet_name='Ordini', index=False)
-        output.seek(0)
+        path = new_export_spool_path(".xlsx")
+        try:
+            await write_orders_xlsx(query, path)
+        except BaseException:
+            os.unlink(path)
+            raise
         
-        return StreamingResponse(
-            io.BytesIO(output.read()),
+        return FileResponse(
+            path,
             media_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-            headers={"Content-Disposition": "attachment; filename=ordini.xlsx"}
+            filename="ordini.xlsx",
+            background=BackgroundTask(os.unlink, path)
         )
     else:
         # CSV format
-        import csv
-        import io
         from fastapi.responses import StreamingResponse
         
-        output = io.StringIO()
-        if export_data:
-            writer = csv.DictWriter(output, fieldnames=export_data[0].keys())
-            writer.writeheader()
-            writer.writerows(export_data)
-        
         return StreamingResponse(
-            io.StringIO(output.getvalue()),
+            stream_orders_csv(query),
             media_type='text/csv',
             headers={"Content-Disposition": "attachment; filename=ordini.csv"}
         )
 
+# Export jobs
+EXPORT_JOB_DIR = Path(os.environ.get('EXPORT_JOB_DIR', str(ROOT_DIR / 'exports')))
+EXPORT_JOB_WORKERS = int(os.environ.get('EXPORT_JOB_WORKERS', '2'))
+EXPORT_JOB_MAX_RUNNING_PER_COMPANY = int(os.environ.get('EXPORT_JOB_MAX_RUNNING_PER_COMPANY', '1'))
+EXPORT_JOB_MAX_QUEUED_PER_COMPANY = int(os.environ.get('EXPORT_JOB_MAX_QUEUED_PER_COMPANY', '5'))
+EXPORT_JOB_MAX_ATTEMPTS = int(os.environ.get('EXPORT_JOB_MAX_ATTEMPTS', '3'))
+EXPORT_JOB_LEASE_SECONDS = float(os.environ.get('EXPORT_JOB_LEASE_SECONDS', '120'))
+EXPORT_JOB_POLL_SECONDS = float(os.environ.get('EXPORT_JOB_POLL_SECONDS', '2'))
+EXPORT_JOB_TTL_HOURS = float(os.environ.get('EXPORT_JOB_TTL_HOURS', '24'))
+EXPORT_JOB_CLEANUP_SECONDS = float(os.environ.get('EXPORT_JOB_CLEANUP_SECONDS', '600'))
+EXPORT_DOWNLOAD_CHUNK_SIZE = 64 * 1024
+EXPORT_FORMATS = {
+    "csv": ("csv", "text/csv"),
+    "excel": ("xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+}
+
+async def write_orders_csv(query: dict, path: str, progress=None) -> int:
+    """Write the order export as a CSV file at path and return the number of rows"""
+    import csv
+    import io
+    
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    written = 0
+    with open(path, "w", encoding="utf-8", newline="") as output:
+        writer.writerow(ORDER_EXPORT_COLUMNS)
+        output.write(buffer.getvalue())
+        async for rows in iter_order_export_rows(query):
+            buffer.seek(0)
+            buffer.truncate()
+            writer.writerows(rows)
+            await asyncio.to_thread(output.write, buffer.getvalue())
+            written += len(rows)
+            if progress:
+                await progress(written)
+    return written
+
+class ExportLeaseLost(Exception):
+    """The job's lease expired and another worker claimed it"""
+
+def export_job_path(job: dict) -> Path:
+    return EXPORT_JOB_DIR / f"{job['id']}.{EXPORT_FORMATS[job['format']][0]}"
+
+def export_job_view(job: dict) -> dict:
+    total = job.get("total_rows")
+    return {
+        "id": job["id"],
+        "status": job["status"],
+        "format": job["format"],
+        "filters": job["filters"],
+        "rows_written": job.get("rows_written", 0),
+        "total_rows": total,
+        "progress": round(min(job.get("rows_written", 0) / total, 1) * 100, 1) if total else (100.0 if job["status"] == "done" else 0.0),
+        "size": job.get("size"),
+        "error": job.get("error"),
+        "created_at": job["created_at"].isoformat(),
+        "started_at": job["started_at"].isoformat() if job.get("started_at") else None,
+        "finished_at": job["finished_at"].isoformat() if job.get("finished_at") else None,
+        "expires_at": job["expires_at"].isoformat() if job.get("expires_at") else None,
+        "download_url": f"/api/exports/{job['id']}/download" if job["status"] == "done" else None
+    }
+
+class ExportJobRunner:
+    """Runs queued export jobs from db.export_jobs into files under EXPORT_JOB_DIR.
+
+    Jobs are claimed with a lease that is renewed as rows are written, so a job
+    whose process died is picked up again. Each claim gets its own lease_token;
+    renewals and the final update only apply while the token still matches, and
+    a worker that finds its lease taken over abandons its partial file. A company never has more than
+    EXPORT_JOB_MAX_RUNNING_PER_COMPANY jobs running, the check is per claim and
+    can be exceeded by one when several processes claim at the same moment.
+    Files live on local disk, processes sharing a job collection must share it.
+    """
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self._tasks = []
+        self._cleanup_task = None
+        self._wakeup = asyncio.Event()
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.expired = 0
+
+    async def submit(self, company_id: str, user_id: str, export_format: str, filters: dict) -> dict:
+        queued = await db.export_jobs.count_documents(
+            {"company_id": company_id, "status": {"$in": ["queued", "running"]}}
+        )
+        if queued >= EXPORT_JOB_MAX_QUEUED_PER_COMPANY:
+            raise HTTPException(
+                status_code=429,
+                detail=f"At most {EXPORT_JOB_MAX_QUEUED_PER_COMPANY} exports can be pending, wait for one to finish"
+            )
+        now = datetime.now(timezone.utc)
+        job = {
+            "id": str(uuid.uuid4()),
+            "company_id": company_id,
+            "user_id": user_id,
+            "format": export_format,
+            "filters": filters,
+            "status": "queued",
+            "attempts": 0,
+            "rows_written": 0,
+            "total_rows": None,
+            "lease_expires_at": None,
+            "created_at": now,
+            "updated_at": now
+        }
+        await db.export_jobs.insert_one(job)
+        self._wakeup.set()
+        return job
+
+    async def _claim(self):
+        now = datetime.now(timezone.utc)
+        busy = await db.export_jobs.aggregate([
+            {"$match": {"status": "running", "lease_expires_at": {"$gt": now}}},
+            {"$group": {"_id": "$company_id", "count": {"$sum": 1}}}
+        ]).to_list(None)
+        full = [row["_id"] for row in busy if row["count"] >= EXPORT_JOB_MAX_RUNNING_PER_COMPANY]
+        return await db.export_jobs.find_one_and_update(
+            {"$or": [
+                {"status": "queued"},
+                {"status": "running", "lease_expires_at": {"$lte": now}}
+            ], "company_id": {"$nin": full}},
+            {"$set": {
+                "status": "running",
+                "started_at": now,
+                "lease_token": str(uuid.uuid4()),
+                "lease_expires_at": now + timedelta(seconds=EXPORT_JOB_LEASE_SECONDS),
+                "updated_at": now
+            },
+             "$inc": {"attempts": 1}},
+            sort=[("created_at", 1)],
+            projection={"_id": 0},
+            return_document=ReturnDocument.AFTER
+        )
+
+    def _owned(self, job: dict) -> dict:
+        return {"id": job["id"], "lease_token": job["lease_token"]}
+
+    async def _update_owned(self, job: dict, fields: dict):
+        result = await db.export_jobs.update_one(self._owned(job), {"$set": fields})
+        if result.matched_count == 0:
+            raise ExportLeaseLost(job["id"])
+
+    async def _finish(self, job: dict, update: dict):
+        now = datetime.now(timezone.utc)
+        await self._update_owned(job, {**update, "finished_at": now, "updated_at": now, "lease_expires_at": None})
+
+    async def _process(self, job: dict):
+        if job["attempts"] > EXPORT_JOB_MAX_ATTEMPTS:
+            self.failed += 1
+            await self._finish(job, {"status": "failed", "error": "Export did not complete after several attempts"})
+            return
+        
+        path = export_job_path(job)
+        # Per claim, so a worker that lost its lease never writes into the new owner's file
+        partial = path.with_suffix(f"{path.suffix}.{job['lease_token']}.part")
+        
+        async def progress(written: int):
+            await self._update_owned(job, {
+                "rows_written": written,
+                "lease_expires_at": datetime.now(timezone.utc) + timedelta(seconds=EXPORT_JOB_LEASE_SECONDS)
+            })
+        
+        try:
+            query = build_order_search_query(job["company_id"], **job["filters"])
+            total = await db.orders.count_documents(query)
+            await self._update_owned(job, {"total_rows": total, "rows_written": 0})
+            
+            write = write_orders_csv if job["format"] == "csv" else write_orders_xlsx
+            written = await write(query, str(partial), progress)
+            os.replace(partial, path)
+        except ExportLeaseLost:
+            partial.unlink(missing_ok=True)
+            print(f"⚠️ Export job {job['id']} was taken over by another worker, abandoning it")
+            return
+        except Exception as e:
+            partial.unlink(missing_ok=True)
+            self.failed += 1
+            print(f"❌ Export job {job['id']} failed: {str(e)}")
+            await self._finish(job, {"status": "failed", "error": str(e)})
+            return
+        
+        self.completed += 1
+        await self._finish(job, {
+            "status": "done",
+            "rows_written": written,
+            "size": path.stat().st_size,
+            "expires_at": datetime.now(timezone.utc) + timedelta(hours=EXPORT_JOB_TTL_HOURS)
+        })
+
+    async def _worker(self):
+        while True:
+            try:
+                job = await self._claim()
+            except Exception as e:
+                print(f"⚠️ Export job claim failed: {str(e)}")
+                job = None
+            
+            if job is None:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), EXPORT_JOB_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                continue
+            
+            self.running += 1
+            try:
+                await self._process(job)
+            except ExportLeaseLost:
+                print(f"⚠️ Export job {job['id']} was taken over by another worker before it finished")
+            except Exception as e:
+                # Leave the lease in place, the job is claimed again once it expires
+                print(f"❌ Export job {job['id']} crashed: {str(e)}")
+            finally:
+                self.running -= 1
+            # A finished job may have freed a per-company slot for another worker
+            self._wakeup.set()
+
+    async def cleanup(self) -> int:
+        """Delete the files of expired jobs and leftovers no job refers to anymore"""
+        now = datetime.now(timezone.utc)
+        removed = 0
+        async for job in db.export_jobs.find(
+            {"status": "done", "expires_at": {"$lte": now}}, {"_id": 0, "id": 1, "format": 1}
+        ):
+            export_job_path(job).unlink(missing_ok=True)
+            await db.export_jobs.update_one(
+                {"id": job["id"]},
+                {"$set": {"status": "expired", "purge_at": now + timedelta(days=7), "updated_at": now}}
+            )
+            removed += 1
+        
+        # Partial files of crashed jobs and files whose job was purged
+        stale_before = time.time() - EXPORT_JOB_TTL_HOURS * 3600 - EXPORT_JOB_LEASE_SECONDS
+        for path in EXPORT_JOB_DIR.iterdir():
+            if path.is_file() and path.stat().st_mtime < stale_before:
+                path.unlink(missing_ok=True)
+        
+        self.expired += removed
+        return removed
+
+    async def _run_cleanup(self):
+        while True:
+            try:
+                await self.cleanup()
+            except Exception as e:
+                print(f"⚠️ Export cleanup failed: {str(e)}")
+            await asyncio.sleep(EXPORT_JOB_CLEANUP_SECONDS)
+
+    def start(self):
+        if self._tasks:
+            return
+        EXPORT_JOB_DIR.mkdir(parents=True, exist_ok=True)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._cleanup_task = asyncio.create_task(self._run_cleanup())
+
+    async def stop(self):
+        # Running jobs keep their lease and are resumed by the next process once it expires
+        for task in self._tasks + [self._cleanup_task]:
+            if task is not None:
+                task.cancel()
+        self._tasks = []
+        self._cleanup_task = None
+
+    def stats(self) -> dict:
+        return {
+            "workers": len(self._tasks),
+            "running": self.running,
+            "completed": self.completed,
+            "failed": self.failed,
+            "expired": self.expired,
+            "max_running_per_company": EXPORT_JOB_MAX_RUNNING_PER_COMPANY
+        }
+
+export_jobs = ExportJobRunner(EXPORT_JOB_WORKERS)
+
+def parse_range_header(header: Optional[str], size: int) -> Optional[tuple]:
+    """Inclusive (start, end) of a single "bytes=" range, None for the whole file"""
+    if not header:
+        return None
+    try:
+        unit, ranges = header.split("=", 1)
+        if unit.strip() != "bytes" or "," in ranges:
+            raise ValueError
+        start, end = ranges.strip().split("-", 1)
+        if start:
+            start = int(start)
+            end = min(int(end), size - 1) if end else size - 1
+        else:
+            # Suffix range, the last N bytes
+            start, end = max(size - int(end), 0), size - 1
+    except ValueError:
+        raise HTTPException(status_code=416, detail="Invalid range", headers={"Content-Range": f"bytes */{size}"})
+    if start > end or start >= size:
+        raise HTTPException(status_code=416, detail="Range not satisfiable", headers={"Content-Range": f"bytes */{size}"})
+    return start, end
+
+async def iter_file_range(path: Path, start: int, end: int):
+    with open(path, "rb") as source:
+        source.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = await asyncio.to_thread(source.read, min(EXPORT_DOWNLOAD_CHUNK_SIZE, remaining))
+            if not chunk:
+                return
+            remaining -= len(chunk)
+            yield chunk
+
+async def get_company_export_job(job_id: str, company_id: str) -> dict:
+    job = await db.export_jobs.find_one({"id": job_id, "company_id": company_id}, {"_id": 0})
+    if not job:
+        raise HTTPException(status_code=404, detail="Export not found")
+    return job
+
+@api_router.post("/exports/orders", status_code=202)
+async def create_order_export_job(
+    request: CreateExportJobRequest,
+    current_user: User = Depends(require_role([UserRole.COMPANY_ADMIN]))
+):
+    """Queue an order export with the same filters as /orders/search"""
+    if request.format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail="Format must be csv or excel")
+    filters = request.dict(exclude={"format"})
+    try:
+        # Reject bad filters now rather than in a failed job
+        build_order_search_query(current_user.company_id, **filters)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid date filter")
+    
+    job = await export_jobs.submit(current_user.company_id, current_user.id, request.format, filters)
+    return export_job_view(job)
+
+@api_router.get("/exports")
+async def list_export_jobs(
+    current_user: User = Depends(require_role([UserRole.COMPANY_ADMIN]))
+):
+    jobs = await db.export_jobs.find(
+        {"company_id": current_user.company_id}, {"_id": 0}
+    ).sort("created_at", -1).to_list(50)
+    return [export_job_view(job) for job in jobs]
+
+@api_router.get("/exports/{job_id}")
+async def get_export_job(
+    job_id: str,
+    current_user: User = Depends(require_role([UserRole.COMPANY_ADMIN]))
+):
+    return export_job_view(await get_company_export_job(job_id, current_user.company_id))
+
+@api_router.get("/exports/{job_id}/download")
+async def download_export_job(
+    job_id: str,
+    request: Request,
+    current_user: User = Depends(require_role([UserRole.COMPANY_ADMIN]))
+):
+    """Download a finished export, supports single byte ranges to resume interrupted downloads"""
+    from fastapi.responses import StreamingResponse
+    
+    job = await get_company_export_job(job_id, current_user.company_id)
+    if job["status"] == "expired":
+        raise HTTPException(status_code=410, detail="Export expired")
+    if job["status"] != "done":
+        raise HTTPException(status_code=409, detail="Export is not ready yet")
+    
+    path = export_job_path(job)
+    if not path.exists():
+        raise HTTPException(status_code=410, detail="Export file is no longer available")
+    
+    size = path.stat().st_size
+    extension, media_type = EXPORT_FORMATS[job["format"]]
+    headers = {
+        "Accept-Ranges": "bytes",
+        "Content-Disposition": f"attachment; filename=ordini-{job['created_at'].strftime('%Y%m%d-%H%M')}.{extension}"
+    }
+    byte_range = parse_range_header(request.headers.get("range"), size)
+    if byte_range is None:
+        start, end, status_code = 0, size - 1, 200
+    else:
+        (start, end), status_code = byte_range, 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+    
+    return StreamingResponse(
+        iter_file_range(path, start, end), status_code=status_code, media_type=media_type, headers=headers
+    )
+
 @api_router.get("/orders", response_model=List[Order])
 async def get_orders(
+    request: Request,
+    response: Response,
+    page: PageParams = Depends(),
     current_user: User = Depends(require_role([UserRole.COMPANY_ADMIN]))
 ):
-    orders = await db.orders.find({
-        "company_id": current_user.company_id
-    }).to_list(1000)
+    etag, cached = await conditional_get(request, response, company_scope(current_user.company_id))
+    if cached:
+        return cached
     
-    return [Order(**order) for order in orders]
+    query = {"company_id": current_user.company_id}
+    if wants_ndjson(request):
+        return await ndjson_response(Order, db.orders, query, page, "created_at", 1, ORDER_PROJECTION, response=response)
+    
+    orders = await fetch_page(db.orders, query, page, response, "created_at", 1, ORDER_PROJECTION)
+    
+    return response_cache.put(etag, model_list_response(Order, orders, response))
 
 @api_router.delete("/orders/{order_id}")
 async def delete_order(
@@ -957,6 +3959,7 @@ async def delete_order(
     
     # Delete order
     await db.orders.delete_one({"id": order_id})
+    await bump_change_versions(current_user.company_id, [order.get("courier_id")])
     
     return {"message": "Order deleted successfully"}
 
@@ -997,9 +4000,138 @@ async def assign_order(
             "status": "assigned"
         }}
     )
+    await bump_change_versions(current_user.company_id, [order.get("courier_id"), request.courier_id])
     
     return {"message": "Order assigned successfully"}
 
+# Bulk order updates
+BULK_ORDER_MAX_IDS = int(os.environ.get('BULK_ORDER_MAX_IDS', '1000'))
+# Target status -> statuses it can be reached from, delivered orders never change
+ORDER_STATUS_TRANSITIONS = {
+    "assigned": {"in_progress"},
+    "in_progress": {"assigned"},
+    "delivered": {"assigned", "in_progress"}
+}
+
+async def bulk_update_orders(company_id: str, order_ids: List[str], allowed_statuses: set,
+                             update: dict, rejection: str) -> tuple:
+    """Update the orders in allowed_statuses and report an outcome per id.
+
+    Returns (results in request order, documents of the updated orders). The updates
+    go out as one unordered bulk_write, each conditional on the status and courier the
+    order was read with, so an order that changed in between matches nothing and is
+    reported as a conflict instead of being overwritten. The bulk result only has
+    totals, the updated orders are the ones a read-back finds in the requested state.
+    """
+    ids = list(dict.fromkeys(order_ids))
+    if not ids:
+        raise HTTPException(status_code=400, detail="No orders given")
+    if len(ids) > BULK_ORDER_MAX_IDS:
+        raise HTTPException(status_code=400, detail=f"At most {BULK_ORDER_MAX_IDS} orders per request")
+    
+    orders = {
+        order["id"]: order
+        async for order in db.orders.find({"id": {"$in": ids}, "company_id": company_id}, {"_id": 0})
+    }
+    outcomes = {}
+    eligible = []
+    for order_id in ids:
+        order = orders.get(order_id)
+        if not order:
+            outcomes[order_id] = {"outcome": "not_found", "detail": "Order not found"}
+        elif order["status"] not in allowed_statuses:
+            outcomes[order_id] = {"outcome": "rejected", "detail": rejection.format(status=order["status"])}
+        else:
+            eligible.append(order_id)
+    
+    updated_ids = set()
+    if eligible:
+        await db.orders.bulk_write([
+            UpdateOne(
+                {
+                    "id": order_id,
+                    "company_id": company_id,
+                    "status": orders[order_id]["status"],
+                    "courier_id": orders[order_id].get("courier_id")
+                },
+                {"$set": update}
+            )
+            for order_id in eligible
+        ], ordered=False)
+        updated_ids = {
+            order["id"]
+            async for order in db.orders.find(
+                {"id": {"$in": eligible}, "company_id": company_id, **update}, {"_id": 0, "id": 1}
+            )
+        }
+    for order_id in eligible:
+        outcomes[order_id] = (
+            {"outcome": "updated"} if order_id in updated_ids
+            else {"outcome": "conflict", "detail": "Order changed while updating, retry"}
+        )
+    
+    results = [{"order_id": order_id, **outcomes[order_id]} for order_id in ids]
+    return results, [orders[order_id] for order_id in ids if order_id in updated_ids]
+
+@api_router.patch("/orders/bulk-assign")
+async def bulk_assign_orders(
+    request: BulkAssignOrdersRequest,
+    current_user: User = Depends(require_role([UserRole.COMPANY_ADMIN]))
+):
+    """Assign, reassign or (without courier_id) unassign many orders at once"""
+    if request.courier_id is not None:
+        courier = await db.users.find_one({
+            "id": request.courier_id,
+            "company_id": current_user.company_id,
+            "role": UserRole.COURIER,
+            "is_active": True
+        }, {"_id": 0, "id": 1})
+        if not courier:
+            raise HTTPException(status_code=404, detail="Courier not found or inactive")
+        update = {"courier_id": request.courier_id, "status": "assigned"}
+    else:
+        update = {"courier_id": None, "status": "pending"}
+    
+    results, updated = await bulk_update_orders(
+        current_user.company_id, request.order_ids, {"pending", "assigned", "in_progress"}, update,
+        "Cannot reassign {status} orders"
+    )
+    if updated:
+        await bump_change_versions(
+            current_user.company_id, [order.get("courier_id") for order in updated] + [request.courier_id]
+        )
+    return {"updated": len(updated), "results": results}
+
+@api_router.patch("/orders/bulk-status")
+async def bulk_update_order_status(
+    request: BulkOrderStatusRequest,
+    current_user: User = Depends(require_role([UserRole.COMPANY_ADMIN]))
+):
+    """Move many orders to a new status, customers of delivered orders are notified like mark-delivered"""
+    if request.status not in ORDER_STATUS_TRANSITIONS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Status must be one of: {', '.join(ORDER_STATUS_TRANSITIONS)}, use bulk-assign to assign or unassign"
+        )
+    
+    update = {"status": request.status}
+    if request.status == "delivered":
+        update["delivered_at"] = datetime.now(timezone.utc)
+    
+    results, updated = await bulk_update_orders(
+        current_user.company_id, request.order_ids, ORDER_STATUS_TRANSITIONS[request.status], update,
+        f"Cannot change {{status}} orders to {request.status}"
+    )
+    if updated:
+        await bump_change_versions(current_user.company_id, [order.get("courier_id") for order in updated])
+    
+    if request.status == "delivered":
+        for order in updated:
+            if order["phone_number"] and order["phone_number"].strip():
+                await queue_delivery_notification(order)
+    
+    return {"updated": len(updated), "results": results}
+
 @api_router.patch("/orders/{order_id}")
 async def update_order(
     order_id: str,
@@ -1026,12 +4158,14 @@ async def update_order(
             "customer_name": request.customer_name,
             "delivery_address": request.delivery_address,
             "phone_number": request.phone_number,
-            "reference_number": request.reference_number
+            "reference_number": request.reference_number,
+            **build_search_fields("orders", request.dict())
         }}
     )
     
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Order not found")
+    await bump_change_versions(current_user.company_id, [order.get("courier_id")])
     
     # If delivery address changed and order is assigned, suggest reassignment
     if (order["delivery_address"] != request.delivery_address and 
@@ -1062,46 +4196,77 @@ async def create_customer(
         notes=request.notes,
         company_id=current_user.company_id
     )
-    await db.customers.insert_one(customer.dict())
+    try:
+        await db.customers.insert_one({**customer.dict(), **build_search_fields("customers", customer.dict())})
+    except DuplicateKeyError:
+        # Lost a race against a concurrent create, answer like the check above would have
+        if await db.customers.find_one(
+            {"phone_number": request.phone_number, "company_id": current_user.company_id}, {"_id": 0, "id": 1}
+        ):
+            raise HTTPException(status_code=400, detail="Customer with this phone number already exists")
+        raise
+    await bump_change_versions(current_user.company_id)
     
     return {"message": "Customer created successfully", "customer": customer}
 
 @api_router.get("/customers", response_model=List[Customer])
 async def get_customers(
+    request: Request,
+    response: Response,
+    page: PageParams = Depends(),
     current_user: User = Depends(require_role([UserRole.COMPANY_ADMIN]))
 ):
-    customers = await db.customers.find({
-        "company_id": current_user.company_id
-    }).sort("name", 1).to_list(1000)
+    # Order writes bump the same version, so the order stats below can't go stale either
+    etag, cached = await conditional_get(request, response, company_scope(current_user.company_id))
+    if cached:
+        return cached
+    
+    query = {"company_id": current_user.company_id}
+    if wants_ndjson(request):
+        # Read-only: a GET stream should not fan out into customer writes per batch
+        return await ndjson_response(Customer, db.customers, query, page, "name", 1, CUSTOMER_PROJECTION,
+                                     prepare=load_customer_stats, response=response)
+    
+    customers = await fetch_page(db.customers, query, page, response, "name", 1, CUSTOMER_PROJECTION)
+    
+    await refresh_customer_stats(customers)
+    
+    return response_cache.put(etag, model_list_response(Customer, customers, response))
+
+async def load_customer_stats(customers: list) -> list:
+    """Fill in total_orders/last_order_date for a batch of customers in one aggregation.
+
+    Returns the updates for customers whose stored values were stale.
+    """
+    if not customers:
+        return []
     
-    # Update customer statistics
+    rows = await db.orders.aggregate([
+        {"$match": {"customer_id": {"$in": [customer["id"] for customer in customers]}}},
+        {"$group": {"_id": "$customer_id", "total_orders": {"$sum": 1}, "last_order_date": {"$max": "$created_at"}}}
+    ]).to_list(None)
+    stats = {row["_id"]: row for row in rows}
+    
+    now = datetime.now(timezone.utc)
+    operations = []
     for customer in customers:
-        # Count total orders
-        total_orders = await db.orders.count_documents({
-            "customer_id": customer["id"]
-        })
-        
-        # Get last order date
-        last_order = await db.orders.find_one(
-            {"customer_id": customer["id"]},
-            sort=[("created_at", -1)]
-        )
-        last_order_date = last_order["created_at"] if last_order else None
-        
-        # Update customer record
-        await db.customers.update_one(
-            {"id": customer["id"]},
-            {"$set": {
-                "total_orders": total_orders,
-                "last_order_date": last_order_date,
-                "updated_at": datetime.now(timezone.utc)
-            }}
-        )
-        
+        row = stats.get(customer["id"], {})
+        total_orders = row.get("total_orders", 0)
+        last_order_date = row.get("last_order_date")
+        if customer.get("total_orders") != total_orders or customer.get("last_order_date") != last_order_date:
+            operations.append(UpdateOne(
+                {"id": customer["id"]},
+                {"$set": {"total_orders": total_orders, "last_order_date": last_order_date, "updated_at": now}}
+            ))
         customer["total_orders"] = total_orders
         customer["last_order_date"] = last_order_date
-    
-    return [Customer(**customer) for customer in customers]
+    return operations
+
+async def refresh_customer_stats(customers: list):
+    """Recompute total_orders/last_order_date for a page of customers and store the stale ones"""
+    operations = await load_customer_stats(customers)
+    if operations:
+        await db.customers.bulk_write(operations, ordered=False)
 
 @api_router.get("/customers/search")
 async def search_customers(
@@ -1112,12 +4277,12 @@ async def search_customers(
     search_query = {"company_id": current_user.company_id}
     
     if query:
-        search_query["$or"] = [
-            {"name": {"$regex": query, "$options": "i"}},
-            {"phone_number": {"$regex": query, "$options": "i"}}
-        ]
+        search_query = compile_search_query(current_user.company_id, query, ("n", "p"))
     
-    customers = await db.customers.find(search_query).sort("name", 1).to_list(100)
+    try:
+        customers = await db.customers.find(search_query).sort("name", 1).max_time_ms(SEARCH_MAX_TIME_MS).to_list(100)
+    except ExecutionTimeout:
+        raise search_timeout()
     return [Customer(**customer) for customer in customers]
 
 @api_router.get("/customers/{customer_id}", response_model=Customer)
@@ -1167,10 +4332,13 @@ async def update_customer(
             "address": request.address,
             "email": request.email,
             "notes": request.notes,
-            "updated_at": datetime.now(timezone.utc)
+            "updated_at": datetime.now(timezone.utc),
+            **build_search_fields("customers", request.dict())
         }}
     )
     
+    await bump_change_versions(current_user.company_id)
+    
     return {"message": "Customer updated successfully"}
 
 @api_router.delete("/customers/{customer_id}")
@@ -1193,42 +4361,55 @@ async def delete_customer(
     
     # Delete customer
     await db.customers.delete_one({"id": customer_id})
+    await bump_change_versions(current_user.company_id)
     
     return {"message": "Customer deleted successfully"}
 
 @api_router.get("/customers/{customer_id}/orders", response_model=List[Order])
 async def get_customer_orders(
     customer_id: str,
+    request: Request,
+    response: Response,
+    page: PageParams = Depends(),
     current_user: User = Depends(require_role([UserRole.COMPANY_ADMIN]))
 ):
     # Verify customer belongs to same company
     customer = await db.customers.find_one({
         "id": customer_id,
         "company_id": current_user.company_id
-    })
+    }, {"_id": 0, "id": 1})
     if not customer:
         raise HTTPException(status_code=404, detail="Customer not found")
     
     # Get customer orders
-    orders = await db.orders.find({
-        "customer_id": customer_id
-    }).sort("created_at", -1).to_list(1000)
+    query = {"customer_id": customer_id}
+    if wants_ndjson(request):
+        return await ndjson_response(Order, db.orders, query, page, "created_at", -1, ORDER_PROJECTION)
     
-    return [Order(**order) for order in orders]
+    orders = await fetch_page(db.orders, query, page, response, "created_at", -1, ORDER_PROJECTION)
+    
+    return model_list_response(Order, orders, response)
 
 
 
 # Courier Routes
 @api_router.get("/courier/deliveries", response_model=List[Order])
 async def get_assigned_deliveries(
+    request: Request,
+    response: Response,
+    page: PageParams = Depends(),
     current_user: User = Depends(require_role([UserRole.COURIER]))
 ):
-    orders = await db.orders.find({
+    etag, cached = await conditional_get(request, response, courier_scope(current_user.id))
+    if cached:
+        return cached
+    
+    orders = await fetch_page(db.orders, {
         "courier_id": current_user.id,
         "status": {"$in": ["assigned", "in_progress"]}
-    }).to_list(1000)
+    }, page, response, "created_at", 1, ORDER_PROJECTION)
     
-    return [Order(**order) for order in orders]
+    return response_cache.put(etag, model_list_response(Order, orders, response))
 
 @api_router.patch("/courier/deliveries/mark-delivered")
 async def mark_delivery_completed(
@@ -1252,19 +4433,19 @@ async def mark_delivery_completed(
         {"id": request.order_id},
         {"$set": {
             "status": "delivered",
-            "delivered_at": datetime.now(timezone.utc),
-            "sms_sent": True
+            "delivered_at": datetime.now(timezone.utc)
         }}
     )
+    await bump_change_versions(order["company_id"], [current_user.id])
     
     # Send SMS notification only if phone number is provided
     if order["phone_number"] and order["phone_number"].strip():
-        message = f"Ciao {order['customer_name']}! 📦 La tua consegna è stata completata con successo all'indirizzo: {order['delivery_address']}. Grazie per aver scelto FarmyGo! 🚚"
-        await send_sms_notification(order["phone_number"], message, order.get("company_id"))
-    else:
-        print(f"📱 SMS skipped for order {request.order_id} - no phone number provided")
-
-    return {"message": "Delivery marked as completed and customer notified"}
+        await queue_delivery_notification(order)
+        # The outbox sends it later, sms_sent on the order tells when the provider accepted it
+        return {"message": "Delivery marked as completed, customer notification queued"}
+    
+    print(f"📱 SMS skipped for order {request.order_id} - no phone number provided")
+    return {"message": "Delivery marked as completed, no phone number to notify"}
 
 @api_router.get("/sms-logs")
 async def get_sms_logs(
@@ -1297,42 +4478,63 @@ async def get_sms_statistics(
     if month:
         query["month"] = month
     
-    # Get monthly stats
-    monthly_stats = await db.sms_monthly_stats.find(query).sort([("year", -1), ("month", -1)]).to_list(12)
+    # History, current month and year-to-date totals in one round trip, settings alongside
+    facets, cost_settings = await asyncio.gather(
+        db.sms_monthly_stats.aggregate([
+            {"$project": {"_id": 0}},
+            {"$facet": {
+                "history": [
+                    {"$match": query},
+                    {"$sort": {"year": -1, "month": -1}},
+                    {"$limit": 12}
+                ],
+                "current_month": [
+                    {"$match": {"year": current_date.year, "month": current_date.month}},
+                    {"$limit": 1}
+                ],
+                "year_to_date": [
+                    {"$match": {"year": current_date.year}},
+                    {"$group": {
+                        "_id": None,
+                        "total_sms": {"$sum": "$total_sms_sent"},
+                        "total_cost": {"$sum": "$total_cost"},
+                        "successful_sms": {"$sum": "$successful_sms"},
+                        "coalesced_sms": {"$sum": "$coalesced_sms"},
+                        "saved_cost": {"$sum": "$saved_cost"}
+                    }}
+                ]
+            }}
+        ]).to_list(1),
+        get_sms_cost_settings()
+    )
+    facets = facets[0]
     
-    # Convert datetime objects and ObjectIds
+    # Convert datetime objects
+    monthly_stats = facets["history"]
     for stats in monthly_stats:
-        if '_id' in stats:
-            stats['_id'] = str(stats['_id'])
         stats["created_at"] = stats["created_at"].isoformat()
         stats["updated_at"] = stats["updated_at"].isoformat()
     
-    # Get current month stats
-    current_month_stats = await db.sms_monthly_stats.find_one({
-        "year": current_date.year,
-        "month": current_date.month
-    })
-    
+    current_month_stats = facets["current_month"][0] if facets["current_month"] else None
     if current_month_stats:
-        if '_id' in current_month_stats:
-            current_month_stats['_id'] = str(current_month_stats['_id'])
         current_month_stats["created_at"] = current_month_stats["created_at"].isoformat()
         current_month_stats["updated_at"] = current_month_stats["updated_at"].isoformat()
     
     # Calculate year-to-date totals
-    ytd_stats = await db.sms_monthly_stats.find({"year": current_date.year}).to_list(None)
-    ytd_total_sms = sum(stats["total_sms_sent"] for stats in ytd_stats)
-    ytd_total_cost = sum(stats["total_cost"] for stats in ytd_stats)
-    ytd_success_rate = sum(stats["successful_sms"] for stats in ytd_stats) / max(ytd_total_sms, 1) * 100
-    
-    # Get cost settings
-    cost_settings = await get_sms_cost_settings()
+    ytd = facets["year_to_date"][0] if facets["year_to_date"] else {
+        "total_sms": 0, "total_cost": 0, "successful_sms": 0, "coalesced_sms": 0, "saved_cost": 0
+    }
+    ytd_total_sms = ytd["total_sms"]
+    ytd_total_cost = ytd["total_cost"]
+    ytd_success_rate = ytd["successful_sms"] / max(ytd_total_sms, 1) * 100
     
     # Get company breakdown for current month
     companies_with_names = {}
     if current_month_stats and current_month_stats.get("companies_breakdown"):
         company_ids = list(current_month_stats["companies_breakdown"].keys())
-        companies = await db.companies.find({"id": {"$in": company_ids}}).to_list(None)
+        companies = await db.companies.find(
+            {"id": {"$in": company_ids}}, {"_id": 0, "id": 1, "name": 1}
+        ).to_list(None)
         
         # Create a map of found companies
         found_companies = {company["id"]: company for company in companies}
@@ -1357,7 +4559,9 @@ async def get_sms_statistics(
         "year_to_date": {
             "total_sms": ytd_total_sms,
             "total_cost": ytd_total_cost,
-            "success_rate": round(ytd_success_rate, 1)
+            "success_rate": round(ytd_success_rate, 1),
+            "coalesced_sms": ytd["coalesced_sms"],
+            "saved_cost": ytd["saved_cost"]
         },
         "cost_settings": cost_settings,
         "companies_breakdown": companies_with_names
@@ -1379,11 +4583,13 @@ async def update_sms_cost_settings(
         "updated_by": current_user.id
     }
     
-    await db.sms_cost_settings.update_one(
+    updated = await db.sms_cost_settings.find_one_and_update(
         {},
-        {"$set": settings},
-        upsert=True
+        {"$set": settings, "$inc": {"version": 1}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
     )
+    sms_cost_settings_cache.set(updated)
     
     return {"message": "SMS cost settings updated successfully", "settings": settings}
 
@@ -1404,28 +4610,22 @@ async def get_monthly_sms_report(
     if '_id' in monthly_stats:
         monthly_stats['_id'] = str(monthly_stats['_id'])
     
-    # Get daily SMS logs for the month
-    from calendar import monthrange
-    start_date = datetime(year, month, 1, tzinfo=timezone.utc)
-    days_in_month = monthrange(year, month)[1]
-    end_date = datetime(year, month, days_in_month, 23, 59, 59, tzinfo=timezone.utc)
-    
-    daily_logs = await db.sms_logs.find({
-        "sent_at": {"$gte": start_date, "$lte": end_date}
-    }).sort("sent_at", 1).to_list(None)
-    
-    # Group by day
-    daily_breakdown = {}
-    for log in daily_logs:
-        day = log["sent_at"].day
-        if day not in daily_breakdown:
-            daily_breakdown[day] = {"total": 0, "success": 0, "failed": 0}
-        
-        daily_breakdown[day]["total"] += 1
-        if log["status"] == "sent":
-            daily_breakdown[day]["success"] += 1
-        else:
-            daily_breakdown[day]["failed"] += 1
+    # Sum the per-company daily rollups, at most one row per day of the month
+    daily_rows = await db.sms_daily_stats.aggregate([
+        {"$match": {"year": year, "month": month}},
+        {"$group": {
+            "_id": "$day",
+            "total": {"$sum": "$total"},
+            "success": {"$sum": "$success"},
+            "failed": {"$sum": "$failed"}
+        }},
+        {"$sort": {"_id": 1}}
+    ]).to_list(None)
+    
+    daily_breakdown = {
+        row["_id"]: {"total": row["total"], "success": row["success"], "failed": row["failed"]}
+        for row in daily_rows
+    }
     
     # Convert datetime objects
     monthly_stats["created_at"] = monthly_stats["created_at"].isoformat()
@@ -1437,6 +4637,45 @@ async def get_monthly_sms_report(
         "period": f"{year}-{month:02d}"
     }
 
+@api_router.post("/super-admin/sms-daily-stats/backfill")
+async def backfill_sms_daily_stats_endpoint(
+    start_date: str,
+    end_date: Optional[str] = None,
+    current_user: User = Depends(require_role([UserRole.SUPER_ADMIN]))
+):
+    """Rebuild the daily SMS rollups from sms_logs (dates as YYYY-MM-DD, end defaults to yesterday)"""
+    try:
+        start_day = datetime.strptime(start_date, "%Y-%m-%d").date()
+        end_day = (
+            datetime.strptime(end_date, "%Y-%m-%d").date() if end_date
+            else datetime.now(timezone.utc).date() - timedelta(days=1)
+        )
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Dates must use the YYYY-MM-DD format")
+    
+    if start_day > end_day:
+        raise HTTPException(status_code=400, detail="start_date must not be after end_date")
+    
+    written = await backfill_sms_daily_stats(start_day, end_day)
+    
+    return {
+        "message": "SMS daily statistics rebuilt successfully",
+        "start_date": start_day.isoformat(),
+        "end_date": end_day.isoformat(),
+        "documents_written": written
+    }
+
+@api_router.post("/super-admin/sms-logs/archive")
+async def archive_sms_logs_endpoint(
+    current_user: User = Depends(require_role([UserRole.SUPER_ADMIN]))
+):
+    """Move SMS logs older than the hot retention window into the compressed archive"""
+    result = await sms_log_archiver.run_once()
+    if result is None:
+        raise HTTPException(status_code=409, detail="SMS log archiving is already running")
+    
+    return {"message": "SMS logs archived successfully", **result}
+
 @api_router.get("/super-admin/company-sms-history/{company_id}")
 async def get_company_sms_history(
     company_id: str,
@@ -1447,11 +4686,6 @@ async def get_company_sms_history(
     current_user: User = Depends(require_role([UserRole.SUPER_ADMIN]))
 ):
     """Get SMS history for a specific company for billing purposes"""
-    # Get company info
-    company = await db.companies.find_one({"id": company_id})
-    if not company:
-        raise HTTPException(status_code=404, detail="Company not found")
-    
     # Set default date range (last 12 months if not specified)
     current_date = datetime.now(timezone.utc)
     if not end_year or not end_month:
@@ -1464,28 +4698,63 @@ async def get_company_sms_history(
         start_year = start_date.year
         start_month = start_date.month
     
-    # Build query for monthly stats
-    monthly_stats = await db.sms_monthly_stats.find({
-        "$or": [
-            {"year": {"$gt": start_year}},
-            {"year": start_year, "month": {"$gte": start_month}},
-        ],
-        "$or": [
-            {"year": {"$lt": end_year}},
-            {"year": end_year, "month": {"$lte": end_month}},
-        ]
-    }).sort([("year", -1), ("month", -1)]).to_list(None)
+    start_date = datetime(start_year, start_month, 1, tzinfo=timezone.utc)
+    from calendar import monthrange
+    days_in_end_month = monthrange(end_year, end_month)[1]
+    end_date = datetime(end_year, end_month, days_in_end_month, 23, 59, 59, tzinfo=timezone.utc)
+    
+    breakdown_field = f"companies_breakdown.{company_id}"
+    company, monthly_stats, log_facets, cost_settings = await asyncio.gather(
+        db.companies.find_one({"id": company_id}, {"_id": 0, "id": 1, "name": 1}),
+        # Both range bounds must hold, and only months where the company sent SMS
+        db.sms_monthly_stats.find(
+            {"$and": [
+                {"$or": [
+                    {"year": {"$gt": start_year}},
+                    {"year": start_year, "month": {"$gte": start_month}},
+                ]},
+                {"$or": [
+                    {"year": {"$lt": end_year}},
+                    {"year": end_year, "month": {"$lte": end_month}},
+                ]},
+                {breakdown_field: {"$exists": True}}
+            ]},
+            {"_id": 0, "year": 1, "month": 1, "cost_per_sms": 1, "currency": 1, breakdown_field: 1}
+        ).sort([("year", -1), ("month", -1)]).to_list(None),
+        # Recent logs for the UI and the total count without loading every log
+        db.sms_logs.aggregate([
+            {"$match": {"company_id": company_id, "sent_at": {"$gte": start_date, "$lte": end_date}}},
+            {"$facet": {
+                "recent": [
+                    {"$sort": {"sent_at": -1}},
+                    {"$limit": 100},
+                    {"$project": {"_id": 0}}
+                ],
+                "total": [{"$count": "count"}]
+            }}
+        ]).to_list(1),
+        get_sms_cost_settings()
+    )
+    
+    if not company:
+        raise HTTPException(status_code=404, detail="Company not found")
     
     # Filter company data and calculate totals
     company_monthly_data = []
     total_sms = 0
     total_cost = 0
-    cost_settings = await get_sms_cost_settings()
+    total_saved_cost = 0
     
     for month_data in monthly_stats:
         if company_id in month_data.get("companies_breakdown", {}):
             company_stats = month_data["companies_breakdown"][company_id]
-            month_cost = company_stats["success"] * month_data.get("cost_per_sms", cost_settings["cost_per_sms"])
+            # Bill by segments; SMS recorded before segment accounting, including the part
+            # of the month before it was deployed, bill one segment each
+            billed_segments = (
+                company_stats.get("segments", 0)
+                + company_stats["success"] - company_stats.get("segmented", 0)
+            )
+            month_cost = billed_segments * month_data.get("cost_per_sms", cost_settings["cost_per_sms"])
             
             monthly_record = {
                 "year": month_data["year"],
@@ -1494,33 +4763,36 @@ async def get_company_sms_history(
                 "total_sms": company_stats["sent"],
                 "successful_sms": company_stats["success"],
                 "failed_sms": company_stats["failed"],
+                "billed_segments": billed_segments,
                 "cost_per_sms": month_data.get("cost_per_sms", cost_settings["cost_per_sms"]),
                 "total_cost": month_cost,
                 "success_rate": round((company_stats["success"] / company_stats["sent"]) * 100, 1) if company_stats["sent"] > 0 else 0,
-                "currency": month_data.get("currency", cost_settings["currency"])
+                "currency": month_data.get("currency", cost_settings["currency"]),
+                "coalesced_sms": company_stats.get("coalesced", 0),
+                "saved_cost": company_stats.get("coalesced", 0) * month_data.get("cost_per_sms", cost_settings["cost_per_sms"])
             }
             
             company_monthly_data.append(monthly_record)
             total_sms += company_stats["sent"]
             total_cost += month_cost
-    
-    # Get detailed SMS logs for the company in date range
-    start_date = datetime(start_year, start_month, 1, tzinfo=timezone.utc)
-    from calendar import monthrange
-    days_in_end_month = monthrange(end_year, end_month)[1]
-    end_date = datetime(end_year, end_month, days_in_end_month, 23, 59, 59, tzinfo=timezone.utc)
-    
-    sms_logs = await db.sms_logs.find({
-        "company_id": company_id,
-        "sent_at": {"$gte": start_date, "$lte": end_date}
-    }).sort("sent_at", -1).to_list(500)  # Limit to 500 recent logs
+            total_saved_cost += monthly_record["saved_cost"]
     
     # Convert datetime objects for JSON serialization
+    sms_logs = log_facets[0]["recent"]
     for log in sms_logs:
         log["sent_at"] = log["sent_at"].isoformat()
-        # Convert ObjectId to string for JSON serialization
-        if '_id' in log:
-            log['_id'] = str(log['_id'])
+    total_logs_count = log_facets[0]["total"][0]["count"] if log_facets[0]["total"] else 0
+    
+    # Ranges older than the hot window are served from the compressed archive
+    if start_date < sms_hot_cutoff():
+        archive_end = min(end_date, sms_hot_cutoff() - timedelta(microseconds=1))
+        archived_count, archived_logs = await asyncio.gather(
+            count_archived_sms_logs(company_id, start_date, archive_end),
+            load_archived_sms_logs(company_id, start_date, archive_end, 100 - len(sms_logs))
+            if len(sms_logs) < 100 else asyncio.sleep(0, result=[])
+        )
+        total_logs_count += archived_count
+        sms_logs.extend(archived_logs)
     
     return {
         "company": {
@@ -1535,13 +4807,56 @@ async def get_company_sms_history(
             "total_sms": total_sms,
             "total_cost": total_cost,
             "currency": cost_settings["currency"],
-            "months_count": len(company_monthly_data)
+            "months_count": len(company_monthly_data),
+            "saved_cost": total_saved_cost
         },
         "monthly_breakdown": company_monthly_data,
-        "recent_sms_logs": sms_logs[:100],  # Return only 100 most recent logs for UI
-        "total_logs_count": len(sms_logs)
+        "recent_sms_logs": sms_logs,  # Only the 100 most recent logs for UI
+        "total_logs_count": total_logs_count
     }
 
+# Runtime Diagnostics - Super Admin Only
+@api_router.get("/super-admin/runtime-stats")
+async def get_runtime_stats(
+    current_user: User = Depends(require_role([UserRole.SUPER_ADMIN]))
+):
+    """Get in-process cache and worker counters for this API worker"""
+    return {
+        "principal_cache": principal_cache.stats(),
+        "password_executor": password_executor.stats(),
+        "token_revocations": token_revocations.stats(),
+        "sms_outbox": await sms_outbox.stats(),
+        "sms_stats_aggregator": sms_stats_aggregator.stats(),
+        "sms_cost_settings_cache": sms_cost_settings_cache.stats(),
+        "sms_log_writer": sms_log_writer.stats(),
+        "sms_log_archiver": sms_log_archiver.stats(),
+        "ttl_store": ttl_store.stats(),
+        "export_jobs": export_jobs.stats(),
+        "response_cache": response_cache.stats()
+    }
+
+@api_router.get("/super-admin/indexes")
+async def get_index_report(
+    current_user: User = Depends(require_role([UserRole.SUPER_ADMIN]))
+):
+    """Compare the index registry with the database and report index usage"""
+    return await build_index_report()
+
+@api_router.post("/super-admin/indexes/ensure")
+async def apply_index_registry(
+    current_user: User = Depends(require_role([UserRole.SUPER_ADMIN]))
+):
+    """Create any declared index that is missing, then return the report"""
+    await ensure_indexes()
+    return await build_index_report()
+
+@api_router.post("/super-admin/search-index/backfill")
+async def run_search_index_backfill(
+    current_user: User = Depends(require_role([UserRole.SUPER_ADMIN]))
+):
+    """Build search_grams for orders and customers that don't have them yet"""
+    return await backfill_search_index(force=True)
+
 # Security Routes
 @api_router.get("/security/status")
 async def get_security_status(current_user: User = Depends(get_current_user)):
@@ -1569,7 +4884,7 @@ async def setup_pin(
     await db.user_security.update_one(
         {"user_id": current_user.id},
         {"$set": {
-            "pin_hash": hash_pin(request.pin),
+            "pin_hash": await hash_pin_async(request.pin),
             "pin_enabled": True,
             "updated_at": datetime.now(timezone.utc)
         }}
@@ -1588,7 +4903,7 @@ async def verify_pin_endpoint(
     if not security.pin_enabled or not security.pin_hash:
         raise HTTPException(status_code=400, detail="PIN not set up")
     
-    if not verify_pin(request.pin, security.pin_hash):
+    if not await verify_pin_async(request.pin, security.pin_hash):
         raise HTTPException(status_code=401, detail="Invalid PIN")
     
     return {"message": "PIN verified successfully"}
@@ -1602,20 +4917,19 @@ async def send_sms_code(
     # Generate 6-digit code
     code = generate_sms_code()
     
-    # Store code with expiration (5 minutes)
-    import time
-    sms_codes[request.phone_number] = {
+    # Store code with expiration (5 minutes); the entry outlives it so late attempts get a clear error
+    await ttl_store.set(f"sms_code_{request.phone_number}", {
         "code": code,
-        "expires_at": time.time() + 300,  # 5 minutes
+        "expires_at": time.time() + SMS_CODE_TTL_SECONDS,
         "user_id": current_user.id
-    }
+    }, SMS_CODE_TTL_SECONDS * 2)
     
     # Send SMS
     message = f"Il tuo codice di verifica FarmyGo è: {code}. Valido per 5 minuti."
-    success = await send_sms_notification(request.phone_number, message, current_user.company_id)
-    
-    if not success:
-        raise HTTPException(status_code=500, detail="Failed to send SMS")
+    await send_sms_notification(
+        request.phone_number, message, current_user.company_id,
+        kind="otp", priority=SMSPriority.OTP
+    )
     
     return {"message": "SMS code sent successfully"}
 
@@ -1625,16 +4939,14 @@ async def verify_sms_code(
     current_user: User = Depends(get_current_user)
 ):
     """Verify SMS code"""
-    import time
-    
-    if request.phone_number not in sms_codes:
+    code_key = f"sms_code_{request.phone_number}"
+    stored_code = await ttl_store.get(code_key)
+    if stored_code is None:
         raise HTTPException(status_code=400, detail="No SMS code sent to this number")
     
-    stored_code = sms_codes[request.phone_number]
-    
     # Check expiration
     if time.time() > stored_code["expires_at"]:
-        del sms_codes[request.phone_number]
+        await ttl_store.delete(code_key)
         raise HTTPException(status_code=400, detail="SMS code expired")
     
     # Check code
@@ -1646,7 +4958,7 @@ async def verify_sms_code(
         raise HTTPException(status_code=403, detail="SMS code not for this user")
     
     # Clean up
-    del sms_codes[request.phone_number]
+    await ttl_store.delete(code_key)
     
     # Enable SMS security for user
     await db.user_security.update_one(
@@ -1688,15 +5000,12 @@ async def generate_webauthn_registration_options(
         ),
     )
     
-    # Store challenge for verification
-    import time
-    import base64
+    # Store challenge for verification (5 minutes)
     challenge_key = f"webauthn_challenge_{current_user.id}"
-    sms_codes[challenge_key] = {
+    await ttl_store.set(challenge_key, {
         "challenge": base64.b64encode(options.challenge).decode('utf-8'),
-        "expires_at": time.time() + 300,  # 5 minutes
         "user_id": current_user.id
-    }
+    }, CHALLENGE_TTL_SECONDS)
     
     # Convert options to JSON-serializable format
     return {
@@ -1731,11 +5040,10 @@ async def verify_webauthn_registration(
     from webauthn.helpers.structs import RegistrationCredential
     
     challenge_key = f"webauthn_challenge_{current_user.id}"
-    if challenge_key not in sms_codes:
+    stored_challenge = await ttl_store.get(challenge_key)
+    if stored_challenge is None:
         raise HTTPException(status_code=400, detail="No registration challenge found")
     
-    stored_challenge = sms_codes[challenge_key]
-    
     try:
         # Convert request to proper format
         credential = RegistrationCredential.parse_raw(json.dumps(request.credential))
@@ -1767,7 +5075,7 @@ async def verify_webauthn_registration(
             )
             
             # Clean up challenge
-            del sms_codes[challenge_key]
+            await ttl_store.delete(challenge_key)
             
             return {"message": "Face ID/Touch ID registered successfully"}
         else:
@@ -1805,14 +5113,11 @@ async def generate_webauthn_authentication_options(
     )
     
     # Store challenge
-    import time
-    import base64
     challenge_key = f"webauthn_auth_challenge_{current_user.id}"
-    sms_codes[challenge_key] = {
+    await ttl_store.set(challenge_key, {
         "challenge": base64.b64encode(options.challenge).decode('utf-8'),
-        "expires_at": time.time() + 300,
         "user_id": current_user.id
-    }
+    }, CHALLENGE_TTL_SECONDS)
     
     # Convert options to JSON-serializable format
     return {
@@ -1843,10 +5148,9 @@ async def verify_webauthn_authentication(
     from webauthn.helpers.structs import AuthenticationCredential
     
     challenge_key = f"webauthn_auth_challenge_{current_user.id}"
-    if challenge_key not in sms_codes:
+    stored_challenge = await ttl_store.get(challenge_key)
+    if stored_challenge is None:
         raise HTTPException(status_code=400, detail="No authentication challenge found")
-    
-    stored_challenge = sms_codes[challenge_key]
     security = await get_user_security(current_user.id)
     
     # Find credential
@@ -1880,7 +5184,7 @@ async def verify_webauthn_authentication(
             )
             
             # Clean up challenge
-            del sms_codes[challenge_key]
+            await ttl_store.delete(challenge_key)
             
             return {"message": "Face ID/Touch ID verified successfully"}
         else:
@@ -1898,6 +5202,7 @@ app.add_middleware(
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "X-Total-Count", "ETag"],
 )
 
 # Configure logging
@@ -1907,10 +5212,35 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+index_bootstrap_task = None
+search_backfill_task = None
+
 @app.on_event("startup")
 async def startup_event():
+    global index_bootstrap_task, search_backfill_task
+    index_bootstrap_task = asyncio.create_task(ensure_indexes())
+    if SEARCH_BACKFILL_ON_STARTUP:
+        search_backfill_task = asyncio.create_task(backfill_search_index())
+    password_executor.start()
+    token_revocations.start()
+    ttl_store.start()
+    sms_log_writer.start()
+    asyncio.create_task(recover_pending_sms_logs())
+    sms_outbox.start()
+    sms_log_archiver.start()
+    export_jobs.start()
+    if SMS_STATS_BATCH_ENABLED:
+        sms_stats_aggregator.start()
     await init_super_admin()
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    await export_jobs.stop()
+    await sms_log_archiver.stop()
+    await sms_outbox.drain(SMS_OUTBOX_DRAIN_SECONDS)
+    await sms_stats_aggregator.stop()
+    await sms_log_writer.stop()
+    await token_revocations.stop()
+    await ttl_store.stop()
+    password_executor.shutdown()
     client.close()
\ No newline at end of file
@@ -310,6 +310,53 @@ class DeliveryManagementAPITester:
         overall_success = success1 and success2
         return self.log_test("Toggle Courier Status", overall_success, f"- Courier status toggled twice (disable/enable)")
 
+    def test_refresh_token_flow(self):
+        """Test refresh token exchange, rejection of access tokens and revocation on password change"""
+        timestamp = datetime.now().strftime('%H%M%S')
+        creds = {"username": f"refresh_courier_{timestamp}", "password": "RefreshPass123!"}
+        created, status, response = self.make_request(
+            'POST', 'couriers', data=creds, token=self.tokens.get('company_admin'), expected_status=200
+        )
+        if not created:
+            return self.log_test("Refresh Token Flow", False, f"- Courier creation failed: {status}, {response}")
+        
+        logged_in, status, login = self.make_request('POST', 'auth/login', data=creds, expected_status=200)
+        if not logged_in or not login.get('refresh_token'):
+            return self.log_test("Refresh Token Flow", False, f"- Login gave no refresh token: {status}, {login}")
+        courier_id = login['user']['id']
+        
+        # Test 1: A valid refresh token returns a working access token and a new refresh token
+        refreshed, status1, tokens = self.make_request(
+            'POST', 'auth/refresh', data={"refresh_token": login['refresh_token']}, expected_status=200
+        )
+        usable = refreshed and self.make_request(
+            'GET', 'courier/deliveries', token=tokens.get('access_token'), expected_status=200
+        )[0]
+        valid_ok = usable and bool(tokens.get('refresh_token')) and tokens.get('expires_in', 0) > 0
+        
+        # Test 2: An access token is not accepted as a refresh token
+        access_rejected, status2, _ = self.make_request(
+            'POST', 'auth/refresh', data={"refresh_token": login['access_token']}, expected_status=401
+        )
+        
+        # Test 3: Changing the password revokes the refresh tokens issued before
+        self.make_request(
+            'PATCH', f'couriers/{courier_id}',
+            data={"username": creds['username'], "password": "RefreshPass456!"},
+            token=self.tokens.get('company_admin'), expected_status=200
+        )
+        revoked, status3, response3 = self.make_request(
+            'POST', 'auth/refresh', data={"refresh_token": tokens.get('refresh_token', login['refresh_token'])},
+            expected_status=401
+        )
+        
+        self.make_request('DELETE', f'couriers/{courier_id}', token=self.tokens.get('company_admin'))
+        
+        overall_success = valid_ok and access_rejected and revoked
+        details = (f"- Valid refresh: {valid_ok} ({status1}), Access token rejected: {access_rejected} ({status2}), "
+                   f"Revoked after password change: {revoked} ({status3})")
+        return self.log_test("Refresh Token Flow", overall_success, details)
+
     # ========== CUSTOMER MANAGEMENT TESTS ==========
     
     def test_create_customer(self):
@@ -624,6 +671,103 @@ class DeliveryManagementAPITester:
         else:
             return self.log_test("Assign Order", False, f"- Status: {status}, Response: {response}")
 
+    def test_bulk_order_updates(self):
+        """Test bulk assign, bulk unassign, delivered orders being rejected and unknown ids"""
+        if 'courier_id' not in self.test_data:
+            return self.log_test("Bulk Order Updates", False, "- Missing courier data")
+
+        token = self.tokens.get('company_admin')
+        order_ids = []
+        for index in range(2):
+            # No phone number, delivering these must not send SMS
+            success, status, response = self.make_request(
+                'POST', 'orders',
+                data={"customer_name": f"Bulk Test {index}", "delivery_address": f"Via Bulk {index}, Milano"},
+                token=token
+            )
+            if not success:
+                return self.log_test("Bulk Order Updates", False, f"- Order creation status: {status}, Response: {response}")
+            order_ids.append(response['order']['id'])
+        first, second = order_ids
+
+        def outcomes(response):
+            return [result.get('outcome') for result in response.get('results', [])]
+
+        _, assign_status, assigned = self.make_request(
+            'PATCH', 'orders/bulk-assign',
+            data={"order_ids": [first, second, "not-an-order", first], "courier_id": self.test_data['courier_id']},
+            token=token
+        )
+        _, deliver_status, delivered = self.make_request(
+            'PATCH', 'orders/bulk-status', data={"order_ids": [second], "status": "delivered"}, token=token
+        )
+        _, unassign_status, unassigned = self.make_request(
+            'PATCH', 'orders/bulk-assign', data={"order_ids": [first, second]}, token=token
+        )
+        _, _, courier_deliveries = self.make_request(
+            'GET', 'courier/deliveries', token=self.tokens.get('courier')
+        )
+        _, empty_courier_status, _ = self.make_request(
+            'PATCH', 'orders/bulk-assign', data={"order_ids": [first], "courier_id": ""},
+            token=token, expected_status=422
+        )
+        _, empty_ids_status, _ = self.make_request(
+            'PATCH', 'orders/bulk-assign', data={"order_ids": []}, token=token, expected_status=400
+        )
+
+        checks = {
+            "assign": assign_status == 200 and assigned.get('updated') == 2
+            and outcomes(assigned) == ["updated", "updated", "not_found"],
+            "deliver": deliver_status == 200 and outcomes(delivered) == ["updated"],
+            "unassign": unassign_status == 200 and unassigned.get('updated') == 1
+            and outcomes(unassigned) == ["updated", "rejected"],
+            "delivered order rejected": "delivered" in unassigned.get('results', [{}, {}])[1].get('detail', ''),
+            "unassigned order left the courier": isinstance(courier_deliveries, list)
+            and all(order['id'] != first for order in courier_deliveries),
+            "empty courier id rejected": empty_courier_status == 422,
+            "empty order list rejected": empty_ids_status == 400,
+        }
+        failed = [name for name, ok in checks.items() if not ok]
+        if failed:
+            return self.log_test("Bulk Order Updates", False, f"- Failed checks: {failed}, Assign: {assigned}, Unassign: {unassigned}")
+        return self.log_test("Bulk Order Updates", True, "- Assign, unassign, rejection and not_found outcomes correct")
+
+    def test_orders_ndjson(self):
+        """Test the NDJSON listing: same page as JSON, one order per line, larger limits allowed"""
+        token = self.tokens.get('company_admin')
+        headers = {'Authorization': f'Bearer {token}'}
+        ndjson_headers = {**headers, 'Accept': 'application/x-ndjson'}
+        try:
+            json_page = requests.get(f"{self.api_url}/orders", headers=headers, params={"limit": 2})
+            ndjson_page = requests.get(f"{self.api_url}/orders", headers=ndjson_headers, params={"limit": 2})
+            large = requests.get(
+                f"{self.api_url}/orders", headers=ndjson_headers, params={"limit": 5000, "include_total": "true"}
+            )
+            large_json = requests.get(f"{self.api_url}/orders", headers=headers, params={"limit": 5000})
+        except Exception as e:
+            return self.log_test("Orders NDJSON", False, f"- Error: {str(e)}")
+
+        try:
+            lines = [json.loads(line) for line in ndjson_page.text.splitlines() if line]
+            large_lines = [json.loads(line) for line in large.text.splitlines() if line]
+        except ValueError as e:
+            return self.log_test("Orders NDJSON", False, f"- Invalid NDJSON line: {str(e)}")
+
+        checks = {
+            "ndjson content type": ndjson_page.status_code == 200
+            and ndjson_page.headers.get('content-type', '').startswith('application/x-ndjson'),
+            "same page as json": json_page.status_code == 200
+            and [order['id'] for order in lines] == [order['id'] for order in json_page.json()],
+            "same next cursor": ndjson_page.headers.get('x-next-cursor') == json_page.headers.get('x-next-cursor'),
+            "limit above the json maximum": large.status_code == 200
+            and len(large_lines) == int(large.headers.get('x-total-count', -1)),
+            "json keeps its maximum": large_json.status_code == 400,
+        }
+        failed = [name for name, ok in checks.items() if not ok]
+        if failed:
+            return self.log_test("Orders NDJSON", False, f"- Failed checks: {failed}")
+        return self.log_test("Orders NDJSON", True, f"- {len(large_lines)} orders streamed in one request")
+
     def test_order_search_filters(self):
         """Test order search with various filters"""
         # Test search by customer name
@@ -681,6 +825,183 @@ class DeliveryManagementAPITester:
             details = f"- Export functionality working"
         return self.log_test("Order Export", overall_success, details)
 
+    def import_orders_file(self, filename, content, content_type):
+        """Upload an order import file, make_request only sends JSON"""
+        try:
+            response = requests.post(
+                f"{self.api_url}/orders/import",
+                files={'file': (filename, content, content_type)},
+                headers={'Authorization': f"Bearer {self.tokens.get('company_admin')}"}
+            )
+            return response.status_code, response.json() if response.content else {}
+        except Exception as e:
+            return 0, {"error": str(e)}
+
+    def test_order_import_csv(self):
+        """Test CSV import: Italian headers, per-row errors and customers matched by phone"""
+        if 'customer' not in self.test_data:
+            return self.log_test("Order Import CSV", False, "- No customer data available")
+
+        # The update tests may have changed the phone, match against the stored one
+        success, status, existing = self.make_request(
+            'GET', f"customers/{self.test_data['customer']['id']}", token=self.tokens.get('company_admin')
+        )
+        if not success:
+            return self.log_test("Order Import CSV", False, f"- Customer lookup status: {status}")
+
+        ts = datetime.now().strftime('%H%M%S%f')
+        new_phone = f"+39 345 {ts[:7]}"
+        content = "\n".join([
+            "Cliente;Indirizzo;Telefono;Numero Riferimento",
+            f"Luca Verdi;Via Po 1 Torino;{new_phone};IMP-{ts}-1",
+            f"Luca Verdi;Via Po 1 Torino;{new_phone};IMP-{ts}-2",
+            f"{existing['name']};Via Garibaldi 46 Roma;{existing['phone_number']};IMP-{ts}-3",
+            f"Senza Indirizzo;;{new_phone};IMP-{ts}-4",
+            ";;;",
+        ]).encode('utf-8')
+        status, response = self.import_orders_file(f"ordini-{ts}.csv", content, 'text/csv')
+        if status != 200:
+            return self.log_test("Order Import CSV", False, f"- Status: {status}, Response: {response}")
+
+        _, _, customer_orders = self.make_request(
+            'GET', f"customers/{existing['id']}/orders", token=self.tokens.get('company_admin')
+        )
+        _, _, new_customers = self.make_request(
+            'GET', 'customers/search', params={"query": new_phone}, token=self.tokens.get('company_admin')
+        )
+        checks = {
+            "blank rows skipped": response.get('total_rows') == 4,
+            "valid rows created": response.get('created') == 3,
+            "one customer per new phone": response.get('customers_created') == 1
+            and isinstance(new_customers, list) and len(new_customers) == 1,
+            "row error reported": response.get('failed') == 1
+            and [error['row'] for error in response.get('errors', [])] == [5]
+            and 'delivery_address' in response['errors'][0]['error'],
+            "existing customer linked": isinstance(customer_orders, list)
+            and any(order.get('reference_number') == f"IMP-{ts}-3" for order in customer_orders),
+        }
+        failed = [name for name, ok in checks.items() if not ok]
+        if failed:
+            return self.log_test("Order Import CSV", False, f"- Failed checks: {failed}, Response: {response}")
+        return self.log_test("Order Import CSV", True, f"- {response['created']} created, {response['failed']} row error")
+
+    def test_order_import_xlsx(self):
+        """Test XLSX import, including phone numbers Excel stored as numbers"""
+        import io
+        from openpyxl import Workbook
+
+        ts = datetime.now().strftime('%H%M%S%f')
+        workbook = Workbook()
+        sheet = workbook.active
+        sheet.append(["customer_name", "delivery_address", "phone_number", "reference_number", "notes"])
+        sheet.append(["Giulia Neri", "Corso Italia 5, Milano", float(f"39347{ts[:7]}"), f"XLS-{ts}-1", "ignored"])
+        sheet.append(["Paolo Gialli", "Via Roma 8, Bari", None, f"XLS-{ts}-2", None])
+        sheet.append([None, "Via Nessuno 1", None, f"XLS-{ts}-3", None])
+        output = io.BytesIO()
+        workbook.save(output)
+
+        status, response = self.import_orders_file(
+            f"ordini-{ts}.xlsx", output.getvalue(),
+            'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+        )
+        _, _, customers = self.make_request(
+            'GET', 'customers/search', params={"query": f"39347{ts[:7]}"}, token=self.tokens.get('company_admin')
+        )
+        checks = {
+            "accepted": status == 200,
+            "valid rows created": response.get('created') == 2,
+            "phone kept as digits": isinstance(customers, list) and len(customers) == 1
+            and customers[0]['phone_number'] == f"39347{ts[:7]}",
+            "row error reported": [error['row'] for error in response.get('errors', [])] == [4],
+        }
+        failed = [name for name, ok in checks.items() if not ok]
+        if failed:
+            return self.log_test("Order Import XLSX", False, f"- Failed checks: {failed}, Status: {status}, Response: {response}")
+        return self.log_test("Order Import XLSX", True, f"- {response['created']} created from the workbook")
+
+    def test_order_import_rejections(self):
+        """Test that unusable files are rejected as a whole and concurrent imports share new customers"""
+        from concurrent.futures import ThreadPoolExecutor
+
+        missing_status, _ = self.import_orders_file(
+            "ordini.csv", b"Cliente,Telefono\nMario,+39 333 0000000\n", 'text/csv'
+        )
+        extension_status, _ = self.import_orders_file("ordini.txt", b"Cliente,Indirizzo\n", 'text/plain')
+
+        # Both requests see the phone as new, the one losing the insert must link the other's customer
+        ts = datetime.now().strftime('%H%M%S%f')
+        phone = f"+39 346 {ts[:7]}"
+        content = f"Cliente,Indirizzo,Telefono\nAnna Blu,Via Dante 3,{phone}\n".encode('utf-8')
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            results = list(pool.map(
+                lambda _: self.import_orders_file(f"ordini-{ts}.csv", content, 'text/csv'), range(2)
+            ))
+        _, _, customers = self.make_request(
+            'GET', 'customers/search', params={"query": phone}, token=self.tokens.get('company_admin')
+        )
+
+        checks = {
+            "missing required column": missing_status == 400,
+            "unsupported file type": extension_status == 400,
+            "concurrent imports succeed": all(status == 200 and response.get('created') == 1 for status, response in results),
+            "one customer for the phone": isinstance(customers, list) and len(customers) == 1
+            and sum(response.get('customers_created', 0) for _, response in results) == 1,
+        }
+        failed = [name for name, ok in checks.items() if not ok]
+        if failed:
+            return self.log_test("Order Import Rejections", False, f"- Failed checks: {failed}, Results: {results}")
+        return self.log_test("Order Import Rejections", True, "- Bad files rejected, concurrent imports share the customer")
+
+    def test_export_job_flow(self):
+        """Test background export jobs: create, poll until done, download and resume with a range"""
+        import time
+        token = self.tokens.get('company_admin')
+        success, status, job = self.make_request(
+            'POST', 'exports/orders',
+            data={"format": "csv"},
+            token=token,
+            expected_status=202
+        )
+        if not success or 'id' not in job:
+            return self.log_test("Export Job Flow", False, f"- Create status: {status}, Response: {job}")
+
+        # Poll the status endpoint until the worker finished the job
+        deadline = time.time() + 60
+        while job.get('status') in ('queued', 'running') and time.time() < deadline:
+            time.sleep(1)
+            success, status, job = self.make_request('GET', f"exports/{job['id']}", token=token)
+            if not success:
+                return self.log_test("Export Job Flow", False, f"- Status poll: {status}, Response: {job}")
+        if job.get('status') != 'done' or not job.get('download_url'):
+            return self.log_test("Export Job Flow", False, f"- Job did not finish: {job}")
+
+        success, status, jobs = self.make_request('GET', 'exports', token=token)
+        listed = success and any(listed_job['id'] == job['id'] for listed_job in jobs)
+
+        download_url = f"{self.base_url}{job['download_url']}"
+        headers = {'Authorization': f'Bearer {token}'}
+        full = requests.get(download_url, headers=headers)
+        partial = requests.get(download_url, headers={**headers, 'Range': 'bytes=0-9'})
+        resumed = requests.get(download_url, headers={**headers, 'Range': 'bytes=10-'})
+        unsatisfiable = requests.get(download_url, headers={**headers, 'Range': f"bytes={job['size']}-"})
+        _, missing_status, _ = self.make_request('GET', 'exports/not-a-job/download', token=token, expected_status=404)
+
+        checks = {
+            "listed": listed,
+            "full download": full.status_code == 200 and len(full.content) == job['size']
+            and full.headers.get('accept-ranges') == 'bytes',
+            "csv header row": full.content.decode('utf-8-sig').startswith('Cliente,Indirizzo,Telefono'),
+            "partial download": partial.status_code == 206 and partial.content == full.content[:10]
+            and partial.headers.get('content-range') == f"bytes 0-9/{job['size']}",
+            "resumed download": resumed.status_code == 206 and full.content[:10] + resumed.content == full.content,
+            "range past the end rejected": unsatisfiable.status_code == 416,
+            "unknown job": missing_status == 404,
+        }
+        failed = [name for name, ok in checks.items() if not ok]
+        if failed:
+            return self.log_test("Export Job Flow", False, f"- Failed checks: {failed}")
+        return self.log_test("Export Job Flow", True, f"- {job['rows_written']} rows, {job['size']} bytes, range resume works")
+
     # ========== COURIER API TESTS ==========
     
     def test_courier_login(self):
@@ -3038,6 +3359,7 @@ class DeliveryManagementAPITester:
         self.test_get_couriers()
         self.test_update_courier()
         self.test_toggle_courier_status()
+        self.test_refresh_token_flow()
         
         # Phase 5: Customer Management Tests
         print("\n📋 Phase 5: Customer Management Tests")
@@ -3056,16 +3378,22 @@ class DeliveryManagementAPITester:
         self.test_create_order_existing_phone_link()
         self.test_create_order()
         self.test_get_orders()
+        self.test_orders_ndjson()
         self.test_update_order()
         self.test_assign_order()
         self.test_order_search_filters()
         self.test_order_export()
+        self.test_export_job_flow()
+        self.test_order_import_csv()
+        self.test_order_import_xlsx()
+        self.test_order_import_rejections()
         
         # Phase 7: Courier API Tests
         print("\n📋 Phase 7: Courier API Tests")
         self.test_courier_login()
         self.test_get_courier_deliveries()
         self.test_mark_delivery_completed()
+        self.test_bulk_order_updates()
         
         # Phase 8: SMS Notification Tests
         print("\n📋 Phase 8: SMS Notification Tests")
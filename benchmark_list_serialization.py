@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+CPU cost of serializing a GET /api/orders page, before and after the fast list path.
+
+"before" replays what the endpoint used to do: validate every document with
+Order(**doc), let FastAPI re-validate the list against response_model=List[Order]
+and render it with the stdlib JSON encoder. "after" is model_list_response() on
+documents read with ORDER_PROJECTION. Mongo is not involved, the BSON decoding
+saved by the projection (no _id, no search fields) comes on top of these numbers.
+
+Usage (with the backend requirements installed):
+    python benchmark_list_serialization.py [--orders 1000] [--rounds 50]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "benchmark")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+
+from bson import ObjectId  # noqa: E402
+from fastapi.responses import JSONResponse  # noqa: E402
+from fastapi.routing import serialize_response  # noqa: E402
+
+try:
+    from fastapi.utils import create_response_field as create_field
+except ImportError:
+    from fastapi.utils import create_model_field as create_field
+
+import server  # noqa: E402
+from server import ORDER_PROJECTION, Order, build_search_fields, model_list_response  # noqa: E402
+
+
+def make_orders(count):
+    """Documents shaped like db.orders rows, as Motor returns them"""
+    start = datetime(2025, 1, 1, 8, 0)
+    documents = []
+    for i in range(count):
+        order = {
+            "_id": ObjectId(),
+            "id": str(uuid.uuid4()),
+            "customer_name": f"Cliente Numero {i}",
+            "delivery_address": f"Via Giuseppe Garibaldi {i}, 20121 Milano MI",
+            "phone_number": f"+39333{i:07d}",
+            "reference_number": f"REF-{i:06d}",
+            "company_id": "company-1",
+            "courier_id": "courier-1" if i % 3 else None,
+            "customer_id": str(uuid.uuid4()),
+            "status": ("pending", "assigned", "in_progress", "delivered")[i % 4],
+            "created_at": start + timedelta(minutes=i),
+            "delivered_at": start + timedelta(minutes=i, hours=2) if i % 4 == 3 else None,
+            "sms_sent": i % 4 == 3,
+        }
+        order.update(build_search_fields("orders", order))
+        documents.append(order)
+    return documents
+
+
+async def before(documents, field):
+    orders = [Order(**document) for document in documents]
+    content = await serialize_response(field=field, response_content=orders, is_coroutine=True)
+    return JSONResponse(content).body
+
+
+def after(documents):
+    return model_list_response(Order, documents).body
+
+
+def measure(label, rounds, run):
+    run()  # warm up
+    started = time.process_time()
+    for _ in range(rounds):
+        body = run()
+    per_request = (time.process_time() - started) / rounds * 1000
+    print(f"{label:<8} {per_request:8.2f} ms CPU/request  {len(body) / 1024:8.1f} KiB")
+    return per_request
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--orders", type=int, default=1000)
+    parser.add_argument("--rounds", type=int, default=50)
+    args = parser.parse_args()
+
+    documents = make_orders(args.orders)
+    projected = [{key: document.get(key) for key in ORDER_PROJECTION if key != "_id"} for document in documents]
+    field = create_field(name="Response_get_orders", type_=list[Order], mode="serialization")
+    loop = asyncio.new_event_loop()
+
+    print(f"GET /api/orders with {args.orders} orders, {args.rounds} rounds "
+          f"({server.DefaultJSONResponse.__name__} is the default response class)")
+    slow = measure("before", args.rounds, lambda: loop.run_until_complete(before(documents, field)))
+    fast = measure("after", args.rounds, lambda: after(projected))
+    print(f"speedup  {slow / fast:8.1f}x")
+    loop.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -19,6 +19,40 @@ class AuthServiceClass {
       }
       return config;
     });
+
+    // Access tokens are short-lived: on a 401 exchange the refresh token once and retry
+    this.apiClient.interceptors.response.use(
+      (response) => response,
+      async (error) => {
+        const originalRequest = error.config;
+        if (
+          error.response?.status !== 401 ||
+          !originalRequest ||
+          originalRequest._retried ||
+          originalRequest.url?.includes('/auth/')
+        ) {
+          throw error;
+        }
+
+        const refreshToken = await SecureStore.getItemAsync('farmygo_refresh_token');
+        if (!refreshToken) {
+          throw error;
+        }
+
+        originalRequest._retried = true;
+        try {
+          const response = await axios.post(`${API_URL}/auth/refresh`, {
+            refresh_token: refreshToken,
+          });
+          await SecureStore.setItemAsync('farmygo_token', response.data.access_token);
+          await SecureStore.setItemAsync('farmygo_refresh_token', response.data.refresh_token);
+          return this.apiClient(originalRequest);
+        } catch (refreshError) {
+          await this.logout();
+          throw error;
+        }
+      }
+    );
   }
 
   async login(username, password) {
@@ -28,7 +62,7 @@ class AuthServiceClass {
         password,
       });
 
-      const { access_token, user } = response.data;
+      const { access_token, refresh_token, user } = response.data;
 
       // Only allow courier role
       if (user.role !== 'courier') {
@@ -37,6 +71,9 @@ class AuthServiceClass {
 
       // Store token securely
       await SecureStore.setItemAsync('farmygo_token', access_token);
+      if (refresh_token) {
+        await SecureStore.setItemAsync('farmygo_refresh_token', refresh_token);
+      }
 
       return user;
     } catch (error) {
@@ -65,6 +102,7 @@ class AuthServiceClass {
   async logout() {
     try {
       await SecureStore.deleteItemAsync('farmygo_token');
+      await SecureStore.deleteItemAsync('farmygo_refresh_token');
     } catch (error) {
       console.error('Logout failed:', error);
     }
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Local fake of the Twilio Messages API for exercising the SMS outbox without
+sending real messages.
+
+Usage:
+    python fake_twilio_server.py --port 8099 [--fail-rate 0.1] [--rate-limit 5] [--latency 0.2]
+
+Then start the backend with:
+    TWILIO_API_BASE=http://localhost:8099 TWILIO_ACCOUNT_SID=ACfake TWILIO_AUTH_TOKEN=fake
+
+Received messages can be inspected with GET /messages and cleared with DELETE /messages.
+"""
+import argparse
+import asyncio
+import random
+import time
+import uuid
+
+from aiohttp import web
+
+
+class FakeTwilio:
+    def __init__(self, fail_rate=0.0, rate_limit=0, latency=0.0):
+        self.fail_rate = fail_rate
+        self.rate_limit = rate_limit  # max messages per second, 0 = unlimited
+        self.latency = latency
+        self.messages = []
+        self.window_start = time.monotonic()
+        self.window_count = 0
+
+    async def create_message(self, request):
+        form = await request.post()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if self.rate_limit:
+            now = time.monotonic()
+            if now - self.window_start >= 1:
+                self.window_start = now
+                self.window_count = 0
+            self.window_count += 1
+            if self.window_count > self.rate_limit:
+                return web.json_response(
+                    {"code": 20429, "message": "Too Many Requests", "status": 429},
+                    status=429,
+                    headers={"Retry-After": "1"}
+                )
+
+        if random.random() < self.fail_rate:
+            return web.json_response({"code": 20500, "message": "Internal Server Error", "status": 500}, status=500)
+
+        if not form.get("To") or not form.get("Body"):
+            return web.json_response({"code": 21604, "message": "A 'To' phone number is required.", "status": 400}, status=400)
+
+        message = {
+            "sid": "SM" + uuid.uuid4().hex,
+            "account_sid": request.match_info["account_sid"],
+            "to": form.get("To"),
+            "from": form.get("From"),
+            "body": form.get("Body"),
+            "status": "queued",
+            "received_at": time.time()
+        }
+        self.messages.append(message)
+        print(f"📨 {message['to']}: {message['body']}")
+        return web.json_response(message, status=201)
+
+    async def list_messages(self, request):
+        return web.json_response({"count": len(self.messages), "messages": self.messages})
+
+    async def clear_messages(self, request):
+        self.messages.clear()
+        return web.json_response({"count": 0})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Twilio Messages API")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="fraction of requests answered with 500")
+    parser.add_argument("--rate-limit", type=int, default=0, help="messages per second before answering 429")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds to wait before answering")
+    args = parser.parse_args()
+
+    fake = FakeTwilio(args.fail_rate, args.rate_limit, args.latency)
+    app = web.Application()
+    app.router.add_post("/2010-04-01/Accounts/{account_sid}/Messages.json", fake.create_message)
+    app.router.add_get("/messages", fake.list_messages)
+    app.router.add_delete("/messages", fake.clear_messages)
+    web.run_app(app, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
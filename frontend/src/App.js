@@ -23,6 +23,44 @@ import { Truck, Package, Users, Building2, CheckCircle, Clock, User, LogOut, Shi
 const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
 const API = `${BACKEND_URL}/api`;
 
+// Access tokens are short-lived: on a 401 exchange the refresh token once and retry
+let refreshRequest = null;
+
+axios.interceptors.response.use(
+  (response) => response,
+  async (error) => {
+    const originalRequest = error.config;
+    const refreshToken = localStorage.getItem('refresh_token');
+    if (
+      error.response?.status !== 401 ||
+      !refreshToken ||
+      !originalRequest ||
+      originalRequest._retried ||
+      originalRequest.url?.includes('/auth/')
+    ) {
+      return Promise.reject(error);
+    }
+
+    originalRequest._retried = true;
+    try {
+      if (!refreshRequest) {
+        refreshRequest = axios.post(`${API}/auth/refresh`, { refresh_token: refreshToken })
+          .finally(() => { refreshRequest = null; });
+      }
+      const { data } = await refreshRequest;
+      localStorage.setItem('token', data.access_token);
+      localStorage.setItem('refresh_token', data.refresh_token);
+      axios.defaults.headers.common['Authorization'] = `Bearer ${data.access_token}`;
+      originalRequest.headers['Authorization'] = `Bearer ${data.access_token}`;
+      return axios(originalRequest);
+    } catch (refreshError) {
+      localStorage.removeItem('token');
+      localStorage.removeItem('refresh_token');
+      return Promise.reject(error);
+    }
+  }
+);
+
 // Auth Context
 const AuthContext = React.createContext();
 
@@ -62,8 +100,11 @@ function AuthProvider({ children }) {
     localStorage.setItem('language', language);
   }, [language]);
 
-  const login = async (token, userData, companyData = null) => {
+  const login = async (token, userData, companyData = null, refreshToken = null) => {
     localStorage.setItem('token', token);
+    if (refreshToken) {
+      localStorage.setItem('refresh_token', refreshToken);
+    }
     localStorage.setItem('user', JSON.stringify(userData));
     if (companyData) {
       localStorage.setItem('company', JSON.stringify(companyData));
@@ -80,6 +121,7 @@ function AuthProvider({ children }) {
 
   const logout = () => {
     localStorage.removeItem('token');
+    localStorage.removeItem('refresh_token');
     localStorage.removeItem('user');
     localStorage.removeItem('company');
     setUser(null);
@@ -144,8 +186,8 @@ function Login() {
         password
       });
 
-      const { access_token, user, company } = response.data;
-      login(access_token, user, company);
+      const { access_token, refresh_token, user, company } = response.data;
+      login(access_token, user, company, refresh_token);
       
       toast({
         title: t.loginSuccessful,
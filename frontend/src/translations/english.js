@@ -114,7 +114,7 @@ export const english = {
   courierDeletedSuccessfully: "Courier deleted successfully",
   orderCreatedSuccessfully: "Order created successfully",
   orderAssignedSuccessfully: "Order assigned successfully",
-  deliveryMarkedCompleted: "Delivery marked as completed and customer notified!",
+  deliveryMarkedCompleted: "Delivery marked as completed, customer notification queued!",
   statusUpdated: "Status updated",
   failedToFetchData: "Failed to fetch data",
   failedToCreateCompany: "Failed to create company",
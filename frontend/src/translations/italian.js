@@ -159,7 +159,7 @@ export const italian = {
   courierCreatedSuccessfully: "Corriere creato con successo",
   orderCreatedSuccessfully: "Ordine creato con successo",
   orderAssignedSuccessfully: "Ordine assegnato con successo",
-  deliveryMarkedCompleted: "Consegna segnata come completata e cliente notificato!",
+  deliveryMarkedCompleted: "Consegna segnata come completata, notifica al cliente in coda!",
   statusUpdated: "Stato aggiornato",
   failedToFetchData: "Impossibile recuperare i dati",
   failedToCreateCompany: "Impossibile creare l'azienda",
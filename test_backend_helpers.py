@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+"""
+Offline checks for the pure helpers in backend/server.py. No server or database
+is needed, only the backend requirements.
+
+Usage:
+    python test_backend_helpers.py
+"""
+import base64
+import os
+import re
+import sys
+import time
+from datetime import datetime, timezone
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "helpers_test")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+
+from fastapi import HTTPException  # noqa: E402
+from fastapi.responses import Response  # noqa: E402
+
+import server  # noqa: E402
+
+
+class BackendHelpersTester:
+    def __init__(self):
+        self.tests_run = 0
+        self.tests_passed = 0
+
+    def log_test(self, name, success, details=""):
+        """Log test results"""
+        self.tests_run += 1
+        if success:
+            self.tests_passed += 1
+            print(f"✅ {name} - PASSED {details}")
+        else:
+            print(f"❌ {name} - FAILED {details}")
+        return success
+
+    def check(self, name, checks):
+        """Log one test from a dict of named boolean checks"""
+        failed = [check for check, ok in checks.items() if not ok]
+        return self.log_test(name, not failed, f"- {failed or len(checks)} checks")
+
+    def raises_http(self, status_code, function, *args):
+        try:
+            function(*args)
+        except HTTPException as e:
+            return e.status_code == status_code
+        return False
+
+    def test_token_bucket(self):
+        """Burst, refill and deferral slots of the SMS rate limiter"""
+        bucket = server.TokenBucket(rate=100, burst=2)
+        burst_ok = bucket.wait_time() == 0
+        bucket.consume()
+        bucket.consume()
+        empty_wait = bucket.wait_time()
+        time.sleep(0.02)
+        refilled = bucket.wait_time() == 0
+        bucket.consume()
+        bucket.consume()
+        bucket.consume()
+        overdrawn_wait = bucket.wait_time()
+        time.sleep(overdrawn_wait + 0.005)
+        refilled_after_wait = bucket.wait_time() == 0
+
+        limiter = server.SMSRateLimiter(1000, 1000, 2, 2)
+        waits = [limiter.acquire("company-1") for _ in range(5)]
+        checks = {
+            "burst available": burst_ok,
+            "empty bucket waits about one interval": 0 < empty_wait <= 0.01,
+            "refills over time": refilled,
+            "overdrawn bucket waits longer": overdrawn_wait > empty_wait,
+            "waiting the reported time refills": refilled_after_wait,
+            "burst then deferred": waits[:2] == [0.0, 0.0] and all(wait > 0 for wait in waits[2:]),
+            "deferred items get distinct slots": all(b - a >= 0.49 for a, b in zip(waits[2:], waits[3:])),
+            "saturated company skipped": limiter.saturated_companies() == ["company-1"],
+            "other company unaffected": limiter.acquire("company-2") == 0.0,
+        }
+        return self.check("TokenBucket/SMSRateLimiter", checks)
+
+    def test_encode_sms(self):
+        """Segment counts at the GSM-7 and UCS-2 boundaries and the gsm7 policy"""
+        checks = {
+            "gsm7 160 chars is one segment": server.encode_sms("a" * 160, "unicode").segments == 1,
+            "gsm7 161 chars is two segments": server.encode_sms("a" * 161, "unicode").segments == 2,
+            "extension chars count twice": server.encode_sms("€" * 80, "unicode").segments == 1
+            and server.encode_sms("€" * 81, "unicode").segments == 2,
+            "ucs2 70 chars is one segment": server.encode_sms("ł" * 70, "unicode").segments == 1,
+            "ucs2 71 chars is two segments": server.encode_sms("ł" * 71, "unicode").segments == 2,
+            "emoji take two code units": server.encode_sms("😀" * 35, "unicode").segments == 1
+            and server.encode_sms("😀" * 36, "unicode").segments == 2,
+            "unicode policy keeps the text": server.encode_sms("Ciao “Anna” 😀", "unicode").encoding == "ucs2",
+        }
+        encoded = server.encode_sms("Ciao “Anna”, l’ordine è in consegna 😀", "gsm7")
+        checks["gsm7 policy transliterates"] = (
+            encoded.encoding == "gsm7" and encoded.transliterated
+            and encoded.text == "Ciao \"Anna\", l'ordine è in consegna"
+        )
+        return self.check("encode_sms", checks)
+
+    def test_cursors(self):
+        """encode_cursor/decode_cursor round trips and rejects foreign or broken cursors"""
+        def b64(text):
+            return base64.urlsafe_b64encode(text.encode()).decode().rstrip("=")
+
+        created_at = datetime(2025, 3, 1, 12, 30, tzinfo=timezone.utc)
+        cursor = server.encode_cursor("created_at", {"id": "order-1", "created_at": created_at})
+        name_cursor = server.encode_cursor("name", {"id": "customer-1", "name": "Anna"})
+        checks = {
+            "datetime round trip": server.decode_cursor(cursor, "created_at") == (created_at, "order-1"),
+            "string round trip": server.decode_cursor(name_cursor, "name") == ("Anna", "customer-1"),
+            "url safe": all(char.isalnum() or char in "-_" for char in cursor),
+            "other listing rejected": self.raises_http(400, server.decode_cursor, cursor, "name"),
+            "garbage rejected": self.raises_http(400, server.decode_cursor, "not-a-cursor", "created_at"),
+            "empty cursor rejected": self.raises_http(400, server.decode_cursor, "", "created_at"),
+            "truncated cursor rejected": self.raises_http(400, server.decode_cursor, cursor[:-4], "created_at"),
+            "not json rejected": self.raises_http(400, server.decode_cursor, b64("created_at|x"), "created_at"),
+            "missing keys rejected": self.raises_http(400, server.decode_cursor, b64('{"f": "created_at"}'), "created_at"),
+        }
+        page = server.PageParams(limit=10, cursor=cursor)
+        query = server.keyset_query({"company_id": "c1"}, page, "created_at", -1)
+        checks["keyset query"] = query == {"$and": [{"company_id": "c1"}, {"$or": [
+            {"created_at": {"$lt": created_at}},
+            {"created_at": created_at, "id": {"$lt": "order-1"}}
+        ]}]}
+        return self.check("encode_cursor/decode_cursor", checks)
+
+    def test_compile_search_query(self):
+        """Queries only use indexed grams of the document fields and escape the regex"""
+        order = {"customer_name": "Rossi Mario", "phone_number": "+39 333 1234567", "reference_number": "A.1"}
+        grams = set(server.build_search_fields("orders", order)["search_grams"])
+
+        def gram_sets(query):
+            # Every $all of the query must be a subset of the document grams to match it
+            clauses = query["$or"] if "$or" in query else [query]
+            return [
+                set(part["search_grams"]["$all"])
+                for clause in clauses
+                for part in (clause["$and"] if "$and" in clause else [clause])
+                if "search_grams" in part
+            ]
+
+        name_query = server.compile_search_query("c1", "ross", ("n",))
+        checks = {
+            "scoped to the company": name_query["company_id"] == "c1",
+            "substring of a name": all(clause <= grams for clause in gram_sets(name_query)),
+            "short word is a prefix": gram_sets(server.compile_search_query("c1", "ma", ("n",))) == [{"n:ma"}],
+            "phone digits only": gram_sets(server.compile_search_query("c1", "333-123", ("p",)))[0] <= grams,
+            "one branch per field": len(server.compile_search_query("c1", "rossi", ("n", "p", "r"))["$or"]) == 2,
+            "no regex syntax reaches $regex": server.compile_search_query("c1", "ab.*(c", ("r",))["$and"][1]
+            == {"search_text.r": {"$regex": re.escape("ab c")}},
+            "empty term rejected": self.raises_http(400, server.compile_search_query, "c1", "...", ("n",)),
+            "long term rejected": self.raises_http(
+                400, server.compile_search_query, "c1", "a" * (server.SEARCH_MAX_TERM_LENGTH + 1), ("n",)
+            ),
+        }
+        return self.check("compile_search_query", checks)
+
+    def test_etag_matches(self):
+        """Weak comparison, lists and the wildcard"""
+        etag = 'W/"1.5-abc"'
+        checks = {
+            "no header": not server.etag_matches(None, etag),
+            "same weak etag": server.etag_matches('W/"1.5-abc"', etag),
+            "strong form matches weakly": server.etag_matches('"1.5-abc"', etag),
+            "one of a list": server.etag_matches('"x", W/"1.5-abc" , "y"', etag),
+            "wildcard": server.etag_matches("*", etag),
+            "other version": not server.etag_matches('W/"1.6-abc"', etag),
+            "weak list": server.etag_matches('W/"0.1-abc", W/"1.5-abc"', etag),
+            "empty list entries ignored": server.etag_matches(' , ,W/"1.5-abc",', etag),
+            "no list entry matches": not server.etag_matches('W/"1.4-abc", "1.6-abc"', etag),
+            "empty header": not server.etag_matches("", etag),
+            "bare weak prefix": not server.etag_matches("W/", etag),
+        }
+        return self.check("etag_matches", checks)
+
+    def test_parse_range_header(self):
+        """Single byte ranges of export downloads, open and suffix forms, 416 otherwise"""
+        checks = {
+            "no header is the whole file": server.parse_range_header(None, 100) is None,
+            "closed range": server.parse_range_header("bytes=0-9", 100) == (0, 9),
+            "open range resumes": server.parse_range_header("bytes=10-", 100) == (10, 99),
+            "end clamped to the file": server.parse_range_header("bytes=90-200", 100) == (90, 99),
+            "suffix range": server.parse_range_header("bytes=-10", 100) == (90, 99),
+            "start past the end": self.raises_http(416, server.parse_range_header, "bytes=100-", 100),
+            "several ranges": self.raises_http(416, server.parse_range_header, "bytes=0-1,5-6", 100),
+            "other unit": self.raises_http(416, server.parse_range_header, "items=0-1", 100),
+            "malformed": self.raises_http(416, server.parse_range_header, "bytes=a-b", 100),
+        }
+        return self.check("parse_range_header", checks)
+
+    def test_response_cache(self):
+        """LRU by entry count and bytes, disabled cache and oversized bodies pass through"""
+        def body(size):
+            return Response(content=b"x" * size, media_type="application/json", headers={"ETag": "e"})
+
+        cache = server.ResponseCache(True, max_entries=2, max_bytes=400)
+        cache.put("a", body(50))
+        cache.put("b", body(50))
+        cache.get("a")
+        cache.put("c", body(50))
+        hit = cache.get("a")
+
+        by_bytes = server.ResponseCache(True, max_entries=10, max_bytes=400)
+        for key in "abcd":
+            by_bytes.put(key, body(100))
+        by_bytes.put("e", body(100))
+
+        oversized = server.ResponseCache(True, max_entries=10, max_bytes=400)
+        oversized.put("big", body(101))
+        disabled = server.ResponseCache(False, max_entries=10, max_bytes=400)
+        disabled.put("a", body(10))
+
+        checks = {
+            "least recently used evicted": cache.get("b") is None and hit is not None,
+            "body and etag kept": hit is not None and hit.body == b"x" * 50 and hit.headers.get("etag") == "e",
+            "bounded by bytes": by_bytes.stats()["bytes"] <= 400 and by_bytes.get("a") is None,
+            "oversized not cached": oversized.stats()["entries"] == 0,
+            "disabled never hits": disabled.get("a") is None and disabled.stats()["entries"] == 0,
+        }
+        return self.check("ResponseCache", checks)
+
+    def run_all_tests(self):
+        print("🚀 Starting backend helper tests")
+        print("=" * 50)
+
+        self.test_token_bucket()
+        self.test_encode_sms()
+        self.test_cursors()
+        self.test_compile_search_query()
+        self.test_etag_matches()
+        self.test_parse_range_header()
+        self.test_response_cache()
+
+        print("\n" + "=" * 50)
+        print(f"📊 Test Results: {self.tests_passed}/{self.tests_run} tests passed")
+        return self.tests_passed == self.tests_run
+
+
+def main():
+    tester = BackendHelpersTester()
+    return 0 if tester.run_all_tests() else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())